@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark of classifying firewall source ranges as public-internet exposed,
+comparing a naive ipaddress-based check against the PublicSpace interval
+index.
+
+Usage: python3 bench/bench_cidr.py [--rules 20000] [--max-cidrs 50]
+"""
+
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cidr import NON_PUBLIC_RANGES, PublicSpace  # noqa: E402
+
+
+def synthetic_source_ranges(count, max_cidrs, seed=0):
+    """Returns lists of CIDRs resembling firewall sourceRanges, mixing private
+    ranges, narrow public blocks, wide public blocks and 0.0.0.0/0.
+    """
+    rng = random.Random(seed)
+    shared = [["0.0.0.0/0"], ["10.0.0.0/8"], ["0.0.0.0/1", "128.0.0.0/1"]]
+    rules = []
+    for _ in range(count):
+        if rng.random() < 0.3:
+            rules.append(rng.choice(shared))
+            continue
+        cidrs = []
+        for _ in range(rng.randint(1, max_cidrs)):
+            prefix = rng.choice([4, 8, 12, 16, 20, 24, 28, 32])
+            address = rng.getrandbits(32) & (2**32 - 2 ** (32 - prefix))
+            cidrs.append(f"{ipaddress.IPv4Address(address)}/{prefix}")
+        rules.append(cidrs)
+    return rules
+
+
+def naive_coverage(source_ranges, non_public):
+    """Counts covered public addresses using ipaddress objects directly."""
+    covered = 0
+    sources = ipaddress.collapse_addresses(
+        ipaddress.ip_network(c, strict=False) for c in source_ranges
+    )
+    for source in sources:
+        covered += source.num_addresses
+        for private in non_public:
+            if private.subnet_of(source):
+                covered -= private.num_addresses
+            elif source.subnet_of(private):
+                covered -= source.num_addresses
+                break
+    return covered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=20000)
+    parser.add_argument("--max-cidrs", type=int, default=50)
+    args = parser.parse_args()
+
+    rules = synthetic_source_ranges(args.rules, args.max_cidrs)
+    non_public = list(
+        ipaddress.collapse_addresses(ipaddress.ip_network(c) for c in NON_PUBLIC_RANGES)
+    )
+
+    start = time.perf_counter()
+    naive = [naive_coverage(r, non_public) for r in rules]
+    naive_secs = time.perf_counter() - start
+
+    public_space = PublicSpace()
+    start = time.perf_counter()
+    indexed = [public_space.coverage(r) for r in rules]
+    indexed_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exposed = sum(public_space.is_public_source(r) for r in rules)
+    cached_secs = time.perf_counter() - start
+
+    assert naive == indexed, "coverage differs"
+    print(f"rules={args.rules} cidrs={sum(len(r) for r in rules)} exposed={exposed}")
+    print(f"naive ipaddress:     {naive_secs:.3f}s")
+    print(f"PublicSpace:         {indexed_secs:.3f}s")
+    print(f"PublicSpace cached:  {cached_secs:.3f}s")
+    print("outputs are equivalent")
+
+
+if __name__ == "__main__":
+    main()
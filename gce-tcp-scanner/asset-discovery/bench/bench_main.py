@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Runs the full asset-discovery main() flow against a synthetic org served by
+FakeAssetServiceClient, with in-process stand-ins for GCS and Pub/Sub, and
+reports runtime, peak memory, Asset API calls and published messages at each
+scale.
+
+Requires the packages in src/requirements.txt to be installed. Any arguments
+after "--" are passed to asset-discovery itself.
+
+Usage: python3 bench/bench_main.py [--scales 1000,10000,100000]
+    [--error-rate 0.01] [-- --exposure-model instance --concurrent-listing]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import Future
+from functools import partial
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import main  # noqa: E402
+import ratelimit  # noqa: E402
+from fake_asset import FakeAssetServiceClient, FakeOrg  # noqa: E402
+from google.api_core.retry import Retry  # noqa: E402
+from publisher import ScanPublisher  # noqa: E402
+
+
+class FakeStorageClient:
+    """Stands in for bibt.gcp.storage.Client, keeping blobs in memory."""
+
+    blobs = {}
+
+    def read_gcs(self, bucket_name, blob_name, decode=True):
+        return self.blobs[(bucket_name, blob_name)]
+
+    def write_gcs(self, bucket_name, blob_name, data, mime_type="text/plain"):
+        self.blobs[(bucket_name, blob_name)] = data
+
+    def write_gcs_from_file(self, bucket_name, blob_name, file_path, mime_type=None):
+        with open(file_path) as f:
+            self.blobs[(bucket_name, blob_name)] = f.read()
+
+
+class FakePublisherClient:
+    """Stands in for pubsub_v1.PublisherClient, resolving every publish
+    immediately. Counts the distinct names port-scanner would file each
+    message's results under, which must match the number of messages.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.result_names = set()
+
+    def publish(self, topic, data):
+        self.messages += 1
+        self.bytes += len(data)
+        message = json.loads(data)
+        self.result_names.add(
+            (message["network"], message.get("job"), message.get("unit"))
+        )
+        future = Future()
+        future.set_result(str(self.messages))
+        return future
+
+
+def run_once(instances, error_rate, main_args):
+    FakeStorageClient.blobs = {}
+    ratelimit._limiters.clear()
+    asset_client = FakeAssetServiceClient(FakeOrg(instances), error_rate=error_rate)
+    publisher_client = FakePublisherClient()
+
+    main.get_asset_client = lambda asset_api_serv_acct=None: asset_client
+    main.storage = SimpleNamespace(Client=FakeStorageClient)
+    main.ScanPublisher = partial(ScanPublisher, client=publisher_client)
+    # Pages are served from memory, so don't pace or back off like real calls.
+    main.ASSET_API_RPM = 10**9
+    main.retry_policy = Retry(
+        predicate=main.is_retryable, initial=0.001, maximum=0.01, timeout=60.0
+    )
+
+    sys.argv = [
+        "main.py",
+        "--gcs-bucket",
+        "bench",
+        "--gcp-org-id",
+        "0",
+        "--pubsub-topic-uri",
+        "projects/bench/topics/scan",
+        "--asset-api-rpm",
+        str(main.ASSET_API_RPM),
+    ] + main_args
+    config = main.get_config()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.main(config)
+    secs = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"instances={instances:<8} time={secs:7.2f}s "
+        f"peak={peak / 2**20:8.1f} MiB "
+        f"api_calls={asset_client.api_calls:<6} "
+        f"injected_429s={asset_client.errors:<4} "
+        f"messages={publisher_client.messages:<6} "
+        f"result_names={len(publisher_client.result_names):<6} "
+        f"message_bytes={publisher_client.bytes}"
+    )
+
+
+def run():
+    argv = sys.argv[1:]
+    main_args = []
+    if "--" in argv:
+        main_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", type=str, default="1000,10000,100000")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    for instances in (int(s) for s in args.scales.split(",")):
+        run_once(instances, args.error_rate, main_args)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Microbenchmark comparing the legacy string-based merge_ports against the
+PortSet interval engine used by get_open_networks.
+
+Usage: python3 bench/bench_ports.py [--rules 20000] [--networks 50]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ports import PortSet  # noqa: E402
+
+
+def legacy_merge_ports(ports_list, port):
+    """Takes a list of ports and port ranges and a new port or port range
+    and merges it with the list.
+
+    The output looks like:
+    ["1-444", "447", "450-65535"]
+    """
+    merged_ports = []
+    if "-" in port:
+        p1, p2 = port.split("-")
+        p_low = min(int(p1), int(p2))
+        p_high = max(int(p1), int(p2))
+        added_range = False
+        for _p in ports_list:
+            if "-" in _p:  # we're comparing 2 ranges
+                _p1, _p2 = _p.split("-")
+                _p_low = min(int(_p1), int(_p2))
+                _p_high = max(int(_p1), int(_p2))
+                # no overlap
+                #  p        |-------|
+                # _p   |--|
+                if int(p_low) > int(_p_high) or int(p_high) < int(_p_low):
+                    merged_ports.append(_p)
+                # overlap pattern 1    overlap pattern 2
+                #  p       |-----|      p       |--|
+                # _p    |-----|        _p     |-----|
+                elif int(p_low) >= int(_p_low) and int(p_low) <= int(_p_high):
+                    if int(p_high) <= int(_p_high):
+                        # print(f"port range ({port}) is contained within
+                        # existing range ({_p}). returning.")
+                        return sorted(deepcopy(ports_list))  # p2
+                    else:
+                        merged_ports.append(f"{_p_low}-{p_high}")  # p1
+                        added_range = True
+                # overlap pattern 3    overlap pattern 4
+                #  p   |-----|          p    |-----|
+                # _p      |-----|      _p     |---|
+                elif int(_p_low) >= int(p_low) and int(_p_low) <= int(p_high):
+                    if int(_p_high) >= int(p_high):
+                        merged_ports.append(f"{p_low}-{_p_high}")  # p3
+                        added_range = True
+            else:  # we're comparing a range with a port
+                if not (int(_p) >= int(p_low) and int(_p) <= int(p_high)):
+                    merged_ports.append(_p)
+
+        if not added_range:
+            # print(f"adding port ({port}) to list.")
+            merged_ports.append(port)
+
+    else:
+        for _p in ports_list:
+            if "-" in _p:  # we're comparing a port with a range
+                _p1, _p2 = _p.split("-")
+                _p_low = min(int(_p1), int(_p2))
+                _p_high = max(int(_p1), int(_p2))
+                if int(port) >= int(_p_low) and int(port) <= int(_p_high):
+                    # print(f"port ({port}) is in the range ({_p}), returning")
+                    return sorted(deepcopy(ports_list))
+                merged_ports.append(_p)
+            else:
+                if int(_p) == int(port):  # we're comparing 2 ports
+                    # print(f"port ({port}) already present, returning.")
+                    return sorted(deepcopy(ports_list))
+                merged_ports.append(_p)
+        # print(f"adding port ({port}) to list.")
+        merged_ports.append(port)
+
+    return sorted(merged_ports)
+
+
+def synthetic_rules(count, networks, seed=0):
+    """Yields (network, [port, ...]) tuples resembling firewall "allowed" blocks."""
+    rng = random.Random(seed)
+    common = ["22", "80", "443", "3389", "8080", "8888", "5432", "6379"]
+    for _ in range(count):
+        network = f"projects/{rng.randint(1, networks)}/global/networks/default"
+        ports = []
+        for _ in range(rng.randint(1, 4)):
+            r = rng.random()
+            if r < 0.5:
+                ports.append(rng.choice(common))
+            elif r < 0.85:
+                ports.append(str(rng.randint(1, 65535)))
+            else:
+                low = rng.randint(1, 65000)
+                ports.append(f"{low}-{low + rng.randint(1, 500)}")
+        yield network, ports
+
+
+def run_legacy(rules):
+    network_configs = {}
+    for network, ports in rules:
+        network_configs.setdefault(network, [])
+        for port in ports:
+            network_configs[network] = legacy_merge_ports(
+                network_configs[network], port
+            )
+    return network_configs
+
+
+def run_portset(rules):
+    network_ports = {}
+    for network, ports in rules:
+        network_ports.setdefault(network, PortSet()).update(ports)
+    return {network: p.to_list() for network, p in network_ports.items()}
+
+
+def expand(port_list):
+    expanded = set()
+    for port in port_list:
+        if "-" in port:
+            low, high = (int(p) for p in port.split("-"))
+            expanded.update(range(min(low, high), max(low, high) + 1))
+        else:
+            expanded.add(int(port))
+    return expanded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=20000)
+    parser.add_argument("--networks", type=int, default=50)
+    args = parser.parse_args()
+
+    rules = list(synthetic_rules(args.rules, args.networks))
+
+    start = time.perf_counter()
+    legacy = run_legacy(rules)
+    legacy_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = run_portset(rules)
+    current_secs = time.perf_counter() - start
+
+    assert legacy.keys() == current.keys(), "network sets differ"
+    for network in legacy:
+        assert expand(legacy[network]) == expand(current[network]), network
+
+    print(f"rules={args.rules} networks={args.networks}")
+    print(f"legacy merge_ports: {legacy_secs:.3f}s")
+    print(f"PortSet:            {current_secs:.3f}s")
+    print(f"speedup:            {legacy_secs / max(current_secs, 1e-9):.1f}x")
+    print("outputs are equivalent")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Checks that firewall entries for protocols other than TCP neither expose
+nor hide the TCP ports an instance is scanned on.
+
+Usage: python3 bench/check_exposure.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from exposure import build_firewall_index, get_exposure_messages  # noqa: E402
+
+NETWORK = "projects/123456789/global/networks/default"
+
+
+def firewall(name, priority, **data):
+    data.update(
+        network=NETWORK,
+        direction="INGRESS",
+        priority=priority,
+        sourceRanges=["0.0.0.0/0"],
+    )
+    return SimpleNamespace(name=name, resource=SimpleNamespace(data=data))
+
+
+def exposed(*firewalls):
+    index = build_firewall_index(firewalls)
+    messages = get_exposure_messages(index, [(NETWORK, "34.1.2.3", (), (), None)])
+    return messages[0]["ports"] if messages else []
+
+
+def run():
+    allow_ssh = firewall(
+        "allow-ssh", 1000, allowed=[{"IPProtocol": "tcp", "ports": ["22"]}]
+    )
+    cases = [
+        ("tcp allow", [allow_ssh], ["22"]),
+        (
+            "udp deny above a tcp allow",
+            [allow_ssh, firewall("deny-udp", 100, denied=[{"IPProtocol": "udp"}])],
+            ["22"],
+        ),
+        (
+            "icmp, esp and sctp deny above a tcp allow",
+            [
+                allow_ssh,
+                firewall(
+                    "deny-other",
+                    100,
+                    denied=[
+                        {"IPProtocol": "icmp"},
+                        {"IPProtocol": "esp"},
+                        {"IPProtocol": "sctp"},
+                    ],
+                ),
+            ],
+            ["22"],
+        ),
+        (
+            "portless udp, esp and sctp allows",
+            [
+                firewall(
+                    "allow-other",
+                    1000,
+                    allowed=[
+                        {"IPProtocol": "udp"},
+                        {"IPProtocol": "esp"},
+                        {"IPProtocol": "sctp"},
+                    ],
+                )
+            ],
+            [],
+        ),
+        (
+            "all deny above a tcp allow",
+            [allow_ssh, firewall("deny-all", 100, denied=[{"IPProtocol": "all"}])],
+            [],
+        ),
+        (
+            "protocol 6 allow",
+            [firewall("allow-6", 1000, allowed=[{"IPProtocol": "6"}])],
+            ["1-65535"],
+        ),
+    ]
+    for name, firewalls, expected in cases:
+        ports = exposed(*firewalls)
+        assert ports == expected, f"{name}: exposed {ports}, expected {expected}"
+        print(f"{name:45} exposes {ports}")
+
+
+if __name__ == "__main__":
+    run()
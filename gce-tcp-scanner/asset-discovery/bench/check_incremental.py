@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Checks that listing the same assets in a different order yields the same
+scan messages, job ids and an empty incremental delta, using instances from
+the synthetic org in fake_asset.
+
+Some NAT IPs are also listed on a second network, as a shared-VPC service
+project's view of them would be, with network URLs in both the full and
+partial forms the Asset API returns, so the order networks are seen in
+varies too.
+
+Usage: python3 bench/check_incremental.py [--instances 5000] [--seed 0]
+"""
+
+import argparse
+import copy
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_asset import FakeOrg  # noqa: E402
+from incremental import diff_scan_messages, parse_scan_config  # noqa: E402
+from targets import build_target_index  # noqa: E402
+
+
+def list_instances(org, count):
+    instances = [org.instance(i) for i in range(count)]
+    for instance in instances[::10]:
+        shared = copy.deepcopy(instance)
+        for nic in shared.resource.data["networkInterfaces"]:
+            project = nic["network"].split("/")[1]
+            nic["network"] = (
+                "https://www.googleapis.com/compute/v1/projects/"
+                f"{int(project) % org.projects + 1}/global/networks/default"
+            )
+        instances.append(shared)
+    return instances
+
+
+def scan_config_text(messages):
+    # As written to {date}/scan-config.txt by asset-discovery.
+    return "".join(
+        f'{m["network"]}|{" ".join(m["ips"])}|{",".join(m["ports"])}\n'
+        for m in messages
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--instances", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    org = FakeOrg(instances=args.instances, projects=50)
+    instances = list_instances(org, args.instances)
+    open_networks = {org.network(p): ["22", "443"] for p in range(1, 51)}
+    open_networks[org.network(1)] = ["1-65535"]
+
+    messages = build_target_index(instances).scan_messages(open_networks)
+    previous = parse_scan_config(scan_config_text(messages))
+    rng = random.Random(args.seed)
+    for trial in range(1, 4):
+        rng.shuffle(instances)
+        for instance in instances:
+            rng.shuffle(instance.resource.data["networkInterfaces"])
+        shuffled = build_target_index(instances).scan_messages(open_networks)
+        assert shuffled == messages, f"trial {trial}: messages differ"
+        delta, removed = diff_scan_messages(previous, shuffled)
+        assert not delta and not removed, f"trial {trial}: spurious delta {delta}"
+        print(
+            f"shuffle {trial}: {len(shuffled)} messages, "
+            f"{len({m['job'] for m in shuffled})} job ids, empty delta"
+        )
+
+
+if __name__ == "__main__":
+    run()
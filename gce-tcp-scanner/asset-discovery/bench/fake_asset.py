@@ -0,0 +1,202 @@
+"""An in-process stand-in for asset_v1.AssetServiceClient that serves a
+synthetic organization of Project, Firewall and Instance assets.
+
+Assets are generated deterministically from a seed, one page at a time, so
+arbitrarily large orgs can be served without holding them in memory.
+"""
+
+import random
+import threading
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+
+COMMON_PORTS = ["22", "80", "443", "3389", "5432", "6379", "8080", "8888"]
+
+
+class FakeOrg:
+    """Describes a synthetic organization: how many instances, firewalls and
+    projects (each with its own VPC network) it has, the fraction of NICs with
+    a NAT IP, NICs per instance, and the mix of firewall rules (open to
+    0.0.0.0/0, open on every port, or restricted to target tags).
+    """
+
+    def __init__(
+        self,
+        instances=1000,
+        firewalls=None,
+        projects=None,
+        external_ip_ratio=0.5,
+        max_nics=2,
+        open_ratio=0.3,
+        full_range_ratio=0.02,
+        tagged_ratio=0.5,
+        seed=0,
+    ):
+        self.instances = instances
+        self.firewalls = firewalls if firewalls is not None else max(1, instances // 5)
+        self.projects = projects or max(1, instances // 20)
+        self.external_ip_ratio = external_ip_ratio
+        self.max_nics = max_nics
+        self.open_ratio = open_ratio
+        self.full_range_ratio = full_range_ratio
+        self.tagged_ratio = tagged_ratio
+        self.seed = seed
+        self._by_project = {}
+
+    def network(self, project):
+        return f"projects/{project}/global/networks/default"
+
+    def project(self, i):
+        return SimpleNamespace(
+            name=f"//cloudresourcemanager.googleapis.com/projects/{i}",
+            resource=SimpleNamespace(
+                data={"projectNumber": str(i), "lifecycleState": "ACTIVE"}
+            ),
+        )
+
+    def firewall(self, i):
+        rng = random.Random(f"{self.seed}-firewall-{i}")
+        project = rng.randint(1, self.projects)
+        data = {
+            "id": str(i),
+            "name": f"firewall-{i}",
+            "network": self.network(project),
+            "direction": "INGRESS",
+            "priority": rng.choice([100, 1000, 1000, 1000, 65534]),
+            "sourceRanges": (
+                ["0.0.0.0/0"] if rng.random() < self.open_ratio else ["10.0.0.0/8"]
+            ),
+        }
+        if rng.random() < self.full_range_ratio:
+            data["allowed"] = [{"IPProtocol": "tcp"}]
+        else:
+            ports = []
+            for _ in range(rng.randint(1, 4)):
+                r = rng.random()
+                if r < 0.6:
+                    ports.append(rng.choice(COMMON_PORTS))
+                elif r < 0.9:
+                    ports.append(str(rng.randint(1, 65535)))
+                else:
+                    low = rng.randint(1, 65000)
+                    ports.append(f"{low}-{low + rng.randint(1, 500)}")
+            data["allowed"] = [{"IPProtocol": "tcp", "ports": ports}]
+        if rng.random() < self.tagged_ratio:
+            data["targetTags"] = [f"tag-{rng.randint(1, 10)}"]
+        return SimpleNamespace(
+            name=f"//compute.googleapis.com/projects/{project}/global/firewalls/{i}",
+            resource=SimpleNamespace(data=data),
+        )
+
+    def instance(self, i):
+        rng = random.Random(f"{self.seed}-instance-{i}")
+        project = rng.randint(1, self.projects)
+        nics = []
+        for n in range(rng.randint(1, self.max_nics)):
+            nic = {
+                "network": self.network(
+                    project if n == 0 else rng.randint(1, self.projects)
+                ),
+                "networkIP": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            }
+            if rng.random() < self.external_ip_ratio:
+                nic["accessConfigs"] = [
+                    {
+                        "name": "External NAT",
+                        "natIP": f"34.{n}{i >> 16 & 15}.{i >> 8 & 255}.{i & 255}",
+                    }
+                ]
+            nics.append(nic)
+        return SimpleNamespace(
+            name=f"//compute.googleapis.com/projects/{project}/zones/z/instances/{i}",
+            resource=SimpleNamespace(
+                data={
+                    "id": str(i),
+                    "name": f"instance-{i}",
+                    "status": "RUNNING",
+                    "lastStartTimestamp": (
+                        f"2024-01-{i % 28 + 1:02d}T00:00:00.000-08:00"
+                    ),
+                    "tags": {"items": [f"tag-{rng.randint(1, 10)}"]},
+                    "networkInterfaces": nics,
+                }
+            ),
+        )
+
+    def project_of(self, kind, i):
+        # Every asset's project is the first draw from its seeded generator.
+        return random.Random(f"{self.seed}-{kind}-{i}").randint(1, self.projects)
+
+    def assets(self, asset_type, parent):
+        """Returns (count, factory) for the assets of a type under a parent."""
+        if asset_type.endswith("/Project"):
+            return self.projects, lambda i: self.project(i + 1)
+        kind = "firewall" if asset_type.endswith("/Firewall") else "instance"
+        factory = self.firewall if kind == "firewall" else self.instance
+        count = self.firewalls if kind == "firewall" else self.instances
+        if not parent.startswith("projects/"):
+            return count, factory
+        if kind not in self._by_project:
+            by_project = {}
+            for i in range(count):
+                by_project.setdefault(self.project_of(kind, i), []).append(i)
+            self._by_project[kind] = by_project
+        matching = self._by_project[kind].get(int(parent.split("/")[1]), [])
+        return len(matching), lambda i: factory(matching[i])
+
+
+class FakePager:
+    """Mimics the ListAssetsPager, generating each page on demand and
+    fetching it through the caller's retry policy.
+    """
+
+    def __init__(self, client, count, factory, page_size, retry, start=0):
+        self.client = client
+        self.count = count
+        self.factory = factory
+        self.page_size = page_size
+        self.retry = retry
+        self.start = start
+
+    def _fetch(self, start):
+        with self.client.lock:
+            self.client.api_calls += 1
+            if self.client.rng.random() < self.client.error_rate:
+                self.client.errors += 1
+                raise exceptions.TooManyRequests("Quota exceeded (injected)")
+        end = min(start + self.page_size, self.count)
+        return SimpleNamespace(
+            assets=[self.factory(i) for i in range(start, end)],
+            next_page_token=str(end) if end < self.count else "",
+        )
+
+    @property
+    def pages(self):
+        fetch = self.retry(self._fetch) if self.retry else self._fetch
+        for start in range(self.start, max(self.count, 1), self.page_size):
+            yield fetch(start)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page.assets
+
+
+class FakeAssetServiceClient:
+    """Serves a FakeOrg through list_assets, failing each page fetch with a
+    429 with probability error_rate, and counting API calls and errors.
+    """
+
+    def __init__(self, org, error_rate=0.0, seed=0):
+        self.org = org
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.api_calls = 0
+        self.errors = 0
+
+    def list_assets(self, request, timeout=None, retry=None):
+        count, factory = self.org.assets(request["asset_types"][0], request["parent"])
+        # Page tokens are simply the offset of the page's first asset.
+        start = int(request.get("page_token") or 0)
+        return FakePager(self, count, factory, request["page_size"], retry, start)
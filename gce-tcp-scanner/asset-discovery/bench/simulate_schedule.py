@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Replays a scan-config.txt against N scanner workers and reports the
+makespan of publishing jobs in random order versus longest-first (LPT).
+
+Job durations come from scheduler.estimate_message_duration, optionally calibrated
+with a copy of the scan duration history port-scanner records to its
+--duration-history-blob, which asset-discovery reads from
+--duration-calibration-blob.
+
+Usage: python3 bench/simulate_schedule.py scan-config.txt [--workers 10]
+    [--max-unit-cost 1048560] [--calibration scan-durations.json] [--trials 20]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from incremental import parse_scan_config  # noqa: E402
+from planner import plan_work_units  # noqa: E402
+from scheduler import (  # noqa: E402
+    estimate_message_duration,
+    order_longest_first,
+    parse_calibration,
+    simulate_makespan,
+)
+from targets import with_job  # noqa: E402
+
+
+def hours(seconds):
+    return f"{seconds / 3600:8.2f}h"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scan_config")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--max-unit-cost", type=int, default=0)
+    parser.add_argument("--calibration", type=str)
+    parser.add_argument("--trials", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.scan_config) as f:
+        scan_config = parse_scan_config(f.read())
+    calibration = {}
+    if args.calibration:
+        with open(args.calibration) as f:
+            calibration = parse_calibration(json.load(f))
+
+    messages = [
+        unit
+        for record in scan_config
+        for unit in plan_work_units(with_job(record), args.max_unit_cost)
+    ]
+    durations = [estimate_message_duration(m, calibration) for m in messages]
+    rng = random.Random(0)
+    shuffled = []
+    for _ in range(args.trials):
+        rng.shuffle(durations)
+        shuffled.append(simulate_makespan(durations, args.workers))
+    lpt = simulate_makespan(
+        [
+            estimate_message_duration(m, calibration)
+            for m in order_longest_first(messages, calibration)
+        ],
+        args.workers,
+    )
+
+    print(f"jobs={len(messages)} workers={args.workers}")
+    print(f"total work:         {hours(sum(durations))}")
+    print(
+        f"lower bound:        {hours(max(sum(durations) / args.workers, max(durations)))}"
+    )
+    print(f"shuffle (mean):     {hours(sum(shuffled) / len(shuffled))}")
+    print(f"shuffle (worst):    {hours(max(shuffled))}")
+    print(f"lpt:                {hours(lpt)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+# Bump when the shape of a checkpoint or of the aggregates in it changes, so
+# checkpoints written by an older release are discarded instead of resumed.
+CHECKPOINT_VERSION = 2
+
+
+class ListingCheckpoint:
+    """Records, for each Asset API listing (keyed by asset type and parent),
+    the next page token and the aggregate its reducer has produced so far, so
+    a restarted run can resume each listing where it stopped instead of
+    paging through the organization again.
+
+    The checkpoint is kept in a local file at path, or in blob_name of
+    gcs_bucket (a google.cloud.storage Bucket), and is rewritten at most once
+    every interval seconds plus whenever a listing finishes. A checkpoint
+    written for a different run_id (e.g. another day or exposure model) is
+    ignored. Aggregates are pickled, so only point this at a location no one
+    else can write to.
+    """
+
+    def __init__(
+        self, run_id, path=None, gcs_bucket=None, blob_name=None, interval=60.0
+    ):
+        self.run_id = run_id
+        self.path = path
+        self.gcs_bucket = gcs_bucket
+        self.blob_name = blob_name
+        self.interval = interval
+        self._listings = {}
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+
+    def location(self):
+        if self.path:
+            return self.path
+        return f"gs://{self.gcs_bucket.name}/{self.blob_name}"
+
+    def load(self):
+        """Loads a previous checkpoint for this run, if there is one. Returns
+        the number of listings it has state for.
+        """
+        try:
+            if self.path:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+            else:
+                data = self.gcs_bucket.blob(self.blob_name).download_as_bytes()
+            state = pickle.loads(data)
+        except Exception as e:
+            print(f"No checkpoint loaded from {self.location()}: {e}")
+            return 0
+        if (
+            state.get("version") != CHECKPOINT_VERSION
+            or state.get("run") != self.run_id
+        ):
+            print(
+                f"Ignoring checkpoint at {self.location()} for run "
+                f"{state.get('run')!r}; this run is {self.run_id!r}."
+            )
+            return 0
+        self._listings = state["listings"]
+        done = sum(1 for listing in self._listings.values() if listing["done"])
+        print(
+            f"Resuming from checkpoint at {self.location()}: "
+            f"{done} of {len(self._listings)} checkpointed listings finished."
+        )
+        return len(self._listings)
+
+    def get(self, key):
+        """Returns the checkpointed state of a listing, which looks like
+        {"page_token": "...", "aggregate": <reducer output>, "done": False},
+        or None if it has none.
+        """
+        with self._lock:
+            return self._listings.get(key)
+
+    def due(self):
+        """Returns True if the checkpoint should be rewritten."""
+        return time.monotonic() - self._last_save >= self.interval
+
+    def update(self, key, page_token, aggregate, done=False):
+        """Records a listing's progress and rewrites the checkpoint if it is
+        due or the listing is done.
+        """
+        with self._lock:
+            self._listings[key] = {
+                "page_token": page_token,
+                "aggregate": aggregate,
+                "done": done,
+            }
+            if done or self.due():
+                self._save()
+
+    def discard(self, key):
+        """Forgets a listing's progress, e.g. when its page token expired."""
+        with self._lock:
+            self._listings.pop(key, None)
+
+    def _save(self):
+        data = pickle.dumps(
+            {
+                "version": CHECKPOINT_VERSION,
+                "run": self.run_id,
+                "listings": self._listings,
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        if self.path:
+            # Write then rename, so a kill mid-write leaves the old checkpoint.
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+                f.write(data)
+            os.replace(f.name, self.path)
+        else:
+            self.gcs_bucket.blob(self.blob_name).upload_from_string(
+                data, content_type="application/octet-stream"
+            )
+        self._last_save = time.monotonic()
+
+    def clear(self):
+        """Deletes the checkpoint once the run no longer needs it."""
+        with self._lock:
+            self._listings = {}
+            try:
+                if self.path:
+                    os.remove(self.path)
+                else:
+                    self.gcs_bucket.blob(self.blob_name).delete()
+            except Exception as e:
+                print(f"Could not delete checkpoint at {self.location()}: {e}")
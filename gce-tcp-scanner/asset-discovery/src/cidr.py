@@ -0,0 +1,116 @@
+# Address blocks that are never reachable from the public internet.
+NON_PUBLIC_RANGES = [
+    "0.0.0.0/8",  # "this" network
+    "10.0.0.0/8",  # RFC1918
+    "100.64.0.0/10",  # carrier-grade NAT
+    "127.0.0.0/8",  # loopback
+    "169.254.0.0/16",  # link-local
+    "172.16.0.0/12",  # RFC1918
+    "192.0.0.0/24",  # IETF protocol assignments
+    "192.168.0.0/16",  # RFC1918
+    "198.18.0.0/15",  # benchmarking
+    "224.0.0.0/4",  # multicast
+    "240.0.0.0/4",  # reserved and broadcast
+]
+# A rule's sources count as public if they cover at least this many public
+# addresses, i.e. as many as a /8.
+DEFAULT_MIN_PUBLIC_PREFIX = 8
+
+
+def parse_cidr(cidr):
+    """Parses an IPv4 address or CIDR and returns its inclusive (first, last)
+    integer interval, or None for IPv6 or unparseable values.
+    """
+    address, _, prefix = cidr.strip().partition("/")
+    octets = address.split(".")
+    try:
+        prefix = int(prefix) if prefix else 32
+        if len(octets) != 4 or not 0 <= prefix <= 32:
+            return None
+        value = 0
+        for octet in octets:
+            octet = int(octet)
+            if not 0 <= octet <= 255:
+                return None
+            value = value << 8 | octet
+    except ValueError:
+        return None
+    size = 1 << (32 - prefix)
+    first = value & ~(size - 1)
+    return (first, first + size - 1)
+
+
+def coalesce(intervals):
+    """Sorts and merges overlapping or adjacent inclusive intervals."""
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class PublicSpace:
+    """An index of public IPv4 address space as sorted integer intervals: the
+    whole IPv4 space minus NON_PUBLIC_RANGES and any excluded_ranges (e.g. our
+    own address blocks).
+
+    Firewall source ranges are classified against it by interval intersection,
+    with results cached per distinct set of source ranges, since many rules
+    share the same sources.
+    """
+
+    def __init__(self, excluded_ranges=(), min_public_prefix=DEFAULT_MIN_PUBLIC_PREFIX):
+        excluded = [
+            parse_cidr(c) for c in list(NON_PUBLIC_RANGES) + list(excluded_ranges)
+        ]
+        excluded = coalesce(e for e in excluded if e)
+        self.intervals = []
+        start = 0
+        for first, last in excluded:
+            if first > start:
+                self.intervals.append((start, first - 1))
+            start = max(start, last + 1)
+        if start <= 2**32 - 1:
+            self.intervals.append((start, 2**32 - 1))
+        self.size = sum(last - first + 1 for first, last in self.intervals)
+        self.min_public_addresses = min(self.size, 2 ** (32 - min_public_prefix))
+        self._cache = {}
+
+    def coverage(self, source_ranges):
+        """Returns how many public addresses the given CIDRs cover."""
+        key = tuple(source_ranges)
+        if key not in self._cache:
+            sources = coalesce(s for s in map(parse_cidr, source_ranges) if s)
+            covered = 0
+            i = 0
+            for first, last in sources:
+                while i < len(self.intervals) and self.intervals[i][1] < first:
+                    i += 1
+                j = i
+                while j < len(self.intervals) and self.intervals[j][0] <= last:
+                    covered += (
+                        min(last, self.intervals[j][1])
+                        - max(first, self.intervals[j][0])
+                        + 1
+                    )
+                    j += 1
+            self._cache[key] = covered
+        return self._cache[key]
+
+    def is_public_source(self, source_ranges):
+        """Returns True if the CIDRs cover a wide enough block of the public
+        internet to treat a rule allowing them as internet-exposed.
+        """
+        return self.coverage(source_ranges) >= self.min_public_addresses
+
+    def covers_internet(self, source_ranges):
+        """Returns True if the CIDRs cover all of public internet space, e.g.
+        0.0.0.0/0 or 0.0.0.0/1 plus 128.0.0.0/1.
+        """
+        return self.coverage(source_ranges) == self.size
+
+
+DEFAULT_PUBLIC_SPACE = PublicSpace()
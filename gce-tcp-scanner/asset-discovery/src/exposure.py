@@ -0,0 +1,242 @@
+from cidr import DEFAULT_PUBLIC_SPACE
+from ports import MAX_PORT, MIN_PORT, PortSet
+from targets import int_to_ip, ip_to_int, network_key, with_job, with_started
+
+# GCP's default firewall rule priority when none is set.
+DEFAULT_PRIORITY = 1000
+# The IPProtocol values of firewall entries that cover TCP. Port scans are
+# TCP only, so entries for other protocols (udp, icmp, esp, sctp, ...) neither
+# expose nor block anything that is scanned.
+TCP_PROTOCOLS = ("tcp", "all", "6")
+
+
+class FirewallRule:
+    """The parts of an ingress firewall rule that decide which instances and
+    ports it exposes to (or blocks from) the internet.
+    """
+
+    __slots__ = ("name", "priority", "deny", "ports", "target_tags", "target_sas")
+
+    def __init__(self, name, priority, deny, ports, target_tags, target_sas):
+        self.name = name
+        self.priority = priority
+        self.deny = deny
+        self.ports = ports
+        self.target_tags = target_tags
+        self.target_sas = target_sas
+
+    def sort_key(self):
+        # Lower priority numbers win, and DENY wins over ALLOW at equal priority.
+        return (self.priority, 0 if self.deny else 1, self.name)
+
+
+def rule_ports(entries):
+    """Returns the TCP PortSet covered by a firewall rule's "allowed" or
+    "denied" entries. Entries for other protocols are ignored; a TCP entry
+    without ports covers every port.
+    """
+    ports = PortSet()
+    for entry in entries:
+        if str(entry["IPProtocol"]).lower() not in TCP_PROTOCOLS:
+            continue
+        if "ports" in entry:
+            ports.update(entry["ports"])
+        else:
+            ports.add_range(MIN_PORT, MAX_PORT)
+    return ports
+
+
+class FirewallIndex:
+    """Ingress firewall rules that match internet traffic, indexed by network
+    and then by target tag and target service account, so the rules that apply
+    to an instance can be looked up without scanning every rule. Networks are
+    compared by targets.network_key, so a shared VPC host project's rules
+    apply to service project instances however their network URL is spelled.
+
+    ALLOW rules are indexed if their sources cover a wide public block, and
+    DENY rules only if their sources cover the whole public internet, as
+    classified by public_space (a cidr.PublicSpace).
+    """
+
+    def __init__(self, public_space=None):
+        self.public_space = public_space or DEFAULT_PUBLIC_SPACE
+        self._networks = {}
+        self._cache = {}
+
+    def add(self, firewall):
+        """Indexes a Firewall asset if it is an enabled ingress rule matching
+        internet traffic. Returns True if it was indexed.
+        """
+        data = firewall.resource.data
+        if data.get("disabled", False):
+            return False
+        if data.get("direction", "INGRESS") == "EGRESS":
+            return False
+        deny = "denied" in data
+        source_ranges = data.get("sourceRanges", [])
+        if deny and not self.public_space.covers_internet(source_ranges):
+            return False
+        if not deny and not self.public_space.is_public_source(source_ranges):
+            return False
+        ports = rule_ports(data["denied"] if deny else data.get("allowed", []))
+        if not ports:
+            return False
+        rule = FirewallRule(
+            name=firewall.name,
+            priority=int(data.get("priority", DEFAULT_PRIORITY)),
+            deny=deny,
+            ports=ports,
+            target_tags=tuple(data.get("targetTags", ())),
+            target_sas=tuple(data.get("targetServiceAccounts", ())),
+        )
+        self._add_rule(network_key(data["network"]), rule)
+        return True
+
+    def _add_rule(self, key, rule):
+        rules = self._networks.setdefault(
+            key, {"all": [], "tags": {}, "service_accounts": {}}
+        )
+        if rule.target_tags:
+            for tag in rule.target_tags:
+                rules["tags"].setdefault(tag, []).append(rule)
+        elif rule.target_sas:
+            for sa in rule.target_sas:
+                rules["service_accounts"].setdefault(sa, []).append(rule)
+        else:
+            rules["all"].append(rule)
+        self._cache = {}
+
+    def merge(self, other):
+        """Adds every rule from another FirewallIndex to this one."""
+        for key, rules in other._networks.items():
+            seen = set()
+            for rule in rules["all"]:
+                self._add_rule(key, rule)
+            for by_target in (rules["tags"], rules["service_accounts"]):
+                for target_rules in by_target.values():
+                    for rule in target_rules:
+                        if id(rule) not in seen:
+                            seen.add(id(rule))
+                            self._add_rule(key, rule)
+        return self
+
+    def rules_for(self, network, tags=(), service_accounts=()):
+        """Returns the rules applying to an instance with the given tags and
+        service accounts, in evaluation order.
+        """
+        rules = self._networks.get(network_key(network))
+        if not rules:
+            return []
+        applicable = {id(r): r for r in rules["all"]}
+        for tag in tags:
+            applicable.update((id(r), r) for r in rules["tags"].get(tag, ()))
+        for sa in service_accounts:
+            applicable.update((id(r), r) for r in rules["service_accounts"].get(sa, ()))
+        return sorted(applicable.values(), key=FirewallRule.sort_key)
+
+    def exposed_ports(self, network, tags=(), service_accounts=()):
+        """Returns the PortSet an instance with the given tags and service
+        accounts exposes to the internet, evaluating its rules in priority
+        order so each port is decided by the first rule that matches it.
+        """
+        key = (network_key(network), frozenset(tags), frozenset(service_accounts))
+        if key not in self._cache:
+            allowed = PortSet()
+            decided = PortSet()
+            for rule in self.rules_for(network, tags, service_accounts):
+                undecided = rule.ports.difference(decided)
+                if not undecided:
+                    continue
+                if not rule.deny:
+                    allowed.union(undecided)
+                decided.union(undecided)
+            self._cache[key] = allowed
+        return self._cache[key]
+
+
+def build_firewall_index(firewalls, public_space=None):
+    """Takes an iterable of Firewall assets and returns a FirewallIndex."""
+    index = FirewallIndex(public_space)
+    for firewall in firewalls:
+        index.add(firewall)
+    return index
+
+
+def merge_firewall_indexes(indexes, public_space=None):
+    """Merges several FirewallIndexes, in order, into one."""
+    merged = FirewallIndex(public_space)
+    for index in indexes:
+        merged.merge(index)
+    return merged
+
+
+def get_instance_targets(instances):
+    """Takes an iterable of GCE instances and returns a compact list of
+    (network, NAT IP, tags, service accounts, lastStartTimestamp) tuples, one
+    per external IP.
+    """
+    targets = []
+    for instance in instances:
+        data = instance.resource.data
+        tags = tuple(data.get("tags", {}).get("items", ()))
+        service_accounts = tuple(sa["email"] for sa in data.get("serviceAccounts", ()))
+        started = data.get("lastStartTimestamp")
+        for ni in data.get("networkInterfaces", ()):
+            for ac in ni.get("accessConfigs", ()):
+                if "natIP" in ac:
+                    targets.append(
+                        (ni["network"], ac["natIP"], tags, service_accounts, started)
+                    )
+    return targets
+
+
+def merge_instance_targets(targets_list):
+    """Merges several get_instance_targets outputs, in order, into one."""
+    return [t for targets in targets_list for t in targets]
+
+
+def get_exposure_messages(index, instance_targets):
+    """Evaluates the firewall rules that apply to each instance target and
+    returns scan messages grouping the IPs of each network that expose the
+    same ports, each with its own "job" id. An IP listed by several targets is
+    scanned once, on the union of their ports, under the first target's
+    network. Targets exposing no ports are left out.
+
+    The output looks like:
+    [
+        {"network": "projects/123456789/global/networks/default", "ips": ["1.2.3.4"], "ports": ["22", "443"], "started": {"1.2.3.4": "2024-01-01T00:00:00.000-08:00"}, "job": "3f2a9c1e0b7d"}, # pragma: allowlist secret
+        {"network": "projects/123456789/global/networks/default", "ips": ["4.4.4.4"], "ports": ["1-65535"], "job": "a81c04d9e2f6"}, # pragma: allowlist secret
+    ]
+    """  # noqa
+    exposed = {}
+    started_at = {}
+    for network, ip, tags, service_accounts, started in instance_targets:
+        ports = index.exposed_ports(network, tags, service_accounts)
+        if not ports:
+            continue
+        value = ip_to_int(ip)
+        if started:
+            started_at[value] = started
+        if value in exposed:
+            merged = PortSet()
+            merged.union(exposed[value][1])
+            merged.union(ports)
+            exposed[value] = (exposed[value][0], merged)
+        else:
+            exposed[value] = (network, ports)
+    groups = {}
+    for value, (network, ports) in exposed.items():
+        groups.setdefault((network, tuple(ports.to_list())), []).append(value)
+    return [
+        with_job(
+            with_started(
+                {
+                    "network": network,
+                    "ips": [int_to_ip(v) for v in values],
+                    "ports": list(ports),
+                },
+                {int_to_ip(v): started_at[v] for v in values if v in started_at},
+            )
+        )
+        for (network, ports), values in groups.items()
+    ]
@@ -0,0 +1,77 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import google.auth
+from google.auth import impersonated_credentials
+from google.auth.transport.requests import Request
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+CREDENTIALS_LIFETIME_SECONDS = 3600
+# Impersonated credentials are refreshed this long before they expire, by
+# the first caller to notice, rather than by every request that finds the
+# token expired at once.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+_clients = {}
+_credentials = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(key):
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def get_client(key, factory):
+    """Returns the client shared by the whole process under key, e.g.
+    ("asset", "scanner@my-project.iam.gserviceaccount.com"), calling
+    factory() to create it on first use.
+
+    Google Cloud clients are thread-safe and keep their connections and
+    tokens, so sharing one avoids a TLS handshake and token request per
+    operation. Concurrent first calls for the same key create one client.
+    """
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock(key):
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def _expiring(credentials):
+    if not credentials.token or credentials.expiry is None:
+        return True
+    # google-auth keeps expiry as a naive UTC datetime.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return credentials.expiry - now < REFRESH_MARGIN
+
+
+def get_credentials(target_acct=None):
+    """Returns credentials impersonating the service account target_acct,
+    or None (i.e. the default credentials) if it isn't given.
+
+    Each account's credentials are created once per process and refreshed
+    when they are within REFRESH_MARGIN of expiring, so clients created
+    with them (see get_client) keep working past the token's lifetime.
+    Impersonation requires the "Service Account Token Creator" role on
+    target_acct.
+    """
+    if not target_acct:
+        return None
+    with _lock(("credentials", target_acct)):
+        credentials = _credentials.get(target_acct)
+        if credentials is None:
+            source_credentials, _ = google.auth.default(scopes=SCOPES)
+            credentials = impersonated_credentials.Credentials(
+                source_credentials=source_credentials,
+                target_principal=target_acct,
+                target_scopes=SCOPES,
+                lifetime=CREDENTIALS_LIFETIME_SECONDS,
+            )
+            _credentials[target_acct] = credentials
+        if _expiring(credentials):
+            credentials.refresh(Request())
+        return credentials
@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+from ports import PortSet
+from scanconfig import NDJSON_BLOB, iter_scan_config
+from targets import network_key, with_job, with_started
+
+SCAN_CONFIG_BLOB = "{date}/scan-config.txt"
+
+
+def parse_scan_config(text):
+    """Parses a scan-config.txt written by asset-discovery back into a list
+    of scan records, one per line. A network may appear on several lines when
+    its IPs expose different ports.
+
+    The output looks like:
+    [
+        {
+            "network": "projects/123456789/global/networks/default", # pragma: allowlist secret
+            "ips": ["1.2.3.4", "4.4.4.4"],
+            "ports": ["1-122", "49", "8000-9000"]
+        }
+    ]
+    """
+    scan_config = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        network, ips, ports = line.split("|")
+        scan_config.append(
+            {
+                "network": network,
+                "ips": ips.split(),
+                "ports": [p for p in ports.split(",") if p],
+            }
+        )
+    return scan_config
+
+
+def load_previous_scan_config(
+    storage_client, bucket, today, max_days_back=7, gcs_bucket=None
+):
+    """Returns the date and parsed contents of the most recent scan config
+    written before today, looking back at most max_days_back days. Returns
+    (None, None) if none is found.
+
+    If gcs_bucket (a google.cloud.storage Bucket) is given, the compressed
+    NDJSON scan config is tried before the text one for each day.
+    """
+    for days_back in range(1, max_days_back + 1):
+        day = today - timedelta(days=days_back)
+        if gcs_bucket is not None:
+            blob = NDJSON_BLOB.format(date=day.isoformat())
+            try:
+                scan_config = list(iter_scan_config(gcs_bucket, blob))
+            except Exception as e:
+                print(f"No previous scan config at gs://{bucket}/{blob}: {e}")
+            else:
+                print(f"Loaded previous scan config from gs://{bucket}/{blob}")
+                return day, scan_config
+        blob = SCAN_CONFIG_BLOB.format(date=day.isoformat())
+        try:
+            text = storage_client.read_gcs(bucket, blob)
+        except Exception as e:
+            print(f"No previous scan config at gs://{bucket}/{blob}: {e}")
+            continue
+        print(f"Loaded previous scan config from gs://{bucket}/{blob}")
+        return day, parse_scan_config(text)
+    return None, None
+
+
+def is_full_sweep_day(today, full_sweep_interval_days):
+    """Returns True if today's run should scan every target regardless of
+    what changed since the previous run.
+    """
+    if full_sweep_interval_days <= 1:
+        return True
+    return today.toordinal() % full_sweep_interval_days == 0
+
+
+def diff_scan_messages(previous, scan_messages):
+    """Compares today's scan messages against the previous scan config and
+    returns only the work that is new since then, plus the targets that are
+    no longer present.
+
+    Each IP is compared against the ports it had in the same network before,
+    matching networks by network_key so differently formed URLs agree:
+    IPs not seen before are scanned on all of their open ports, and IPs seen
+    before are scanned only on newly opened ports. IPs needing the same ports
+    are grouped into one message per network, keeping their "started"
+    timestamps. A network can get several messages (e.g. new IPs on all their
+    ports and known IPs on newly opened ones), so each gets its own "job" id.
+
+    The output looks like:
+    (
+        [
+            {"network": "...", "ips": ["1.2.3.4"], "ports": ["1-122"], "job": "3f2a9c1e0b7d"},
+            {"network": "...", "ips": ["4.4.4.4"], "ports": ["8000-9000"], "job": "a81c04d9e2f6"},
+        ],
+        {"projects/987654321/global/networks/default": ["4.3.2.1"]}, # pragma: allowlist secret
+    )
+    """  # noqa
+    previous_ports = {}
+    previous_names = {}
+    for record in previous:
+        network = network_key(record["network"])
+        previous_names.setdefault(network, record["network"])
+        for ip in record["ips"]:
+            previous_ports.setdefault((network, ip), PortSet()).update(record["ports"])
+
+    groups = {}
+    current = set()
+    started = {}
+    for message in scan_messages:
+        started.update(message.get("started", {}))
+        network = network_key(message["network"])
+        ports = PortSet(message["ports"])
+        for ip in message["ips"]:
+            current.add((network, ip))
+            seen = previous_ports.get((network, ip))
+            new_ports = ports.difference(seen) if seen is not None else ports
+            if new_ports:
+                key = (message["network"], tuple(new_ports.to_list()))
+                groups.setdefault(key, []).append(ip)
+    delta_messages = [
+        with_job(
+            with_started(
+                {"network": network, "ips": ips, "ports": list(ports)}, started
+            )
+        )
+        for (network, ports), ips in groups.items()
+    ]
+
+    removed = {}
+    for network, ip in previous_ports:
+        if (network, ip) not in current:
+            removed.setdefault(previous_names[network], []).append(ip)
+    return delta_messages, removed
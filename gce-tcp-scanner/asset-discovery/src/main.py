@@ -3,18 +3,42 @@ import argparse
 import re
 import sys
 import os
-from copy import deepcopy
 from random import shuffle
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import tempfile
 from datetime import date
 
-from bibt.gcp import iam
 from bibt.gcp import storage
 from google.api_core import exceptions
 from google.api_core.retry import Retry
 from google.cloud import asset_v1
-from bibt.gcp import pubsub
+from google.cloud import storage as google_storage
+from gcpclients import get_client, get_credentials
+
+from ports import MAX_PORT, MIN_PORT, PortSet
+from cidr import DEFAULT_MIN_PUBLIC_PREFIX, DEFAULT_PUBLIC_SPACE, PublicSpace
+from ratelimit import get_limiter, get_stats
+from publisher import ScanPublisher
+from planner import plan_work_units
+from scheduler import load_calibration, order_longest_first
+from scancost import DEFAULT_JOB_DEADLINE_HOURS, DEFAULT_PROFILES, load_profiles
+from scanconfig import NDJSON_BLOB, write_scan_config_ndjson
+from exposure import (
+    build_firewall_index,
+    get_exposure_messages,
+    get_instance_targets,
+    merge_firewall_indexes,
+    merge_instance_targets,
+)
+from checkpoint import ListingCheckpoint
+from targets import build_target_index, merge_target_indexes
+from incremental import (
+    SCAN_CONFIG_BLOB,
+    diff_scan_messages,
+    is_full_sweep_day,
+    load_previous_scan_config,
+)
 
 _RETRYABLE = [
     exceptions.TooManyRequests,
@@ -28,72 +52,269 @@ _RETRYABLE = [
 
 def is_retryable(exc):
     print(f"Checking exception for retryable: {type(exc).__name__}")
-    return isinstance(exc, _RETRYABLE)
+    return isinstance(exc, tuple(_RETRYABLE))
 
 
+# Requests are paced by the Asset API rate limiter, so a 429 here is the
+# exception rather than the rule and does not warrant minutes of backoff.
 retry_policy = Retry(
-    predicate=is_retryable, initial=60.0, maximum=600.0, multiplier=1.5, timeout=43200.0
+    predicate=is_retryable, initial=5.0, maximum=120.0, multiplier=2.0, timeout=43200.0
 )
 
+ASSET_API_RPM = 90
+# 16 IPs on every port.
+DEFAULT_MAX_UNIT_COST = 16 * 65535
 
-def get_resources(type, org_id, asset_api_serv_acct=None):
-    """For the given organization, pulls all resources of the given type."""
-    if asset_api_serv_acct:
-        iam_client = iam.Client()
-        creds = iam_client.get_credentials(target_acct=asset_api_serv_acct)
-        client = asset_v1.AssetServiceClient(credentials=creds)
-    else:
-        client = asset_v1.AssetServiceClient()
+
+def get_asset_client(asset_api_serv_acct=None):
+    """Returns the process's AssetServiceClient, impersonating
+    asset_api_serv_acct if given.
+    """
+    creds = get_credentials(asset_api_serv_acct)
+    return get_client(
+        ("asset", asset_api_serv_acct),
+        lambda: asset_v1.AssetServiceClient(credentials=creds),
+    )
+
+
+def get_asset_limiter(asset_api_serv_acct=None, requests_per_minute=ASSET_API_RPM):
+    """Returns the rate limiter shared by all Asset API calls made with the
+    given credential. requests_per_minute only applies to the first call,
+    which creates the limiter; main() makes that call with --asset-api-rpm
+    before anything is listed.
+    """
+    return get_limiter(
+        "cloudasset.googleapis.com", asset_api_serv_acct, requests_per_minute
+    )
+
+
+def iter_resource_pages(
+    type, org_id, asset_api_serv_acct=None, client=None, parent=None, page_token=None
+):
+    """For the given organization, yields (assets, next page token) for each
+    page of resources of the given type, starting from page_token if given.
+    The last page's next page token is empty.
+
+    If parent is given (e.g. "projects/123456789"), only resources under it are
+    listed. An existing client may be passed in to be shared across calls.
+    Every page request is paced by the Asset API rate limiter.
+    """
+    if not client:
+        client = get_asset_client(asset_api_serv_acct)
+    limiter = get_asset_limiter(asset_api_serv_acct)
     pagesize = 250
+    request = {
+        # "parent": f"projects/bits-bt-aim-prod",
+        "parent": parent or f"organizations/{org_id}",
+        "asset_types": [f"compute.googleapis.com/{type}"],
+        "content_type": "RESOURCE",
+        "page_size": pagesize,
+    }
+    if page_token:
+        request["page_token"] = page_token
+    limiter.acquire()
+    response = client.list_assets(request=request, timeout=300.0, retry=retry_policy)
+
+    for page in response.pages:
+        yield page.assets, page.next_page_token
+        # The next page, if any, is fetched when the loop advances.
+        if page.next_page_token:
+            limiter.acquire()
+
+
+def iter_resources(type, org_id, asset_api_serv_acct=None, client=None, parent=None):
+    """For the given organization, yields all resources of the given type one
+    page at a time, so callers can reduce them without holding every asset in
+    memory.
+    """
+    for assets, _ in iter_resource_pages(
+        type, org_id, asset_api_serv_acct, client, parent
+    ):
+        yield from assets
+        # firewalls.append(json.loads(resource.__class__.to_json(resource)))
+        # gce_ips.extend(resource.additional_attributes.get("externalIPs", []))
+
+
+def reduce_resources(
+    type,
+    org_id,
+    reducer,
+    asset_api_serv_acct=None,
+    client=None,
+    parent=None,
+    merger=None,
+    checkpoint=None,
+):
+    """Lists all resources of the given type and returns reducer applied to
+    them.
+
+    With a checkpoint (a checkpoint.ListingCheckpoint), reducer is instead
+    applied to each page, and merger (which takes a list of reducer outputs and
+    merges them in order) folds the results into an aggregate that is
+    checkpointed along with the next page token. A listing that was already
+    finished is returned from the checkpoint without listing it again, and one
+    that was interrupted resumes from its next page.
+    """
+    if checkpoint is None:
+        return reducer(
+            iter_resources(type, org_id, asset_api_serv_acct, client, parent)
+        )
+
+    if merger is None:
+        raise ValueError(f"Checkpointed listings of {type} need a merger.")
+    key = f"{type}|{parent or f'organizations/{org_id}'}"
+    state = checkpoint.get(key)
+    if state and state["done"]:
+        return state["aggregate"]
+    aggregate = state["aggregate"] if state else None
+    page_token = state["page_token"] if state else None
+    if page_token:
+        print(f"Resuming listing of {key} from a checkpointed page token.")
+
+    def fold(aggregate, partials):
+        return merger(([] if aggregate is None else [aggregate]) + partials)
+
+    partials = []
+    try:
+        for assets, next_page_token in iter_resource_pages(
+            type, org_id, asset_api_serv_acct, client, parent, page_token
+        ):
+            partials.append(reducer(assets))
+            if next_page_token and checkpoint.due():
+                aggregate = fold(aggregate, partials)
+                partials = []
+                checkpoint.update(key, next_page_token, aggregate)
+    except exceptions.InvalidArgument as e:
+        if not page_token:
+            raise
+        # Page tokens expire; start this listing over rather than fail the run.
+        print(f"WARNING: Checkpointed page token for {key} was rejected: {e}")
+        checkpoint.discard(key)
+        return reduce_resources(
+            type,
+            org_id,
+            reducer,
+            asset_api_serv_acct,
+            client,
+            parent,
+            merger,
+            checkpoint,
+        )
+    aggregate = fold(aggregate, partials)
+    checkpoint.update(key, "", aggregate, done=True)
+    return aggregate
+
+
+def get_resources(type, org_id, asset_api_serv_acct=None, client=None, parent=None):
+    """For the given organization, pulls all resources of the given type into a
+    list.
+    """
+    return list(iter_resources(type, org_id, asset_api_serv_acct, client, parent))
+
+
+def get_project_shards(org_id, client, asset_api_serv_acct=None):
+    """Lists every project in the organization and returns a sorted list of
+    "projects/<number>" parents to shard Asset API listing across.
+    """
+    limiter = get_asset_limiter(asset_api_serv_acct)
+    limiter.acquire()
     response = client.list_assets(
         request={
-            # "parent": f"projects/bits-bt-aim-prod",
             "parent": f"organizations/{org_id}",
-            "asset_types": [f"compute.googleapis.com/{type}"],
+            "asset_types": ["cloudresourcemanager.googleapis.com/Project"],
             "content_type": "RESOURCE",
-            "page_size": pagesize,
+            "page_size": 1000,
         },
         timeout=300.0,
         retry=retry_policy,
     )
-
-    resources = []
-    c = 1
-    for resource in response:
-        resources.append(resource)
-        c += 1
-        if c % (pagesize * 90) == 0:
-            sleep(61)
-        # firewalls.append(json.loads(resource.__class__.to_json(resource)))
-        # gce_ips.extend(resource.additional_attributes.get("externalIPs", []))
-
-    return resources
-
-
-def get_instance_network_configs(instances):
-    """Takes a list of GCE instances and returns a dictionary of networks and
-    lists of NAT IPs that belong to them.
+    shards = set()
+    for page in response.pages:
+        for project in page.assets:
+            if project.resource.data.get("lifecycleState", "ACTIVE") != "ACTIVE":
+                continue
+            shards.add(f"projects/{project.resource.data['projectNumber']}")
+        # The next page, if any, is fetched when the loop advances.
+        if page.next_page_token:
+            limiter.acquire()
+    return sorted(shards)
+
+
+def get_resources_concurrent(
+    types,
+    org_id,
+    asset_api_serv_acct=None,
+    shard_by=None,
+    max_workers=4,
+    client=None,
+    reducers=None,
+    mergers=None,
+    checkpoint=None,
+):
+    """Pulls all resources of each of the given types concurrently.
+
+    Each asset type is listed on its own worker. If shard_by is "project", the
+    organization is additionally split into one listing per project. At most
+    max_workers listings run at once, and a single client is shared by all of
+    them.
+
+    reducers optionally maps an asset type to a function that is applied to
+    the stream of resources of each shard as it is listed (e.g.
+    get_open_networks), so raw assets are never held in memory. Without a
+    reducer, a shard's resources are collected into a list. Shard results are
+    returned in shard order so output does not depend on which listing
+    finishes first.
+
+    With a checkpoint, each shard's listing is checkpointed and resumed as
+    described in reduce_resources, folding pages with the asset type's merger
+    from mergers. A ValueError is raised before anything is listed if a type
+    has no merger.
 
     The output looks like:
     {
-        "projects/123456789/networks/default": [ # pragma: allowlist secret
-            "1.2.3.4",
-            "4.3.2.1"
-        ]
+        "Firewall": [<shard 1 result>, <shard 2 result>, ...],
+        "Instance": [<shard 1 result>, <shard 2 result>, ...]
     }
     """
-    network_configs = {}
-    for instance in instances:
-        for ni in instance.resource.data["networkInterfaces"]:
-            if "accessConfigs" not in ni:
-                continue
-            for ac in ni["accessConfigs"]:
-                if "natIP" in ac:
-                    if ni["network"] in network_configs:
-                        network_configs[ni["network"]].append(ac["natIP"])
-                    else:
-                        network_configs[ni["network"]] = [ac["natIP"]]
-    return network_configs
+    reducers = reducers or {}
+    mergers = mergers or {}
+    if checkpoint is not None:
+        unmerged = [type for type in types if type not in mergers]
+        if unmerged:
+            raise ValueError(f"No merger for checkpointed asset types: {unmerged}")
+    if not client:
+        client = get_asset_client(asset_api_serv_acct)
+
+    def list_shard(type, parent):
+        return reduce_resources(
+            type,
+            org_id,
+            reducers.get(type, list),
+            asset_api_serv_acct,
+            client,
+            parent,
+            merger=mergers.get(type),
+            checkpoint=checkpoint,
+        )
+
+    if shard_by == "project":
+        parents = get_project_shards(org_id, client, asset_api_serv_acct)
+        print(f"Sharding asset listing across {len(parents)} projects.")
+    elif shard_by:
+        raise ValueError(f"Unsupported shard type: {shard_by}")
+    else:
+        parents = [f"organizations/{org_id}"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            (type, parent): executor.submit(list_shard, type, parent)
+            for type in types
+            for parent in parents
+        }
+        return {
+            type: [futures[(type, parent)].result() for parent in parents]
+            for type in types
+        }
 
 
 def merge_ports(ports_list, port):
@@ -103,72 +324,16 @@ def merge_ports(ports_list, port):
     The output looks like:
     ["1-444", "447", "450-65535"]
     """
-    merged_ports = []
-    if "-" in port:
-        p1, p2 = port.split("-")
-        p_low = min(int(p1), int(p2))
-        p_high = max(int(p1), int(p2))
-        added_range = False
-        for _p in ports_list:
-            if "-" in _p:  # we're comparing 2 ranges
-                _p1, _p2 = _p.split("-")
-                _p_low = min(int(_p1), int(_p2))
-                _p_high = max(int(_p1), int(_p2))
-                # no overlap
-                #  p        |-------|
-                # _p   |--|
-                if int(p_low) > int(_p_high) or int(p_high) < int(_p_low):
-                    merged_ports.append(_p)
-                # overlap pattern 1    overlap pattern 2
-                #  p       |-----|      p       |--|
-                # _p    |-----|        _p     |-----|
-                elif int(p_low) >= int(_p_low) and int(p_low) <= int(_p_high):
-                    if int(p_high) <= int(_p_high):
-                        # print(f"port range ({port}) is contained within
-                        # existing range ({_p}). returning.")
-                        return sorted(deepcopy(ports_list))  # p2
-                    else:
-                        merged_ports.append(f"{_p_low}-{p_high}")  # p1
-                        added_range = True
-                # overlap pattern 3    overlap pattern 4
-                #  p   |-----|          p    |-----|
-                # _p      |-----|      _p     |---|
-                elif int(_p_low) >= int(p_low) and int(_p_low) <= int(p_high):
-                    if int(_p_high) >= int(p_high):
-                        merged_ports.append(f"{p_low}-{_p_high}")  # p3
-                        added_range = True
-            else:  # we're comparing a range with a port
-                if not (int(_p) >= int(p_low) and int(_p) <= int(p_high)):
-                    merged_ports.append(_p)
-
-        if not added_range:
-            # print(f"adding port ({port}) to list.")
-            merged_ports.append(port)
-
-    else:
-        for _p in ports_list:
-            if "-" in _p:  # we're comparing a port with a range
-                _p1, _p2 = _p.split("-")
-                _p_low = min(int(_p1), int(_p2))
-                _p_high = max(int(_p1), int(_p2))
-                if int(port) >= int(_p_low) and int(port) <= int(_p_high):
-                    # print(f"port ({port}) is in the range ({_p}), returning")
-                    return sorted(deepcopy(ports_list))
-                merged_ports.append(_p)
-            else:
-                if int(_p) == int(port):  # we're comparing 2 ports
-                    # print(f"port ({port}) already present, returning.")
-                    return sorted(deepcopy(ports_list))
-                merged_ports.append(_p)
-        # print(f"adding port ({port}) to list.")
-        merged_ports.append(port)
-
-    return sorted(merged_ports)
+    port_set = PortSet(ports_list)
+    port_set.add(port)
+    return port_set.to_list()
 
 
-def get_open_networks(firewalls):
+def get_open_networks(firewalls, public_space=None):
     """Iterates through all firewalls in a GCP organization and returns
-    a dictionary of those which permit (non-ICMP) ingress traffic from 0.0.0.0/0.
+    a dictionary of those which permit (non-ICMP) ingress traffic from the
+    public internet, i.e. whose source ranges cover a wide enough block of
+    public_space (a cidr.PublicSpace).
 
     The output looks like:
     {
@@ -177,7 +342,8 @@ def get_open_networks(firewalls):
         ...
     }
     """  # noqa
-    network_configs = {}
+    public_space = public_space or DEFAULT_PUBLIC_SPACE
+    network_ports = {}
     for firewall in firewalls:
         if firewall.resource.data.get("disabled", False):
             continue
@@ -187,12 +353,13 @@ def get_open_networks(firewalls):
             continue
         if "sourceRanges" not in firewall.resource.data:
             continue
-        if "0.0.0.0/0" not in firewall.resource.data["sourceRanges"]:
+        if not public_space.is_public_source(firewall.resource.data["sourceRanges"]):
             continue
 
         network = firewall.resource.data["network"]
-        if network not in network_configs:
-            network_configs[network] = []
+        if network not in network_ports:
+            network_ports[network] = PortSet()
+        port_set = network_ports[network]
         for a in firewall.resource.data["allowed"]:
             if a["IPProtocol"] == "icmp":
                 continue
@@ -202,101 +369,293 @@ def get_open_networks(firewalls):
                     f'{firewall.resource.data["id"]},'
                     f'{firewall.resource.data.get("targetTags")},{dict(a)}'
                 )
-                network_configs[network] = ["1-65535"]
+                port_set.add_range(MIN_PORT, MAX_PORT)
                 break
             elif "ports" in a:
-                for port in a["ports"]:
-                    network_configs[network] = merge_ports(
-                        network_configs[network], str(port)
-                    )
+                port_set.update(a["ports"])
             else:
-                for port in a["IPProtocol"].split(","):
-                    network_configs[network] = merge_ports(
-                        network_configs[network], port
-                    )
-    return network_configs
+                port_set.update(a["IPProtocol"].split(","))
+    return {network: ports.to_list() for network, ports in network_ports.items()}
 
 
-def main(config):
-    bucket = config["gcs-bucket"]
+def merge_open_networks(open_networks_list):
+    """Merges several get_open_networks outputs into one, unioning the port
+    ranges of networks that appear in more than one.
+    """
+    network_ports = {}
+    for open_networks in open_networks_list:
+        for network, ports in open_networks.items():
+            network_ports.setdefault(network, PortSet()).update(ports)
+    return {network: ports.to_list() for network, ports in network_ports.items()}
+
+
+def get_network_scan_messages(config, public_space=None, checkpoint=None):
+    """Lists all firewalls and GCE instances and returns scan messages covering
+    every NAT IP on every port opened to the public internet by any firewall
+    rule of the networks it is reachable on: any rule whose source ranges
+    cover as many public addresses as a CIDR of the min-public-source-prefix
+    length (see cidr.PublicSpace). Each IP is listed once, even if it appears
+    on several NICs or networks.
+    """
     org_id = config["gcp-org-id"]
-    pubsub_topic_uri = config["pubsub-topic-uri"]
     asset_api_serv_acct = config["asset-api-serv-acct"]
 
-    print("Getting all firewalls...")
+    # Assets are streamed through the reducers below as they are listed, so only
+    # the per-network results are held in memory.
     # Format:
     # open_networks_dict = {
     #     "projects/123456789/global/networks/default": ["1-122","49","8000-9000"],  # pragma: allowlist secret # noqa
     #     "projects/987654321/global/networks/default": ["1-65535"],  # pragma: allowlist secret # noqa
     # }
-    firewalls = get_resources("Firewall", org_id, asset_api_serv_acct)
-    open_networks_dict = get_open_networks(firewalls)
+    # NAT IPs are collected into a targets.TargetIndex keyed by network.
+    if config["concurrent-listing"]:
+        print("Getting all firewalls and GCE instances concurrently...")
+        reduced = get_resources_concurrent(
+            ["Firewall", "Instance"],
+            org_id,
+            asset_api_serv_acct,
+            shard_by=config["shard-by"],
+            max_workers=config["max-workers"],
+            reducers={
+                "Firewall": partial(get_open_networks, public_space=public_space),
+                "Instance": build_target_index,
+            },
+            mergers={
+                "Firewall": merge_open_networks,
+                "Instance": merge_target_indexes,
+            },
+            checkpoint=checkpoint,
+        )
+        open_networks_dict = merge_open_networks(reduced["Firewall"])
+        target_index = merge_target_indexes(reduced["Instance"])
+    else:
+        print("Getting all firewalls...")
+        open_networks_dict = reduce_resources(
+            "Firewall",
+            org_id,
+            partial(get_open_networks, public_space=public_space),
+            asset_api_serv_acct,
+            merger=merge_open_networks,
+            checkpoint=checkpoint,
+        )
+        print("Getting all GCE instances...")
+        target_index = reduce_resources(
+            "Instance",
+            org_id,
+            build_target_index,
+            asset_api_serv_acct,
+            merger=merge_target_indexes,
+            checkpoint=checkpoint,
+        )
 
-    print("Getting all GCE instances...")
+    print("Formatting scan data...")
     # Format:
-    # network_gces_dict = {
-    #     "projects/123456789/networks/default": ["1.2.3.4","4.4.4.4"],  # pragma: allowlist secret # noqa
-    #     "projects/987654321/global/networks/default": ["4.3.2.1", "1.1.1.1"],  # pragma: allowlist secret # noqa
+    # message = {
+    #   "network": "projects/123456789/global/networks/default",  # pragma: allowlist secret # noqa
+    #   "ips": ["1.2.3.4","4.4.4.4"],
+    #   "ports": ["1-122","49","8000-9000"],
     # }
-    instances = get_resources("Instance", org_id, asset_api_serv_acct)
-    network_gces_dict = get_instance_network_configs(instances)
-
-    print("Formatting for and shufflisng list for randomness while scanning...")
-    # Formatting:
-    # network_gce_list = [
-    #   {"projects/123456789/global/networks/default": ["1.2.3.4", "4.4.4.4"]},  # pragma: allowlist secret # noqa
-    #   {"projects/987654321/global/networks/default": ["4.3.2.1", "1.1.1.1"]},  # pragma: allowlist secret # noqa
-    # ]
-    network_gce_list = []
-    for k in network_gces_dict.keys():
-        network_gce_list.append({k: network_gces_dict[k]})
-    shuffle(network_gce_list)
+    print(
+        f"Found {len(target_index)} unique NAT IPs "
+        f"({target_index.seen - len(target_index)} duplicates dropped) "
+        f"across {target_index.networks()} networks."
+    )
+    return target_index.scan_messages(open_networks_dict)
+
+
+def get_instance_scan_messages(config, public_space=None, checkpoint=None):
+    """Lists all firewalls and GCE instances and returns scan messages for
+    only the ports each NAT IP actually exposes to the internet, honoring
+    target tags, target service accounts, rule priority and DENY rules.
+    A network may get several messages if its IPs expose different ports.
+    """
+    org_id = config["gcp-org-id"]
+    asset_api_serv_acct = config["asset-api-serv-acct"]
+
+    if config["concurrent-listing"]:
+        print("Getting all firewalls and GCE instances concurrently...")
+        reduced = get_resources_concurrent(
+            ["Firewall", "Instance"],
+            org_id,
+            asset_api_serv_acct,
+            shard_by=config["shard-by"],
+            max_workers=config["max-workers"],
+            reducers={
+                "Firewall": partial(build_firewall_index, public_space=public_space),
+                "Instance": get_instance_targets,
+            },
+            mergers={
+                "Firewall": partial(merge_firewall_indexes, public_space=public_space),
+                "Instance": merge_instance_targets,
+            },
+            checkpoint=checkpoint,
+        )
+        firewall_index = merge_firewall_indexes(reduced["Firewall"], public_space)
+        instance_targets = merge_instance_targets(reduced["Instance"])
+    else:
+        print("Getting all firewalls...")
+        firewall_index = reduce_resources(
+            "Firewall",
+            org_id,
+            partial(build_firewall_index, public_space=public_space),
+            asset_api_serv_acct,
+            merger=partial(merge_firewall_indexes, public_space=public_space),
+            checkpoint=checkpoint,
+        )
+        print("Getting all GCE instances...")
+        instance_targets = reduce_resources(
+            "Instance",
+            org_id,
+            get_instance_targets,
+            asset_api_serv_acct,
+            merger=merge_instance_targets,
+            checkpoint=checkpoint,
+        )
+
+    print("Evaluating effective firewall exposure per instance...")
+    return get_exposure_messages(firewall_index, instance_targets)
+
+
+def main(config):
+    bucket = config["gcs-bucket"]
+    pubsub_topic_uri = config["pubsub-topic-uri"]
+
+    get_asset_limiter(config["asset-api-serv-acct"], config["asset-api-rpm"])
+
+    public_space = PublicSpace(
+        config["excluded-source-ranges"], config["min-public-source-prefix"]
+    )
+    today = date.today()
+    checkpoint = None
+    if config["checkpoint-path"] or config["checkpoint-blob"]:
+        checkpoint = ListingCheckpoint(
+            f"{today.isoformat()}/{config['exposure-model']}",
+            path=config["checkpoint-path"],
+            gcs_bucket=(
+                None
+                if config["checkpoint-path"]
+                else get_client(("storage",), google_storage.Client).bucket(bucket)
+            ),
+            blob_name=config["checkpoint-blob"],
+            interval=config["checkpoint-interval"],
+        )
+        checkpoint.load()
+    if config["exposure-model"] == "instance":
+        scan_messages = get_instance_scan_messages(config, public_space, checkpoint)
+    else:
+        scan_messages = get_network_scan_messages(config, public_space, checkpoint)
+    print(f"Asset API rate limiter stats: {get_stats()}")
+    if config["job-order"] == "shuffle":
+        print("Shuffling list for randomness while scanning...")
+        shuffle(scan_messages)
 
+    storage_client = storage.Client()
+    gcs_bucket = None
+    if config["scan-config-format"] == "ndjson-gz":
+        gcs_bucket = get_client(("storage",), google_storage.Client).bucket(bucket)
+    publish_messages = scan_messages
+    if config["incremental"]:
+        if is_full_sweep_day(today, config["full-sweep-interval-days"]):
+            print("Running a forced full sweep; publishing every scan target.")
+        else:
+            previous_date, previous = load_previous_scan_config(
+                storage_client, bucket, today, gcs_bucket=gcs_bucket
+            )
+            if previous is None:
+                print("No previous scan config found; publishing every scan target.")
+            else:
+                publish_messages, removed = diff_scan_messages(previous, scan_messages)
+                print(
+                    f"Incremental scan against {previous_date.isoformat()}: "
+                    f"{len(publish_messages)} delta messages "
+                    f"(of {len(scan_messages)} networks), "
+                    f"{sum(len(ips) for ips in removed.values())} IPs removed "
+                    f"across {len(removed)} networks."
+                )
+                for network, ips in removed.items():
+                    print(f"Removed scan targets: {network} | {ips}")
+
+    if config["max-unit-cost"]:
+        unit_count = len(publish_messages)
+        publish_messages = [
+            unit
+            for message in publish_messages
+            for unit in plan_work_units(message, config["max-unit-cost"])
+        ]
+        print(
+            f"Split {unit_count} scan messages into {len(publish_messages)} "
+            f"work units of at most {config['max-unit-cost']} IP-port pairs."
+        )
+
+    if config["job-order"] == "lpt":
+        print("Ordering scan jobs by estimated duration, longest first...")
+        calibration = {}
+        if config["duration-calibration-blob"]:
+            calibration = load_calibration(
+                storage_client, bucket, config["duration-calibration-blob"]
+            )
+        profiles = DEFAULT_PROFILES
+        if config["nmap-profiles"]:
+            profiles = load_profiles(config["nmap-profiles"])
+        publish_messages = order_longest_first(
+            publish_messages,
+            calibration,
+            profiles,
+            config["job-deadline-hours"] * 3600,
+        )
+
+    publish_failures = []
     if pubsub_topic_uri:
         print("Pushing scan data to nmap pubsub topic...")
-        # iterating through each network with GCEs with NAT IPs, formatting data,
-        # and sending to pubsub topic.
-        # Format:
-        # message = {
-        #   "network": "projects/123456789/global/networks/default",  # pragma: allowlist secret # noqa
-        #   "ips": ["1.2.3.4","4.4.4.4"],
-        #   "ports": ["1-122","49","8000-9000"],
-        # }
-        for i in range(len(network_gce_list)):
-            # .keys() returns a list so just grab first element since this is a
-            # 1-key dictionary:
-            network = list(network_gce_list[i].keys())[0]
-            ports = open_networks_dict.get(network, None)
-            if not ports:
-                continue
-            message = {
-                "network": network,
-                "ips": network_gce_list[i][network],
-                "ports": ports,
-            }
-            pubsub_client = pubsub.Client()
-            pubsub_client.send_pubsub(pubsub_topic_uri, payload=message)
-            print(f"Sent message to pubsub topic: {message}")
-
-    print("Preparing data for upload to GCS...")
-    # The output looks like:
-    # projects.123456789.global.networks.default|1.2.3.4,4.4.4.4|1-122,49,8000-9000
-    # projects.987654321.global.networks.default|4.3.2.1,1.1.1.1|1-65535
-    tmp = tempfile.NamedTemporaryFile()
-    with open(tmp.name, "w") as f:
-        for i in range(len(network_gce_list)):
-            n = list(network_gce_list[i].keys())[0]
-            ports = open_networks_dict.get(n, None)
-            if not ports:
-                continue
-            f.write(f'{n}|{" ".join(network_gce_list[i][n])}|{",".join(ports)}\n')
+        # iterating through each network with GCEs with NAT IPs
+        # and sending to pubsub topic. Messages are batched and published
+        # asynchronously; failures are collected and reported below.
+        publisher = ScanPublisher(pubsub_topic_uri)
+        for message in publish_messages:
+            publisher.publish(message)
+            print(f"Queued message for pubsub topic: {message}")
+        publish_failures = publisher.wait()
+        print(
+            f"Published {publisher.published} messages to {pubsub_topic_uri}, "
+            f"{len(publish_failures)} failed."
+        )
 
-    storage_client = storage.Client()
-    scan_config_blob = f"{date.today().isoformat()}/scan-config.txt"
-    storage_client.write_gcs_from_file(
-        bucket, scan_config_blob, tmp.name, mime_type="text/plain"
-    )
-    print(f"Scan config written to gs://{bucket}/{scan_config_blob}")
+    # The full config is always written, so the next incremental run diffs
+    # against everything that was in scope today rather than just the delta.
+    if gcs_bucket is not None:
+        # Format: one JSON scan message per line, gzip-compressed, streamed
+        # straight to the bucket. Read it back with scanconfig.iter_scan_config.
+        scan_config_blob = NDJSON_BLOB.format(date=today.isoformat())
+        print(f"Streaming scan config to gs://{bucket}/{scan_config_blob}...")
+        write_scan_config_ndjson(gcs_bucket, scan_config_blob, scan_messages)
+        print(f"Scan config written to gs://{bucket}/{scan_config_blob}")
+    else:
+        print("Preparing data for upload to GCS...")
+        # The output looks like:
+        # projects/123456789/global/networks/default|1.2.3.4 4.4.4.4|1-122,49,8000-9000
+        # projects/987654321/global/networks/default|4.3.2.1 1.1.1.1|1-65535
+        tmp = tempfile.NamedTemporaryFile()
+        with open(tmp.name, "w") as f:
+            for message in scan_messages:
+                f.write(
+                    f'{message["network"]}|{" ".join(message["ips"])}'
+                    f'|{",".join(message["ports"])}\n'
+                )
+
+        scan_config_blob = SCAN_CONFIG_BLOB.format(date=today.isoformat())
+        storage_client.write_gcs_from_file(
+            bucket, scan_config_blob, tmp.name, mime_type="text/plain"
+        )
+        print(f"Scan config written to gs://{bucket}/{scan_config_blob}")
+
+    # Listing is only resumed until today's scan config has been written.
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    if publish_failures:
+        for message, e in publish_failures:
+            print(f"ERROR: Failed to publish message: {message}: {e}")
+        sys.exit(1)
 
 
 def get_config():
@@ -347,6 +706,208 @@ def get_config():
         ),
         required=False,
     )
+    parser.add_argument(
+        "--exposure-model",
+        type=str,
+        choices=["network", "instance"],
+        help=(
+            'Optional: How to decide what to scan. "network" scans every NAT IP '
+            "in a network on every port any rule in it allows from public "
+            "sources (see --min-public-source-prefix). "
+            '"instance" evaluates target tags, target service accounts, '
+            "priorities and DENY rules per instance and scans only the ports "
+            'each IP actually exposes. Defaults to "network". '
+            "May also be provided in the EXPOSURE_MODEL environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--excluded-source-ranges",
+        type=str,
+        help=(
+            "Optional: Comma-separated CIDRs (e.g. your own address blocks) that "
+            "do not count as public internet when classifying firewall sources. "
+            "May also be provided in the EXCLUDED_SOURCE_RANGES environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--min-public-source-prefix",
+        type=int,
+        help=(
+            "Optional: A firewall rule counts as internet-exposed if its source "
+            "ranges cover at least as many public addresses as a CIDR of this "
+            f"prefix length. Defaults to {DEFAULT_MIN_PUBLIC_PREFIX}. "
+            "May also be provided in the MIN_PUBLIC_SOURCE_PREFIX environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--concurrent-listing",
+        action="store_true",
+        help=(
+            "Optional: List firewalls and instances concurrently. "
+            "May also be enabled by setting the CONCURRENT_LISTING "
+            'environment variable to "true". '
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--shard-by",
+        type=str,
+        choices=["project"],
+        help=(
+            "Optional: With --concurrent-listing, additionally split the "
+            "organization-wide listing into one listing per project. "
+            "May also be provided in the SHARD_BY environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help=(
+            "Optional: The maximum number of concurrent Asset API listings. "
+            "Defaults to 4. "
+            "May also be provided in the MAX_WORKERS environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Optional: Only publish scan messages for targets that are new or "
+            "have newly opened ports since the previous scan config. "
+            "May also be enabled by setting the INCREMENTAL environment "
+            'variable to "true". '
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--full-sweep-interval-days",
+        type=int,
+        help=(
+            "Optional: With --incremental, publish every scan target once every "
+            "this many days. Defaults to 7. "
+            "May also be provided in the FULL_SWEEP_INTERVAL_DAYS environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--max-unit-cost",
+        type=int,
+        help=(
+            "Optional: Split each network's scan into work units of at most this "
+            "many IP-port pairs, so large networks are spread across scanner "
+            f"replicas. Defaults to {DEFAULT_MAX_UNIT_COST}; 0 disables splitting. "
+            "May also be provided in the MAX_UNIT_COST environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--job-order",
+        type=str,
+        choices=["lpt", "shuffle"],
+        help=(
+            'Optional: The order in which to publish scan jobs. "lpt" publishes '
+            'the longest estimated jobs first; "shuffle" publishes them in '
+            'random order. Defaults to "lpt". '
+            "May also be provided in the JOB_ORDER environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--duration-calibration-blob",
+        type=str,
+        help=(
+            "Optional: The scan duration history blob port-scanner records to "
+            "with its --duration-history-blob, whose per-network slowness "
+            'factors calibrate "lpt" job ordering. '
+            "May also be provided in the DURATION_CALIBRATION_BLOB environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--nmap-profiles",
+        type=str,
+        help=(
+            "Optional: The JSON file of nmap profiles port-scanner is given with "
+            'its --nmap-profiles, so "lpt" job ordering estimates each job '
+            "with the profile port-scanner will choose for it. Defaults to "
+            "port-scanner's built-in profiles. "
+            "May also be provided in the NMAP_PROFILES environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--job-deadline-hours",
+        type=float,
+        help=(
+            "Optional: port-scanner's --job-deadline-hours, used with "
+            "--nmap-profiles to estimate job durations. "
+            f"Defaults to {DEFAULT_JOB_DEADLINE_HOURS}. "
+            "May also be provided in the JOB_DEADLINE_HOURS environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--scan-config-format",
+        type=str,
+        choices=["text", "ndjson-gz"],
+        help=(
+            'Optional: The format of the daily scan config. "text" writes '
+            '{date}/scan-config.txt; "ndjson-gz" streams gzip-compressed NDJSON '
+            'to {date}/scan-config.ndjson.gz. Defaults to "text". '
+            "May also be provided in the SCAN_CONFIG_FORMAT environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--checkpoint-path",
+        type=str,
+        help=(
+            "Optional: A local file in which to checkpoint Asset API listing "
+            "progress, so a restarted run resumes listing where it stopped. "
+            "May also be provided in the CHECKPOINT_PATH environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--checkpoint-blob",
+        type=str,
+        help=(
+            "Optional: Like --checkpoint-path, but a blob in the GCS bucket, "
+            'e.g. "checkpoints/asset-discovery.pickle". '
+            "May also be provided in the CHECKPOINT_BLOB environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        help=(
+            "Optional: The minimum number of seconds between checkpoint writes. "
+            "Defaults to 60. "
+            "May also be provided in the CHECKPOINT_INTERVAL environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--asset-api-rpm",
+        type=int,
+        help=(
+            "Optional: The maximum number of Asset API requests per minute per "
+            f"credential. Defaults to {ASSET_API_RPM}. "
+            "May also be provided in the ASSET_API_RPM environment variable. "
+        ),
+        required=False,
+    )
 
     # for i in range(len(sys.argv)):
     #     print(f"{i}: {sys.argv[i]}")
@@ -359,6 +920,50 @@ def get_config():
         "pubsub-topic-uri": args.pubsub_topic_uri or os.environ.get("PUBSUB_TOPIC_URI"),
         "asset-api-serv-acct": args.asset_api_serv_acct
         or os.environ.get("ASSET_API_SERV_ACCT"),
+        "exposure-model": args.exposure_model
+        or os.environ.get("EXPOSURE_MODEL", "network"),
+        "excluded-source-ranges": [
+            c
+            for c in (
+                args.excluded_source_ranges
+                or os.environ.get("EXCLUDED_SOURCE_RANGES", "")
+            ).split(",")
+            if c.strip()
+        ],
+        "min-public-source-prefix": (
+            args.min_public_source_prefix
+            if args.min_public_source_prefix is not None
+            else int(
+                os.environ.get("MIN_PUBLIC_SOURCE_PREFIX", DEFAULT_MIN_PUBLIC_PREFIX)
+            )
+        ),
+        "concurrent-listing": args.concurrent_listing
+        or os.environ.get("CONCURRENT_LISTING", "").lower() == "true",
+        "shard-by": args.shard_by or os.environ.get("SHARD_BY"),
+        "max-workers": args.max_workers or int(os.environ.get("MAX_WORKERS", 4)),
+        "asset-api-rpm": args.asset_api_rpm
+        or int(os.environ.get("ASSET_API_RPM", ASSET_API_RPM)),
+        "incremental": args.incremental
+        or os.environ.get("INCREMENTAL", "").lower() == "true",
+        "full-sweep-interval-days": args.full_sweep_interval_days
+        or int(os.environ.get("FULL_SWEEP_INTERVAL_DAYS", 7)),
+        "scan-config-format": args.scan_config_format
+        or os.environ.get("SCAN_CONFIG_FORMAT", "text"),
+        "job-order": args.job_order or os.environ.get("JOB_ORDER", "lpt"),
+        "duration-calibration-blob": args.duration_calibration_blob
+        or os.environ.get("DURATION_CALIBRATION_BLOB"),
+        "nmap-profiles": args.nmap_profiles or os.environ.get("NMAP_PROFILES"),
+        "job-deadline-hours": args.job_deadline_hours
+        or float(os.environ.get("JOB_DEADLINE_HOURS", DEFAULT_JOB_DEADLINE_HOURS)),
+        "checkpoint-path": args.checkpoint_path or os.environ.get("CHECKPOINT_PATH"),
+        "checkpoint-blob": args.checkpoint_blob or os.environ.get("CHECKPOINT_BLOB"),
+        "checkpoint-interval": args.checkpoint_interval
+        or float(os.environ.get("CHECKPOINT_INTERVAL", 60)),
+        "max-unit-cost": (
+            args.max_unit_cost
+            if args.max_unit_cost is not None
+            else int(os.environ.get("MAX_UNIT_COST", DEFAULT_MAX_UNIT_COST))
+        ),
     }
 
     if not config["gcs-bucket"] or not config["gcp-org-id"]:
@@ -0,0 +1,62 @@
+from ports import PortSet
+from targets import with_job, with_started
+
+
+def scan_cost(message):
+    """Estimates the cost of a scan message as its number of IP-port pairs."""
+    return len(message["ips"]) * PortSet(message["ports"]).size()
+
+
+def plan_work_units(message, max_cost):
+    """Splits a network's scan message into work units of at most max_cost
+    IP-port pairs each, so large networks can be scanned by several scanner
+    replicas at once.
+
+    IPs are divided into evenly sized groups first. Port ranges are only split
+    when a single IP on its own exceeds max_cost. Every unit keeps the
+    message's "network" and "job" fields and the "started" timestamps of its
+    own IPs, and is numbered with "unit" and "units", so results are stored
+    separately per message and unit. Messages within budget are returned
+    unchanged.
+
+    The output looks like:
+    [
+        {"network": "...", "ips": ["1.2.3.4"], "ports": ["1-65535"], "job": "3f2a9c1e0b7d", "unit": 1, "units": 2},
+        {"network": "...", "ips": ["4.4.4.4"], "ports": ["1-65535"], "job": "3f2a9c1e0b7d", "unit": 2, "units": 2},
+    ]
+    """  # noqa
+    ports = PortSet(message["ports"])
+    ips = message["ips"]
+    port_count = ports.size()
+    if not max_cost or not ips or len(ips) * port_count <= max_cost:
+        return [message]
+
+    if port_count > max_cost:
+        port_chunks = [p.to_list() for p in ports.split(-(-port_count // max_cost))]
+        ip_groups = [[ip] for ip in ips]
+    else:
+        port_chunks = [message["ports"]]
+        ips_per_unit = max_cost // port_count
+        group_count = -(-len(ips) // ips_per_unit)
+        base, extra = divmod(len(ips), group_count)
+        ip_groups = []
+        start = 0
+        for i in range(group_count):
+            end = start + base + (1 if i < extra else 0)
+            ip_groups.append(ips[start:end])
+            start = end
+
+    job = message.get("job") or with_job(dict(message))["job"]
+    units = [
+        with_started(
+            {"network": message["network"], "ips": ip_group, "ports": port_chunk},
+            message.get("started", {}),
+        )
+        for ip_group in ip_groups
+        for port_chunk in port_chunks
+    ]
+    for i, unit in enumerate(units, start=1):
+        unit["job"] = job
+        unit["unit"] = i
+        unit["units"] = len(units)
+    return units
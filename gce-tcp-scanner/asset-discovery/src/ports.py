@@ -0,0 +1,152 @@
+MIN_PORT = 1
+MAX_PORT = 65535
+
+
+def parse_port(port):
+    """Parses a port or port range string (e.g. "22" or "8000-9000") and
+    returns an inclusive (low, high) tuple of integers.
+    """
+    port = str(port).strip()
+    if "-" in port:
+        p1, p2 = port.split("-", 1)
+        p1, p2 = int(p1), int(p2)
+        return (min(p1, p2), max(p1, p2))
+    p = int(port)
+    return (p, p)
+
+
+def format_range(low, high):
+    if low == high:
+        return str(low)
+    return f"{low}-{high}"
+
+
+class PortSet:
+    """A set of ports stored as sorted, non-overlapping, non-adjacent inclusive
+    integer intervals.
+
+    Ports are accumulated cheaply with add()/update() and only sorted and
+    coalesced when the set is queried or serialized, so building a set from
+    many firewall rules is O(n log n) instead of re-merging on every insert.
+    """
+
+    def __init__(self, ports=None):
+        self._intervals = []
+        self._pending = []
+        if ports:
+            self.update(ports)
+
+    def add(self, port):
+        """Adds a single port or port range string to the set."""
+        self._pending.append(parse_port(port))
+
+    def add_range(self, low, high):
+        """Adds the inclusive integer range [low, high] to the set."""
+        self._pending.append((min(low, high), max(low, high)))
+
+    def update(self, ports):
+        """Adds every port or port range string in ports to the set."""
+        for port in ports:
+            self._pending.append(parse_port(port))
+
+    def union(self, other):
+        """Adds every range of another PortSet to this set."""
+        self._pending.extend(other.intervals())
+
+    def difference(self, other):
+        """Returns a new PortSet of the ports in this set but not in other."""
+        result = PortSet()
+        theirs = other.intervals()
+        i = 0
+        for low, high in self.intervals():
+            while i < len(theirs) and theirs[i][1] < low:
+                i += 1
+            j = i
+            while low <= high and j < len(theirs) and theirs[j][0] <= high:
+                if theirs[j][0] > low:
+                    result.add_range(low, theirs[j][0] - 1)
+                low = max(low, theirs[j][1] + 1)
+                j += 1
+            if low <= high:
+                result.add_range(low, high)
+        return result
+
+    def split(self, count):
+        """Splits the set into at most count PortSets of roughly equal size,
+        in ascending port order.
+        """
+        total = self.size()
+        count = max(1, min(count, total))
+        base, extra = divmod(total, count)
+        sizes = [base + 1 if i < extra else base for i in range(count)]
+        chunks = [PortSet() for _ in sizes]
+        i, remaining = 0, sizes[0]
+        for low, high in self.intervals():
+            while low <= high:
+                chunk_high = min(high, low + remaining - 1)
+                chunks[i].add_range(low, chunk_high)
+                remaining -= chunk_high - low + 1
+                low = chunk_high + 1
+                if remaining == 0 and i + 1 < count:
+                    i += 1
+                    remaining = sizes[i]
+        return [chunk for chunk in chunks if chunk]
+
+    def is_full(self):
+        return self.intervals() == [(MIN_PORT, MAX_PORT)]
+
+    def intervals(self):
+        """Returns the coalesced list of (low, high) tuples in ascending order."""
+        if self._pending:
+            self._coalesce()
+        return self._intervals
+
+    def _coalesce(self):
+        ranges = self._intervals + self._pending
+        ranges.sort()
+        merged = []
+        for low, high in ranges:
+            if merged and low <= merged[-1][1] + 1:
+                if high > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], high)
+            else:
+                merged.append((low, high))
+        self._intervals = merged
+        self._pending = []
+
+    def size(self):
+        """Returns the number of individual ports in the set."""
+        return sum(high - low + 1 for low, high in self.intervals())
+
+    def to_list(self):
+        """Serializes the set to a list of port and port range strings, e.g.
+        ["1-444", "447", "450-65535"].
+        """
+        return [format_range(low, high) for low, high in self.intervals()]
+
+    def to_nmap(self):
+        """Serializes the set to nmap `-p` syntax, e.g. "1-444,447,450-65535"."""
+        return ",".join(self.to_list())
+
+    def __contains__(self, port):
+        port = int(port)
+        intervals = self.intervals()
+        lo, hi = 0, len(intervals)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if intervals[mid][1] < port:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(intervals) and intervals[lo][0] <= port
+
+    def __bool__(self):
+        return bool(self._pending or self._intervals)
+
+    def __eq__(self, other):
+        if not isinstance(other, PortSet):
+            return NotImplemented
+        return self.intervals() == other.intervals()
+
+    def __repr__(self):
+        return f"PortSet({self.to_list()})"
@@ -0,0 +1,74 @@
+import json
+
+from google.cloud import pubsub_v1
+
+
+class ScanPublisher:
+    """Publishes scan messages to a Pub/Sub topic through a single, reused
+    PublisherClient.
+
+    Messages are batched by count, size and latency and published
+    asynchronously. Flow control blocks publish() once max_in_flight_bytes are
+    awaiting acknowledgement, bounding memory when fanning out many messages.
+    Failures are collected and returned by wait() instead of being dropped.
+
+    An existing client exposing publish(topic, data) -> future may be passed
+    in, e.g. an in-process stand-in.
+    """
+
+    def __init__(
+        self,
+        topic_uri,
+        max_messages=100,
+        max_bytes=1024 * 1024,
+        max_latency=0.05,
+        max_in_flight_bytes=16 * 1024 * 1024,
+        client=None,
+    ):
+        self.topic_uri = topic_uri
+        if not client:
+            client = pubsub_v1.PublisherClient(
+                batch_settings=pubsub_v1.types.BatchSettings(
+                    max_messages=max_messages,
+                    max_bytes=max_bytes,
+                    max_latency=max_latency,
+                ),
+                publisher_options=pubsub_v1.types.PublisherOptions(
+                    flow_control=pubsub_v1.types.PublishFlowControl(
+                        byte_limit=max_in_flight_bytes,
+                        limit_exceeded_behavior=(
+                            pubsub_v1.types.LimitExceededBehavior.BLOCK
+                        ),
+                    )
+                ),
+            )
+        self._client = client
+        self._pending = []
+        self.published = 0
+        self.failures = []
+
+    def publish(self, payload):
+        """Queues payload (a dict, list or str) for publishing and returns the
+        publish future.
+        """
+        if isinstance(payload, (dict, list)):
+            data = json.dumps(payload, default=str)
+        else:
+            data = payload
+        future = self._client.publish(self.topic_uri, data.encode("utf-8"))
+        self._pending.append((future, payload))
+        return future
+
+    def wait(self, timeout=None):
+        """Blocks until every queued message is published or has failed, and
+        returns the list of (payload, exception) failures.
+        """
+        for future, payload in self._pending:
+            try:
+                future.result(timeout=timeout)
+            except Exception as e:
+                self.failures.append((payload, e))
+            else:
+                self.published += 1
+        self._pending = []
+        return self.failures
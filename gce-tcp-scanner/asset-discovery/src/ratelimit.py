@@ -0,0 +1,76 @@
+import threading
+import time
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """A thread-safe token bucket that allows requests_per_minute requests per
+    minute, with bursts of up to burst requests.
+
+    Time spent blocked in acquire() is tracked so callers can report how long
+    they were throttled.
+    """
+
+    def __init__(self, requests_per_minute, burst=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst or max(1, requests_per_minute // 6))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Blocks until tokens are available and consumes them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Reserve the tokens now; if that leaves the bucket in debt, wait
+            # for it to refill. Reserving under the lock keeps concurrent
+            # callers queued in order instead of racing for the next token.
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.requests += 1
+            if wait:
+                self.throttled_requests += 1
+                self.throttled_seconds += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "throttled_requests": self.throttled_requests,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
+
+
+def get_limiter(api, credential=None, requests_per_minute=60, burst=None):
+    """Returns the process-wide RateLimiter for the given API and credential,
+    creating it on first use. Quotas are enforced per caller identity, so
+    each impersonated service account gets its own bucket.
+    """
+    key = (api, credential or "default")
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(requests_per_minute, burst)
+        return _limiters[key]
+
+
+def get_stats():
+    """Returns throttling counters for every limiter, keyed by "api/credential"."""
+    with _limiters_lock:
+        return {
+            f"{api}/{credential}": limiter.stats()
+            for (api, credential), limiter in _limiters.items()
+        }
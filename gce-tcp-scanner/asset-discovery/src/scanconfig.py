@@ -0,0 +1,40 @@
+import gzip
+import json
+
+NDJSON_BLOB = "{date}/scan-config.ndjson.gz"
+
+
+def write_scan_config_ndjson(gcs_bucket, blob_name, messages):
+    """Streams scan messages to a gzip-compressed NDJSON blob, one message per
+    line, without staging the file locally.
+
+    gcs_bucket is a google.cloud.storage Bucket. Each line looks like:
+    {"network": "projects/123456789/global/networks/default", "ips": ["1.2.3.4"], "ports": ["1-122"]}
+    """  # noqa
+    blob = gcs_bucket.blob(blob_name)
+    count = 0
+    with blob.open("wb", content_type="application/gzip") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            for message in messages:
+                f.write(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+                f.write(b"\n")
+                count += 1
+    return count
+
+
+def iter_scan_config_records(fileobj):
+    """Lazily yields scan config records from a gzip-compressed NDJSON file
+    object.
+    """
+    with gzip.GzipFile(fileobj=fileobj, mode="rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_scan_config(gcs_bucket, blob_name):
+    """Lazily yields scan config records from a gzip-compressed NDJSON blob,
+    downloading it in chunks as it is read.
+    """
+    with gcs_bucket.blob(blob_name).open("rb") as raw:
+        yield from iter_scan_config_records(raw)
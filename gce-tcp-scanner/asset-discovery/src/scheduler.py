@@ -0,0 +1,127 @@
+import heapq
+import json
+import math
+
+from scancost import (
+    DEFAULT_JOB_DEADLINE_HOURS,
+    DEFAULT_PROFILES,
+    count_ports,
+    select_profile,
+)
+
+
+def scan_profile(
+    message,
+    calibration=None,
+    profiles=DEFAULT_PROFILES,
+    deadline=DEFAULT_JOB_DEADLINE_HOURS * 3600,
+):
+    """Returns the nmap profile port-scanner is expected to scan the message
+    with and its estimated duration in seconds, chosen as port-scanner does
+    from the message's IPs, IP-port pairs and deadline (see
+    scancost.select_profile).
+
+    calibration optionally maps a network to its slowness factor from
+    previous runs (see load_calibration). profiles and deadline should match
+    port-scanner's --nmap-profiles and --job-deadline-hours.
+    """
+    ips = len(message["ips"])
+    pairs = ips * count_ports(message["ports"])
+    slowness = (calibration or {}).get(message["network"], 1.0)
+    return select_profile(profiles, ips, pairs, deadline, slowness)
+
+
+def estimate_message_duration(
+    message,
+    calibration=None,
+    profiles=DEFAULT_PROFILES,
+    deadline=DEFAULT_JOB_DEADLINE_HOURS * 3600,
+):
+    """Estimates how many seconds port-scanner will take to scan the message,
+    with the profile scan_profile expects it to use.
+    """
+    return scan_profile(message, calibration, profiles, deadline)[1]
+
+
+def load_calibration(storage_client, bucket, blob):
+    """Loads per-network slowness factors from the scan duration history
+    port-scanner keeps in the bucket (see DurationHistory in port-scanner's
+    profiles.py). port-scanner writes it after each scan when run with
+    --duration-history-blob; give asset-discovery's
+    --duration-calibration-blob the same blob name. Returns an empty
+    dictionary if it can't be read.
+
+    The output looks like:
+    {
+        "projects/123456789/global/networks/default": 1.7, # pragma: allowlist secret
+        ...
+    }
+    """
+    try:
+        history = json.loads(storage_client.read_gcs(bucket, blob))
+    except Exception as e:
+        print(f"Could not load scan duration calibration gs://{bucket}/{blob}: {e}")
+        return {}
+    calibration = parse_calibration(history)
+    print(f"Loaded scan duration calibration for {len(calibration)} networks.")
+    return calibration
+
+
+def parse_calibration(history):
+    """Returns the slowness factor of each network in a scan duration
+    history, shaped like:
+    {
+        "projects/123456789/global/networks/default": {"slowness": 1.7, "seconds": 5400, "pairs": 2400000, "profile": "reduced"}, # pragma: allowlist secret
+    }
+
+    Entries without a positive, finite slowness are skipped with a warning,
+    so one bad entry can't reorder every job.
+    """  # noqa
+    if not isinstance(history, dict):
+        print("WARNING: Ignoring scan duration calibration that isn't a JSON object.")
+        return {}
+    calibration = {}
+    for network, entry in history.items():
+        slowness = entry.get("slowness") if isinstance(entry, dict) else None
+        if (
+            not isinstance(slowness, (int, float))
+            or isinstance(slowness, bool)
+            or not math.isfinite(slowness)
+            or slowness <= 0
+        ):
+            print(
+                f"WARNING: Skipping scan duration calibration for {network}; "
+                f"no positive slowness in {entry!r}"
+            )
+            continue
+        calibration[network] = float(slowness)
+    return calibration
+
+
+def order_longest_first(
+    messages,
+    calibration=None,
+    profiles=DEFAULT_PROFILES,
+    deadline=DEFAULT_JOB_DEADLINE_HOURS * 3600,
+):
+    """Returns messages ordered by estimated scan duration, longest first
+    (LPT scheduling), so the longest jobs start early and short ones fill in
+    the gaps across scanner replicas.
+    """
+    return sorted(
+        messages,
+        key=lambda m: (
+            -estimate_message_duration(m, calibration, profiles, deadline),
+            m["network"],
+        ),
+    )
+
+
+def simulate_makespan(durations, workers):
+    """Simulates workers taking jobs in the given order as they become free
+    and returns the time at which the last job finishes.
+    """
+    finish_times = [0.0] * max(1, workers)
+    for duration in durations:
+        heapq.heapreplace(finish_times, finish_times[0] + duration)
+    return max(finish_times)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+
+from ports import PortSet
+
+
+def network_key(network):
+    """Returns a canonical (host project, network name) key for a VPC network
+    URL, so the full, partial and "global"-less forms the Asset API returns for
+    the same network (e.g. from a shared-VPC service project's instances and
+    the host project's firewalls) all compare equal. Unrecognized values are
+    returned unchanged.
+    """
+    parts = network.split("/")
+    try:
+        project = parts[parts.index("projects") + 1]
+        name = parts[parts.index("networks") + 1]
+    except (ValueError, IndexError):
+        return network
+    return (project, name)
+
+
+def ip_to_int(ip):
+    """Packs a dotted IPv4 address into an int, or returns the address
+    unchanged if it isn't one.
+    """
+    octets = ip.split(".")
+    if len(octets) != 4:
+        return ip
+    try:
+        value = 0
+        for octet in octets:
+            octet = int(octet)
+            if not 0 <= octet <= 255:
+                return ip
+            value = value << 8 | octet
+    except ValueError:
+        return ip
+    return value
+
+
+def int_to_ip(value):
+    """Unpacks an int from ip_to_int back into a dotted IPv4 address."""
+    if not isinstance(value, int):
+        return value
+    return f"{value >> 24}.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+
+
+def with_started(message, started):
+    """Adds the lastStartTimestamp of each of a scan message's IPs found in
+    started (a dict of IP to timestamp) to the message under "started", if it
+    has any, and returns the message.
+    """
+    started = {ip: started[ip] for ip in message["ips"] if ip in started}
+    if started:
+        message["started"] = started
+    return message
+
+
+def with_job(message):
+    """Adds a "job" id to a scan message, derived from its network, IPs and
+    ports, and returns the message. A network can be covered by several
+    messages, so port-scanner names each message's results after its job
+    rather than its network alone. The id doesn't depend on the order of the
+    IPs and ports or the form of the network URL, so the same targets get the
+    same id from run to run.
+    """
+    key = json.dumps(
+        [
+            network_key(message["network"]),
+            sorted(message["ips"]),
+            sorted(message["ports"]),
+        ]
+    )
+    message["job"] = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return message
+
+
+class TargetIndex:
+    """NAT IPs keyed by canonical network, de-duplicated across NICs, networks
+    and overlapping asset listings.
+
+    Each IP is stored once, as an int, along with the ids of every network it
+    was seen on, so it can be scanned once with the union of the ports open on
+    all of them, and the lastStartTimestamp of its instance, so port-scanner
+    can tell when cached service fingerprints for it are stale.
+    """
+
+    def __init__(self):
+        self._network_ids = {}
+        self._network_names = []
+        self._ips = {}
+        self._started = {}
+        self.seen = 0
+
+    def _network_id(self, network):
+        key = network_key(network)
+        if key not in self._network_ids:
+            self._network_ids[key] = len(self._network_names)
+            self._network_names.append(network)
+        network_id = self._network_ids[key]
+        # A network seen in several forms is named by the first in sorted
+        # order, rather than the first listed, so names are stable across runs.
+        if network < self._network_names[network_id]:
+            self._network_names[network_id] = network
+        return network_id
+
+    def add(self, network, ip, started=None):
+        """Records that ip is reachable on network, on an instance last started
+        at started. Returns True if the IP wasn't already indexed.
+        """
+        self.seen += 1
+        network_id = self._network_id(network)
+        value = ip_to_int(ip)
+        if started:
+            self._started[value] = started
+        networks = self._ips.get(value)
+        if networks is None:
+            self._ips[value] = (network_id,)
+            return True
+        if network_id not in networks:
+            self._ips[value] = networks + (network_id,)
+        return False
+
+    def merge(self, other):
+        """Adds every IP from another TargetIndex to this one."""
+        seen = self.seen + other.seen
+        for value, network_ids in other._ips.items():
+            for network_id in network_ids:
+                self.add(
+                    other._network_names[network_id],
+                    int_to_ip(value),
+                    other._started.get(value),
+                )
+        self.seen = seen
+        return self
+
+    def __iter__(self):
+        """Yields (IP, [network, ...]) for each indexed IP."""
+        for value, network_ids in self._ips.items():
+            yield int_to_ip(value), [self._network_names[i] for i in network_ids]
+
+    def __len__(self):
+        return len(self._ips)
+
+    def networks(self):
+        return len(self._network_names)
+
+    def scan_messages(self, open_networks):
+        """Returns one scan message per group of IPs sharing the same networks,
+        with each IP listed once and scanned on the union of the ports
+        open_networks (as from get_open_networks) lists for those networks.
+        IPs with no open ports are left out. Each message is named after the
+        group's first network in canonical order, so a network in several
+        groups gets several messages, told apart by their "job" ids. Messages
+        and their IPs don't depend on the order assets were listed in.
+
+        The output looks like:
+        [
+            {"network": "projects/123456789/global/networks/default", "ips": ["1.2.3.4"], "ports": ["22", "443"], "started": {"1.2.3.4": "2024-01-01T00:00:00.000-08:00"}, "job": "3f2a9c1e0b7d"}, # pragma: allowlist secret
+        ]
+        """  # noqa
+        open_ports = {}
+        for network, ports in open_networks.items():
+            open_ports.setdefault(network_key(network), PortSet()).update(ports)
+        network_ports = [
+            open_ports.get(network_key(name), PortSet()) for name in self._network_names
+        ]
+
+        # IPs are grouped by their networks in canonical order rather than the
+        # order they were seen in.
+        order = {network_id: str(key) for key, network_id in self._network_ids.items()}
+        groups = {}
+        for value, network_ids in self._ips.items():
+            group = tuple(sorted(network_ids, key=order.get))
+            groups.setdefault(group, []).append(value)
+        messages = []
+        for network_ids in sorted(groups, key=lambda ids: [order[i] for i in ids]):
+            values = sorted(groups[network_ids], key=lambda v: (isinstance(v, str), v))
+            ports = PortSet()
+            for network_id in network_ids:
+                ports.union(network_ports[network_id])
+            if not ports:
+                continue
+            messages.append(
+                with_job(
+                    with_started(
+                        {
+                            "network": self._network_names[network_ids[0]],
+                            "ips": [int_to_ip(v) for v in values],
+                            "ports": ports.to_list(),
+                        },
+                        {
+                            int_to_ip(v): self._started[v]
+                            for v in values
+                            if v in self._started
+                        },
+                    )
+                )
+            )
+        return messages
+
+
+def build_target_index(instances):
+    """Takes an iterable of GCE instances and returns a TargetIndex of their
+    NAT IPs.
+    """
+    index = TargetIndex()
+    for instance in instances:
+        data = instance.resource.data
+        for ni in data.get("networkInterfaces", ()):
+            for ac in ni.get("accessConfigs", ()):
+                if "natIP" in ac:
+                    index.add(
+                        ni["network"], ac["natIP"], data.get("lastStartTimestamp")
+                    )
+    return index
+
+
+def merge_target_indexes(indexes):
+    """Merges several TargetIndexes, in order, into one."""
+    merged = TargetIndex()
+    for index in indexes:
+        merged.merge(index)
+    return merged
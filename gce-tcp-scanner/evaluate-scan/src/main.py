@@ -11,12 +11,12 @@ from datetime import timezone
 import json
 
 from google.cloud import asset_v1
-from bibt.gcp import iam
+from gcpclients import get_client, get_credentials
 from fake_useragent import UserAgent
 from google.cloud import logging as gcp_logging
 from google.api_core import exceptions
 from google.api_core.retry import Retry
-
+from ratelimit import get_limiter, get_stats
 
 _RETRYABLE = [
     exceptions.TooManyRequests,
@@ -30,11 +30,13 @@ _RETRYABLE = [
 
 def is_retryable(exc):
     print(f"Checking exception for retryable: {type(exc).__name__}")
-    return isinstance(exc, _RETRYABLE)
+    return isinstance(exc, tuple(_RETRYABLE))
 
 
+# Requests are paced by the Asset API rate limiter, so a 429 here is the
+# exception rather than the rule and does not warrant minutes of backoff.
 retry_policy = Retry(
-    predicate=is_retryable, initial=60.0, maximum=600.0, multiplier=1.5, timeout=43200.0
+    predicate=is_retryable, initial=5.0, maximum=120.0, multiplier=2.0, timeout=43200.0
 )
 
 
@@ -79,16 +81,23 @@ def is_vulnerable_jupyter(ip, port, project, is_server=False):
     return True
 
 
+def _get_asset_limiter():
+    return get_limiter(
+        "cloudasset.googleapis.com",
+        os.environ.get("ASSET_API_SERV_ACCT"),
+        int(os.environ.get("ASSET_API_RPM", 90)),
+    )
+
+
 def _get_host_metadata(project, ipaddr):
-    if os.environ.get("ASSET_API_SERV_ACCT"):
-        iam_client = iam.Client()
-        creds = iam_client.get_credentials(
-            target_acct=os.environ.get("ASSET_API_SERV_ACCT")
-        )
-        client = asset_v1.AssetServiceClient(credentials=creds)
-    else:
-        client = asset_v1.AssetServiceClient()
-    for _asset in client.list_assets(
+    limiter = _get_asset_limiter()
+    serv_acct = os.environ.get("ASSET_API_SERV_ACCT")
+    creds = get_credentials(serv_acct)
+    client = get_client(
+        ("asset", serv_acct), lambda: asset_v1.AssetServiceClient(credentials=creds)
+    )
+    limiter.acquire()
+    response = client.list_assets(
         request={
             "parent": f"projects/{project}",
             "content_type": "RESOURCE",
@@ -97,27 +106,30 @@ def _get_host_metadata(project, ipaddr):
         },
         timeout=300,
         retry=retry_policy,
-    ):
-        try:
-            for networkInterface in _asset.resource.data.get("networkInterfaces"):
-                for accessConfig in networkInterface.get("accessConfigs"):
-                    if accessConfig.get("natIP") == ipaddr:
-                        return _asset
-        except Exception:
-            continue
+    )
+    for page in response.pages:
+        for _asset in page.assets:
+            try:
+                for networkInterface in _asset.resource.data.get("networkInterfaces"):
+                    for accessConfig in networkInterface.get("accessConfigs"):
+                        if accessConfig.get("natIP") == ipaddr:
+                            return _asset
+            except Exception:
+                continue
+        # The next page, if any, is fetched when the loop advances.
+        if page.next_page_token:
+            limiter.acquire()
     return None
 
 
 def _get_startup_log(project, instance_id, last_starttime):
     print(f"GCE last startup time: {last_starttime}")
-    if os.environ.get("LOGGING_API_SERV_ACCT"):
-        iam_client = iam.Client()
-        creds = iam_client.get_credentials(
-            target_acct=os.environ.get("LOGGING_API_SERV_ACCT")
-        )
-        client = gcp_logging.Client(project=project, credentials=creds, _use_grpc=False)
-    else:
-        client = gcp_logging.Client(project=project, _use_grpc=False)
+    serv_acct = os.environ.get("LOGGING_API_SERV_ACCT")
+    creds = get_credentials(serv_acct)
+    client = get_client(
+        ("logging", project, serv_acct),
+        lambda: gcp_logging.Client(project=project, credentials=creds, _use_grpc=False),
+    )
     start_ts = datetime.strptime(last_starttime, "%Y-%m-%dT%H:%M:%S.%f%z")
     window_start = start_ts - timedelta(minutes=30)
     window_start_str = window_start.astimezone(tz=timezone.utc).strftime(
@@ -144,6 +156,7 @@ def _get_startup_log(project, instance_id, last_starttime):
 def alert_vulnerable_jupyter(project, host, port_id, is_server):
     print("Alerting on vulnerable jupyter...")
     host_metadata = _get_host_metadata(project, host["address"]["addr"])
+    print(f"Asset API rate limiter stats: {get_stats()}")
     hostdata = ""
     if host_metadata:
         hostdata = (
@@ -263,9 +276,25 @@ def alert_vulnerable_jupyter(project, host, port_id, is_server):
 
 
 def evaluate_results(message):
+    """Checks the hosts in a port-scanner results message for open Jupyter
+    servers and notebooks.
+
+    The message is either the full nmaprun document with a "network" field,
+    or a compact message ("format": "compact") with the same "network" and
+    "host" fields, but listing only hosts with open ports, and with the GCS
+    URI of the full results under "results".
+    """
     message.ack()
     results_json = json.loads(message.data.decode("utf-8"))
     project = results_json["network"].split("/")[-4]
+    if results_json.get("format") == "compact":
+        print(
+            f"Evaluating compact results for {results_json['network']} "
+            f"(part {results_json.get('part', 1)}): "
+            f"{len(results_json.get('host', []))} of "
+            f"{results_json.get('scanned')} hosts have open ports. "
+            f"Full results: {results_json.get('results')}"
+        )
     host_list = results_json.get("host", [])
     if not isinstance(host_list, list):
         host_list = [host_list]
@@ -324,6 +353,8 @@ def main(config):
         os.environ["ASSET_API_SERV_ACCT"] = config["asset-api-serv-acct"]
     if not os.environ.get("LOGGING_API_SERV_ACCT"):
         os.environ["LOGGING_API_SERV_ACCT"] = config["logging-api-serv-acct"]
+    if not os.environ.get("ASSET_API_RPM") and config["asset-api-rpm"]:
+        os.environ["ASSET_API_RPM"] = str(config["asset-api-rpm"])
 
     subscriber = pubsub_v1.SubscriberClient()
     sub_path = subscriber.subscription_path(subscription_project, subscription_topic)
@@ -375,6 +406,16 @@ def get_config():
         ),
         required=False,
     )
+    parser.add_argument(
+        "--asset-api-rpm",
+        type=int,
+        help=(
+            "Optional: The maximum number of Asset API requests per minute. "
+            "Defaults to 90. "
+            "May also be provided in the ASSET_API_RPM environment variable. "
+        ),
+        required=False,
+    )
     parser.add_argument(
         "--logging-api-serv-acct",
         type=str,
@@ -399,6 +440,7 @@ def get_config():
         or os.environ.get("ASSET_API_SERV_ACCT"),
         "logging-api-serv-acct": args.asset_api_serv_acct
         or os.environ.get("LOGGING_API_SERV_ACCT"),
+        "asset-api-rpm": args.asset_api_rpm or os.environ.get("ASSET_API_RPM"),
     }
 
     if (
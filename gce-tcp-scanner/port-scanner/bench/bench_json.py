@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Benchmarks converting large synthetic nmap XML results to JSON: the
+previous approach of reading the file, parsing it whole with xmltodict and
+json.dumps-ing the result, against the streaming write_nmap_json. Checks that
+both produce identical output.
+
+Requires xmltodict, which port-scanner itself no longer needs.
+
+Usage: python3 bench/bench_json.py [--hosts 1000,10000]
+    [--filtered-ports 0] [--open-ports 4]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import xmltodict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_nmap import fake_ips, write_nmap_xml  # noqa: E402
+from nmapjson import write_nmap_json  # noqa: E402
+
+
+def xmltodict_json(xml_path, json_path, network):
+    with open(xml_path, "r") as f:
+        results = f.read()
+    results_json = xmltodict.parse(results, attr_prefix="", cdata_key="value")[
+        "nmaprun"
+    ]
+    results_json["network"] = network
+    with open(json_path, "w") as f:
+        f.write(json.dumps(results_json))
+
+
+def streaming_json(xml_path, json_path, network):
+    write_nmap_json(xml_path, json_path, extra={"network": network})
+
+
+def measure(name, func, *args):
+    # Timed separately, since tracing allocations slows parsing down a lot.
+    start = time.perf_counter()
+    func(*args)
+    secs = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<10} peak={peak / 2**20:8.1f} MiB  time={secs:6.2f}s")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=str, default="1000,10000")
+    parser.add_argument("--filtered-ports", type=int, default=0)
+    parser.add_argument("--open-ports", type=int, default=None)
+    args = parser.parse_args()
+
+    network = "projects/123456789/global/networks/default"
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, "results.xml")
+        for hosts in (int(h) for h in args.hosts.split(",")):
+            write_nmap_xml(
+                xml_path,
+                fake_ips(hosts),
+                open_ports=args.open_ports,
+                filtered_ports=args.filtered_ports,
+            )
+            print(f"hosts={hosts} xml={os.path.getsize(xml_path) / 2**20:.1f} MiB")
+            outputs = {}
+            for name, func in (
+                ("xmltodict", xmltodict_json),
+                ("streaming", streaming_json),
+            ):
+                outputs[name] = os.path.join(tmp, f"{name}.json")
+                measure(name, func, xml_path, outputs[name], network)
+            with open(outputs["xmltodict"]) as a, open(outputs["streaming"]) as b:
+                assert a.read() == b.read(), "outputs differ"
+            print("  outputs are identical")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Checks that two-phase scans using the fingerprint cache produce the same
+evaluate-scan hosts as version-scanning every open port, using synthetic nmap
+output from fake_nmap and a cache in a temporary directory.
+
+Runs a first scan that fills the cache, a repeat scan whose open ports are
+all cached (with nmap and masscan style discovery output), a scan where some
+instances restarted, scans of instances with no known start time, and a
+scan after every entry expired. Also checks that a save which raced another
+is rejected rather than overwriting it.
+
+Usage: python3 bench/check_fingerprints.py [--ips 500] [--restarted 0.1]
+"""
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from google.api_core.exceptions import PreconditionFailed
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_nmap import fake_ips, write_nmap_xml  # noqa: E402
+from fingerprints import (  # noqa: E402
+    FingerprintCache,
+    collect_fingerprints,
+    splice_cached_ports,
+)
+from nmapjson import compact_host, element_to_dict  # noqa: E402
+from twophase import parse_open_ports  # noqa: E402
+
+NETWORK = "projects/123456789/global/networks/default"
+STARTED = "2024-01-01T00:00:00.000-08:00"
+
+
+def open_hosts(path):
+    # The hosts evaluate-scan would get, by address.
+    hosts = {}
+    for host in ET.parse(path).getroot().findall("host"):
+        host = compact_host(element_to_dict(host))
+        if host:
+            hosts[host["address"]["addr"]] = host
+    return hosts
+
+
+def write_discovery(full_path, path, masscan=False):
+    # A discovery sweep finds the same open ports, without service results;
+    # masscan writes one host element per open port.
+    root = ET.parse(full_path).getroot()
+    for host in root.findall("host"):
+        ports = host.find("ports")
+        for port in ports.findall("port"):
+            port.remove(port.find("service"))
+        if masscan:
+            at = list(root).index(host)
+            for port in ports.findall("port")[1:]:
+                ports.remove(port)
+                extra = copy.deepcopy(host)
+                extra.find("ports").clear()
+                extra.find("ports").append(port)
+                at += 1
+                root.insert(at, extra)
+    ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def scan(cache, tmp, full_path, started, masscan=False):
+    """Runs the fingerprint cache steps of a two-phase scan, with the
+    version scan of each host given by full_path. Returns the number of
+    version-scanned ports and the result's open hosts.
+    """
+    discovery = os.path.join(tmp, "discovery.xml")
+    results = os.path.join(tmp, "results.xml")
+    write_discovery(full_path, discovery, masscan)
+    to_scan, cached = cache.split(
+        cache.load(NETWORK), parse_open_ports(discovery), started, 8
+    )
+    if to_scan:
+        # Stands in for nmap -sV on just the ports that weren't cached.
+        root = ET.parse(full_path).getroot()
+        for host in root.findall("host"):
+            if host.find("address").get("addr") not in to_scan:
+                root.remove(host)
+        ET.ElementTree(root).write(results, encoding="utf-8", xml_declaration=True)
+    else:
+        shutil.copyfile(discovery, results)
+    if cached:
+        splice_cached_ports(results, cached)
+    cache.save(NETWORK, collect_fingerprints(results, to_scan, started, 8))
+    return sum(len(p) for p in to_scan.values()), open_hosts(results)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ips", type=int, default=500)
+    parser.add_argument("--restarted", type=float, default=0.1)
+    args = parser.parse_args()
+
+    ips = fake_ips(args.ips)
+    started = {ip: STARTED for ip in ips}
+    with tempfile.TemporaryDirectory() as tmp:
+        full_path = os.path.join(tmp, "full.xml")
+        write_nmap_xml(full_path, ips)
+        expected = open_hosts(full_path)
+        total = sum(len(h["ports"]["port"]) for h in expected.values())
+        cache = FingerprintCache(path=os.path.join(tmp, "cache"))
+
+        probed, hosts = scan(cache, tmp, full_path, started)
+        assert probed == total and hosts == expected, "first scan differs"
+        print(f"first scan:     probed {probed:5} of {total} open ports, matches")
+
+        for masscan in (False, True):
+            start = time.perf_counter()
+            probed, hosts = scan(cache, tmp, full_path, started, masscan)
+            secs = time.perf_counter() - start
+            assert probed == 0 and hosts == expected, "cached scan differs"
+            print(
+                f"cached scan:    probed {probed:5} of {total} open ports, matches "
+                f"({'masscan' if masscan else 'nmap'} discovery, {secs:.2f}s)"
+            )
+
+        restarted = ips[: int(len(ips) * args.restarted)]
+        started.update({ip: "2024-02-01T00:00:00.000-08:00" for ip in restarted})
+        probed, hosts = scan(cache, tmp, full_path, started)
+        expected_probed = sum(
+            len(expected[ip]["ports"]["port"]) for ip in restarted if ip in expected
+        )
+        assert probed == expected_probed and hosts == expected, "restart differs"
+        print(f"restarted scan: probed {probed:5} of {total} open ports, matches")
+
+        for _ in range(2):
+            probed, hosts = scan(cache, tmp, full_path, dict.fromkeys(ips))
+            assert probed == total and hosts == expected, "unknown start differs"
+            print(f"unknown start:  probed {probed:5} of {total} open ports, matches")
+
+        # Another replica saves between this one's read and write.
+        entries, generation = cache._read(NETWORK)
+        FingerprintCache(path=cache.path).save(
+            NETWORK, {"9.9.9.9:22": {"time": time.time()}}
+        )
+        try:
+            cache._write(NETWORK, entries, generation)
+            raise AssertionError("a stale save overwrote a newer one")
+        except PreconditionFailed:
+            print("raced save:     rejected the stale write")
+
+        cache.ttl = 0
+        probed, hosts = scan(cache, tmp, full_path, started)
+        assert probed == total and hosts == expected, "expired scan differs"
+        print(f"expired scan:   probed {probed:5} of {total} open ports, matches")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Checks that scanning a job's IPs in parallel host groups and merging the
+nmap XML with merge_nmap_xml produces the same evaluate-scan JSON as a single
+nmap run over every IP, using synthetic nmap output from fake_nmap.
+
+Only timing (run and host start, finish and elapsed) may differ between the two.
+
+Usage: python3 bench/check_merge.py [--ips 1000] [--groups 1,2,3,8]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import xmltodict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_nmap import fake_ips, write_nmap_xml  # noqa: E402
+from nmapxml import merge_nmap_xml, split_host_groups  # noqa: E402
+
+
+def to_json(path):
+    with open(path) as f:
+        results_json = xmltodict.parse(f.read(), attr_prefix="", cdata_key="value")
+    results_json = results_json["nmaprun"]
+    # Timing legitimately differs between one run and several parallel ones.
+    results_json["runstats"]["finished"] = {
+        k: v
+        for k, v in results_json["runstats"]["finished"].items()
+        if k not in ("time", "timestr", "elapsed", "summary")
+    }
+    for key in ("args", "start", "startstr"):
+        results_json.pop(key)
+    hosts = results_json.get("host", [])
+    for host in hosts if isinstance(hosts, list) else [hosts]:
+        host.pop("starttime")
+        host.pop("endtime")
+    return results_json
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ips", type=int, default=1000)
+    parser.add_argument("--groups", type=str, default="1,2,3,8")
+    args = parser.parse_args()
+
+    ips = fake_ips(args.ips)
+    with tempfile.TemporaryDirectory() as tmp:
+        single = os.path.join(tmp, "single.xml")
+        write_nmap_xml(single, ips)
+        expected = to_json(single)
+        for groups in (int(g) for g in args.groups.split(",")):
+            paths = []
+            for i, group in enumerate(split_host_groups(ips, groups)):
+                paths.append(os.path.join(tmp, f"group.{i}.xml"))
+                # Later groups start later, as parallel runs would.
+                write_nmap_xml(paths[-1], group, start=1700000000 + i)
+            merged = os.path.join(tmp, "merged.xml")
+            start = time.perf_counter()
+            merge_nmap_xml(paths, merged)
+            secs = time.perf_counter() - start
+            assert to_json(merged) == expected, f"{groups} groups: outputs differ"
+            print(f"groups={groups:<3} merge={secs:6.3f}s  merged output matches")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Checks that a journaled nmap run interrupted one or more times and then
+resumed with nmap --resume ends up with the same hosts as an uninterrupted
+run, using synthetic nmap output from fake_nmap.
+
+Each interruption cuts the run's -oX output off partway through a host, as
+killing nmap does, with an -oG log of the hosts it finished. The resumed run
+stands in for nmap --resume, scanning the hosts after the last logged one.
+
+Usage: python3 bench/check_resume.py [--ips 500] [--interruptions 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_nmap import fake_ips, iter_nmap_xml  # noqa: E402
+from journal import finish_resume, resume_args  # noqa: E402
+
+
+def host_addresses(path):
+    return [
+        host.find("address").get("addr")
+        for host in ET.parse(path).getroot().findall("host")
+    ]
+
+
+def interrupted_run(xml_path, gnmap_path, args, ips, rng):
+    # Scans ips, writing to the outputs in args, until killed partway
+    # through a random host. Returns the hosts it finished.
+    chunks = list(iter_nmap_xml(ips))
+    finished = rng.randrange(len(ips))
+    with open(xml_path, "w") as f:
+        f.write("".join(chunks[: finished + 1]))
+        cut = chunks[finished + 1]
+        f.write(cut[: rng.randrange(1, len(cut))])
+    with open(gnmap_path, "a") as f:
+        f.write(f"# Nmap 7.93 scan initiated as: {' '.join(args)}\n")
+        for ip in ips[:finished]:
+            f.write(f"Host: {ip} ()\tStatus: Up\n")
+    return ips[:finished]
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ips", type=int, default=500)
+    parser.add_argument("--interruptions", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ips = fake_ips(args.ips)
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, "results.0.xml")
+        gnmap_path = os.path.join(tmp, "results.0.gnmap")
+        command = ["nmap", "-p", "1-65535", "-oG", gnmap_path, "-oX", xml_path] + ips
+
+        todo = ips
+        for attempt in range(1, args.interruptions + 2):
+            to_run = resume_args(command, attempt)
+            expected = ["nmap", "--resume", gnmap_path] if attempt > 1 else command
+            assert to_run == expected, f"attempt {attempt} runs {to_run}"
+            if attempt <= args.interruptions:
+                done = interrupted_run(xml_path, gnmap_path, command, todo, rng)
+                todo = todo[len(done) :]
+                print(f"attempt {attempt}: interrupted after {len(done):4} hosts")
+        with open(xml_path, "w") as f:
+            f.write("".join(iter_nmap_xml(todo)))
+        print(f"attempt {attempt}: resumed and scanned {len(todo):4} hosts")
+
+        start = time.perf_counter()
+        finish_resume(command)
+        secs = time.perf_counter() - start
+        hosts = host_addresses(xml_path)
+        assert sorted(hosts) == sorted(ips), "resumed hosts differ"
+        assert not [name for name in os.listdir(tmp) if ".attempt-" in name]
+        print(f"merged {len(hosts)} hosts, matches ({secs:.2f}s)")
+
+
+if __name__ == "__main__":
+    run()
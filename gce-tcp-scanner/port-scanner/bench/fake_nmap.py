@@ -0,0 +1,107 @@
+"""Generates synthetic nmap XML output (-oX) shaped like a real nmap 7.93
+-sS -sV run, for exercising result handling without running nmap.
+
+Each host's element is derived only from its IP and the seed, so the output
+for a host is the same whichever group of hosts it is scanned with.
+"""
+
+import random
+from xml.sax.saxutils import quoteattr
+
+SERVICES = [
+    ("22", "ssh", "OpenSSH", "8.9p1 Ubuntu 3ubuntu0.6", "cpe:/a:openbsd:openssh:8.9p1"),
+    ("80", "http", "nginx", "1.18.0", "cpe:/a:igor_sysoev:nginx:1.18.0"),
+    ("443", "https", "nginx", "1.18.0", "cpe:/a:igor_sysoev:nginx:1.18.0"),
+    ("3306", "mysql", "MySQL", "8.0.36", "cpe:/a:mysql:mysql:8.0.36"),
+    ("5432", "postgresql", "PostgreSQL DB", "9.6.0 or later", None),
+    ("8888", "http", "Tornado httpd", "6.1", "cpe:/a:tornadoweb:tornado:6.1"),
+]
+
+
+def host_xml(ip, seed=0, start=1700000000, open_ports=None, filtered_ports=0):
+    """Returns the <host> element for one scanned IP."""
+    rng = random.Random(f"{seed}-{ip}")
+    open_ports = rng.randint(0, 4) if open_ports is None else open_ports
+    lines = [
+        f'<host starttime="{start}" endtime="{start + rng.randint(10, 600)}">'
+        '<status state="up" reason="user-set" reason_ttl="0"/>',
+        f'<address addr="{ip}" addrtype="ipv4"/>',
+        "<hostnames>",
+        f'<hostname name="{ip.replace(".", "-")}.bc.googleusercontent.com" '
+        'type="PTR"/>',
+        "</hostnames>",
+        "<ports>",
+    ]
+    if filtered_ports:
+        lines.append(
+            f'<extraports state="filtered" count="{filtered_ports}">'
+            f'<extrareasons reason="no-response" count="{filtered_ports}" '
+            'proto="tcp" ports="1-21,23-79"/></extraports>'
+        )
+    used = set()
+    for _ in range(open_ports):
+        if rng.random() < 0.7:
+            portid, name, product, version, cpe = rng.choice(SERVICES)
+        else:
+            portid = str(rng.randint(1024, 65535))
+            name, product, version, cpe = "unknown", None, None, None
+        if portid in used:
+            continue
+        used.add(portid)
+        service = f'<service name="{name}"'
+        if product:
+            service += f" product={quoteattr(product)} version={quoteattr(version)}"
+            service += ' method="probed" conf="10">'
+            service += f"<cpe>{cpe}</cpe></service>" if cpe else "</service>"
+        else:
+            service += ' method="table" conf="3"/>'
+        lines.append(
+            f'<port protocol="tcp" portid="{portid}">'
+            '<state state="open" reason="syn-ack" reason_ttl="58"/>'
+            f"{service}</port>"
+        )
+    lines += [
+        "</ports>",
+        f'<times srtt="{rng.randint(500, 90000)}" rttvar="{rng.randint(100, 9000)}" '
+        'to="100000"/>',
+        "</host>",
+    ]
+    return "\n".join(lines)
+
+
+def iter_nmap_xml(ips, ports="1-65535", seed=0, start=1700000000, **host_kwargs):
+    """Yields the chunks of a complete nmaprun document scanning the given IPs,
+    so large documents can be written without building them in memory.
+    """
+    args = f"nmap -p {ports} -Pn -T4 -sS -sV -oX results.xml {' '.join(ips)}"
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        "<!DOCTYPE nmaprun>\n"
+        '<?xml-stylesheet href="file:///usr/bin/../share/nmap/nmap.xsl" '
+        'type="text/xsl"?>\n'
+        f'<nmaprun scanner="nmap" args={quoteattr(args)} start="{start}" '
+        f'startstr="Tue Nov 14 22:13:20 2023" version="7.93" xmloutputversion="1.05">\n'
+        f'<scaninfo type="syn" protocol="tcp" numservices="65535" services="{ports}"/>\n'
+        '<verbose level="0"/>\n<debugging level="0"/>\n'
+    )
+    for ip in ips:
+        yield host_xml(ip, seed, start, **host_kwargs) + "\n"
+    end = start + 3600
+    yield (
+        f'<runstats><finished time="{end}" timestr="Tue Nov 14 23:13:20 2023" '
+        f'summary="Nmap done at Tue Nov 14 23:13:20 2023; {len(ips)} IP addresses '
+        f'({len(ips)} hosts up) scanned in 3600.00 seconds" elapsed="3600.00" '
+        'exit="success"/>'
+        f'<hosts up="{len(ips)}" down="0" total="{len(ips)}"/>\n'
+        "</runstats>\n</nmaprun>\n"
+    )
+
+
+def write_nmap_xml(path, ips, **kwargs):
+    with open(path, "w") as f:
+        for chunk in iter_nmap_xml(ips, **kwargs):
+            f.write(chunk)
+
+
+def fake_ips(count, prefix="34.1"):
+    return [f"{prefix}.{i >> 8 & 255}.{i & 255}" for i in range(count)]
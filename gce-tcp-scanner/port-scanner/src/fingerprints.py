@@ -0,0 +1,310 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# Bump when the shape of a cache entry changes, so entries written by an older
+# release are ignored instead of spliced into results.
+FINGERPRINT_CACHE_VERSION = 1
+DEFAULT_FINGERPRINT_TTL_HOURS = 168
+# Replicas scanning units of the same network may save its cache at once; a
+# save that loses the race re-reads the cache and tries again.
+SAVE_ATTEMPTS = 5
+
+
+def _key(ip, port):
+    return f"{ip}:{port}"
+
+
+class FingerprintCache:
+    """Remembers the nmap -sV result of each open IP:port, so two-phase scans
+    only version-probe ports that are new or whose cached result is stale.
+
+    Each network's entries are kept in one gzipped JSON file, named after the
+    network, in the local directory path or under prefix in gcs_bucket (a
+    google.cloud.storage Bucket). An entry is used for at most ttl_hours
+    after it was probed, only while its instance's lastStartTimestamp is
+    unchanged, and only for scans at the same or a lower version intensity.
+
+    An entry looks like:
+    {
+        "1.2.3.4:443": {
+            "time": 1704067200,
+            "started": "2024-01-01T00:00:00.000-08:00",
+            "intensity": 8,
+            "port": "<port protocol=\\"tcp\\" portid=\\"443\\">...</port>",
+            "hostnames": "<hostnames>...</hostnames>"
+        }
+    }
+    """
+
+    def __init__(
+        self,
+        path=None,
+        gcs_bucket=None,
+        prefix="fingerprints",
+        ttl_hours=DEFAULT_FINGERPRINT_TTL_HOURS,
+    ):
+        self.path = path
+        self.gcs_bucket = gcs_bucket
+        self.prefix = prefix.strip("/")
+        self.ttl = ttl_hours * 3600
+        self._lock = threading.Lock()
+
+    def _name(self, network):
+        return ".".join(network.split("/")[-5:]) + ".json.gz"
+
+    def location(self, network):
+        if self.path:
+            return os.path.join(self.path, self._name(network))
+        return f"gs://{self.gcs_bucket.name}/{self.prefix}/{self._name(network)}"
+
+    def _read(self, network):
+        # Returns the network's entries and the generation they were read at:
+        # the blob's generation in GCS, or a hash of the file's contents
+        # locally (0 if there is no cache yet). A cache that can't be decoded
+        # or has another version reads as empty at its generation, so it is
+        # replaced only if no one else has written it since.
+        try:
+            if self.path:
+                with open(self.location(network), "rb") as f:
+                    data = f.read()
+                generation = hashlib.sha1(data).hexdigest()
+            else:
+                blob = self.gcs_bucket.get_blob(f"{self.prefix}/{self._name(network)}")
+                if blob is None:
+                    return {}, 0
+                generation = blob.generation
+                data = blob.download_as_bytes(if_generation_match=generation)
+        except (FileNotFoundError, NotFound):
+            return {}, 0
+        try:
+            state = json.loads(gzip.decompress(data))
+        except Exception as e:
+            print(
+                "WARNING: Ignoring corrupt fingerprint cache at "
+                f"{self.location(network)}: {e}"
+            )
+            return {}, generation
+        if state.get("version") != FINGERPRINT_CACHE_VERSION:
+            return {}, generation
+        return state["entries"], generation
+
+    def _local_generation(self, network):
+        try:
+            with open(self.location(network), "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except FileNotFoundError:
+            return 0
+
+    def _write(self, network, entries, generation):
+        data = gzip.compress(
+            json.dumps(
+                {"version": FINGERPRINT_CACHE_VERSION, "entries": entries}
+            ).encode("utf-8")
+        )
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            # Processes sharing the directory check and replace the cache under
+            # a file lock, so one can't overwrite entries another saved since
+            # it read them.
+            with open(f"{self.location(network)}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if self._local_generation(network) != generation:
+                    raise PreconditionFailed(f"{self.location(network)} changed")
+                # Write then rename, so a kill mid-write leaves the old cache.
+                with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as f:
+                    f.write(data)
+                os.replace(f.name, self.location(network))
+        else:
+            self.gcs_bucket.blob(
+                f"{self.prefix}/{self._name(network)}"
+            ).upload_from_string(
+                data,
+                content_type="application/gzip",
+                if_generation_match=generation,
+            )
+
+    def _fresh(self, entries, now):
+        return {
+            key: entry
+            for key, entry in entries.items()
+            if now - entry["time"] < self.ttl
+        }
+
+    def load(self, network):
+        """Returns the network's unexpired entries, or none if the cache
+        can't be read.
+        """
+        try:
+            entries, _ = self._read(network)
+        except Exception as e:
+            print(f"No fingerprint cache loaded from {self.location(network)}: {e}")
+            return {}
+        return self._fresh(entries, time.time())
+
+    def split(self, entries, open_ports, started, intensity):
+        """Splits the open ports found by a discovery sweep (as from
+        twophase.parse_open_ports) into those that still need a version scan
+        and those with a usable cache entry. started maps IPs to their
+        instance's lastStartTimestamp, from the scan message. Entries for
+        IPs without a known start time are treated as stale, since a restart
+        can't be ruled out.
+
+        The output looks like:
+        (
+            {"1.2.3.4": ["8080"]},
+            {"1.2.3.4": [<cache entry for 443>], "4.4.4.4": [<cache entry for 22>]},
+        )
+        """
+        to_scan = {}
+        cached = {}
+        for ip, ports in open_ports.items():
+            for port in ports:
+                entry = entries.get(_key(ip, port))
+                if (
+                    entry is not None
+                    and entry["started"] is not None
+                    and entry["started"] == started.get(ip)
+                    and entry["intensity"] >= intensity
+                ):
+                    cached.setdefault(ip, []).append(entry)
+                else:
+                    to_scan.setdefault(ip, []).append(port)
+        return to_scan, cached
+
+    def save(self, network, updates):
+        """Adds new entries (as from collect_fingerprints) to the network's
+        cache and drops expired ones. Concurrent saves of the same network
+        are merged rather than overwritten. If the cache can't be read, the
+        updates aren't saved, rather than overwriting its other entries.
+        """
+        if not updates:
+            return
+        for _ in range(SAVE_ATTEMPTS):
+            with self._lock:
+                try:
+                    entries, generation = self._read(network)
+                except Exception as e:
+                    print(
+                        "WARNING: Not saving fingerprints; could not read the "
+                        f"cache at {self.location(network)}: {e}"
+                    )
+                    return
+                entries.update(updates)
+                try:
+                    self._write(network, self._fresh(entries, time.time()), generation)
+                    return
+                except PreconditionFailed:
+                    print(
+                        f"Fingerprint cache at {self.location(network)} changed "
+                        "while saving; retrying."
+                    )
+        print(
+            f"WARNING: Gave up saving fingerprint cache at {self.location(network)} "
+            f"after {SAVE_ATTEMPTS} attempts."
+        )
+
+
+def _host_ip(host):
+    for address in host.findall("address"):
+        if address.get("addrtype") in ("ipv4", "ipv6"):
+            return address.get("addr")
+    return None
+
+
+def splice_cached_ports(path, cached):
+    """Adds the cached port results of each IP (as from FingerprintCache.split)
+    to the nmap XML at path, in place, as if nmap had just probed them.
+
+    A host's cached ports replace any of its ports with the same number (e.g.
+    from a discovery sweep), and hosts listed more than once (masscan writes
+    one per open port) are collapsed into the first. IPs with no host in the
+    XML get one built from their cached entries, counted in its runstats.
+    """
+    root = ET.parse(path).getroot()
+    hosts = {}
+    for host in root.findall("host"):
+        ip = _host_ip(host)
+        if ip not in hosts:
+            hosts[ip] = host
+            continue
+        # A duplicate host: move its ports into the first one.
+        first_ports = hosts[ip].find("ports")
+        if first_ports is None:
+            first_ports = ET.SubElement(hosts[ip], "ports")
+        for port in host.iter("port"):
+            first_ports.append(port)
+        root.remove(host)
+
+    runstats = root.find("runstats")
+    insert_at = list(root).index(runstats) if runstats is not None else len(root)
+    added = 0
+    for ip, ip_entries in cached.items():
+        host = hosts.get(ip)
+        if host is None:
+            host = ET.Element("host")
+            ET.SubElement(host, "status", state="up", reason="cached")
+            ET.SubElement(host, "address", addr=ip, addrtype="ipv4")
+            host.append(ET.fromstring(ip_entries[0]["hostnames"]))
+            root.insert(insert_at, host)
+            insert_at += 1
+            added += 1
+        ports = host.find("ports")
+        if ports is None:
+            ports = ET.SubElement(host, "ports")
+        for entry in ip_entries:
+            port = ET.fromstring(entry["port"])
+            for existing in ports.findall("port"):
+                if existing.get("portid") == port.get("portid"):
+                    ports.remove(existing)
+            ports.append(port)
+
+    if added and runstats is not None and runstats.find("hosts") is not None:
+        counts = runstats.find("hosts")
+        for key in ("up", "total"):
+            counts.set(key, str(int(counts.get(key, 0)) + added))
+    ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def collect_fingerprints(path, scanned, started, intensity):
+    """Returns cache entries for the ports in scanned (IPs to the ports that
+    were just version-scanned, as from FingerprintCache.split) that are open
+    and have a service result in the nmap XML at path. Ports spliced in from
+    the cache aren't in scanned, so their entries keep their original time.
+    """
+    now = int(time.time())
+    entries = {}
+    for _, host in ET.iterparse(path):
+        if host.tag != "host":
+            continue
+        ip = _host_ip(host)
+        hostnames = host.find("hostnames")
+        for port in host.iter("port"):
+            state = port.find("state")
+            if (
+                state is None
+                or state.get("state") != "open"
+                or port.find("service") is None
+                or port.get("portid") not in scanned.get(ip, ())
+            ):
+                continue
+            entries[_key(ip, port.get("portid"))] = {
+                "time": now,
+                "started": started.get(ip),
+                "intensity": intensity,
+                "port": ET.tostring(port, encoding="unicode").strip(),
+                "hostnames": ET.tostring(
+                    hostnames if hostnames is not None else ET.Element("hostnames"),
+                    encoding="unicode",
+                ).strip(),
+            }
+        host.clear()
+    return entries
@@ -1,8 +1,10 @@
+import json
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
 
 class HealthHandler(BaseHTTPRequestHandler):
     ready = False  # Shared readiness flag
+    status = None  # Optional function returning a JSON-able status for /status
 
     def log_message(self, format, *args):
         return  # Suppress logging
@@ -12,6 +14,14 @@ class HealthHandler(BaseHTTPRequestHandler):
             self.send_response(200 if HealthHandler.ready else 503)
         elif self.path == "/health":
             self.send_response(200)
+        elif self.path == "/status" and HealthHandler.status:
+            body = json.dumps(HealthHandler.status()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         else:
             self.send_response(404)
         self.end_headers()
@@ -24,3 +34,8 @@ def run_health_server():
 
 def set_ready(state: bool):
     HealthHandler.ready = state
+
+
+def set_status(status):
+    """Serves status(), e.g. the progress of running jobs, at /status."""
+    HealthHandler.status = staticmethod(status)
@@ -0,0 +1,261 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+
+from nmapxml import merge_nmap_xml, salvage_nmap_xml
+
+JOURNAL_FILE = "journal.json"
+# Bump when the journal's shape changes, so jobs journaled by an older release
+# start over instead of resuming from state this one can't read.
+JOURNAL_VERSION = 1
+DEFAULT_JOURNAL_SYNC_MINUTES = 5
+
+
+class ScanInterrupted(Exception):
+    """Raised when a journaled scan is stopped, e.g. because the pod is being
+    preempted, so it can be resumed when its message is redelivered.
+    """
+
+
+class JobJournal:
+    """A durable record of a scan job, kept in the job's directory next to
+    its nmap output, so a job interrupted by a crash or preemption resumes
+    where it stopped when Pub/Sub redelivers its message.
+
+    The journal holds the job's network, the date its results are filed
+    under, the plan chosen for it (nmap commands, profile and fingerprint
+    cache split) and which of the plan's runs have finished. With a
+    gcs_bucket (a google.cloud.storage Bucket), the directory is also synced
+    to prefix/<job id>/ in it at most every sync_interval seconds and
+    whenever a run finishes, so a job can be resumed on another pod.
+    Otherwise job directories must be on a volume that survives restarts.
+    """
+
+    def __init__(
+        self,
+        job_dir,
+        job_id,
+        gcs_bucket=None,
+        prefix="jobs",
+        sync_interval=DEFAULT_JOURNAL_SYNC_MINUTES * 60,
+    ):
+        self.job_dir = job_dir
+        self.job_id = job_id
+        self.gcs_bucket = gcs_bucket
+        self.prefix = f"{prefix.strip('/')}/{job_id}"
+        self.sync_interval = sync_interval
+        self.state = {"version": JOURNAL_VERSION, "attempt": 0, "done": []}
+        self._synced = {}
+        self._lock = threading.Lock()
+        self._stop_autosync = threading.Event()
+
+    def location(self):
+        if self.gcs_bucket is not None:
+            return f"gs://{self.gcs_bucket.name}/{self.prefix}/"
+        return self.job_dir
+
+    def load(self):
+        """Loads the job's journal, restoring its directory from GCS if it
+        isn't on this pod, and counts this as a new attempt. Returns True if
+        an earlier attempt is being resumed.
+        """
+        path = os.path.join(self.job_dir, JOURNAL_FILE)
+        if not os.path.exists(path) and self.gcs_bucket is not None:
+            self._restore()
+        state = None
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"WARNING: Starting over; unreadable job journal {path}: {e}")
+        if state and state.get("version") == JOURNAL_VERSION:
+            self.state = state
+        self.state["attempt"] += 1
+        self.save()
+        return self.state["attempt"] > 1
+
+    def _restore(self):
+        os.makedirs(self.job_dir, exist_ok=True)
+        restored = 0
+        for blob in self.gcs_bucket.list_blobs(prefix=f"{self.prefix}/"):
+            name = os.path.basename(blob.name)
+            blob.download_to_filename(os.path.join(self.job_dir, name))
+            self._synced[name] = blob.size
+            restored += 1
+        if restored:
+            print(f"Restored {restored} job files from {self.location()}")
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, **values):
+        """Records values (e.g. the job's plan) and saves the journal."""
+        self.state.update(values)
+        self.save(sync=True)
+
+    def run_done(self, run):
+        return run in self.state["done"]
+
+    def finish_run(self, run):
+        with self._lock:
+            self.state["done"].append(run)
+        self.save(sync=True)
+
+    def save(self, sync=False):
+        with self._lock:
+            os.makedirs(self.job_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.job_dir, suffix=".tmp", delete=False
+            ) as f:
+                json.dump(self.state, f)
+            os.replace(f.name, os.path.join(self.job_dir, JOURNAL_FILE))
+        if sync:
+            self.sync()
+
+    def sync(self):
+        """Uploads the job's files that changed since they were last synced,
+        and deletes those removed since, if the journal is kept in GCS. nmap
+        output is uploaded as it is, which may be mid-write; resuming only
+        relies on complete lines of -oG logs and complete hosts of -oX output.
+        """
+        if self.gcs_bucket is None:
+            return
+        with self._lock:
+            names = set(os.listdir(self.job_dir))
+            for name in [name for name in self._synced if name not in names]:
+                self.gcs_bucket.blob(f"{self.prefix}/{name}").delete()
+                del self._synced[name]
+            for name in sorted(names):
+                path = os.path.join(self.job_dir, name)
+                if name.endswith(".tmp") or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                if self._synced.get(name) == size and name != JOURNAL_FILE:
+                    continue
+                self.gcs_bucket.blob(f"{self.prefix}/{name}").upload_from_filename(path)
+                self._synced[name] = size
+
+    def start_autosync(self):
+        """Syncs the job every sync_interval seconds until the job ends."""
+        if self.gcs_bucket is None:
+            return
+
+        def autosync():
+            while not self._stop_autosync.wait(self.sync_interval):
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"WARNING: Could not sync job to {self.location()}: {e}")
+
+        threading.Thread(target=autosync, daemon=True).start()
+
+    def stop_autosync(self):
+        self._stop_autosync.set()
+
+    def clear(self):
+        """Deletes the job's synced files once its results are published."""
+        self.stop_autosync()
+        if self.gcs_bucket is None:
+            return
+        for blob in self.gcs_bucket.list_blobs(prefix=f"{self.prefix}/"):
+            try:
+                blob.delete()
+            except Exception as e:
+                print(f"Could not delete {blob.name}: {e}")
+
+
+def _output_path(args, option):
+    return args[args.index(option) + 1] if option in args else None
+
+
+def _log_status(gnmap_path):
+    # Returns "done" if the -oG log says nmap finished, "partial" if it has
+    # hosts to resume after, or None.
+    try:
+        with open(gnmap_path, errors="replace") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    if any(line.startswith("# Nmap done") for line in lines):
+        return "done"
+    if any(line.startswith("Host: ") for line in lines):
+        return "partial"
+    return None
+
+
+def resume_args(args, attempt):
+    """Returns the command to run for an nmap run that may have been
+    interrupted by an earlier attempt: nothing (None) if its -oG log says it
+    finished, nmap --resume on that log if it got partway, or args to start
+    over. Partial -oX output is moved aside first, to be merged back by
+    finish_resume.
+    """
+    gnmap_path = _output_path(args, "-oG")
+    xml_path = _output_path(args, "-oX")
+    status = _log_status(gnmap_path) if gnmap_path else None
+    if status == "done":
+        return None
+    if os.path.exists(xml_path):
+        os.replace(xml_path, f"{xml_path}.attempt-{attempt - 1}")
+    if status == "partial":
+        return ["nmap", "--resume", gnmap_path]
+    if gnmap_path and os.path.exists(gnmap_path):
+        os.remove(gnmap_path)
+    return args
+
+
+def discard_resume(args):
+    """Removes an nmap run's -oG log and any -oX output, including that of
+    interrupted attempts, so it can be run again from the start.
+    """
+    xml_path = _output_path(args, "-oX")
+    directory = os.path.dirname(xml_path) or "."
+    paths = [_output_path(args, "-oG"), xml_path] + [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(f"{os.path.basename(xml_path)}.attempt-")
+    ]
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def finish_resume(args):
+    """Merges the complete hosts of an nmap run's earlier, interrupted -oX
+    output back into its final output, for hosts the final run didn't scan
+    again.
+    """
+    xml_path = _output_path(args, "-oX")
+    directory = os.path.dirname(xml_path) or "."
+    prefix = f"{os.path.basename(xml_path)}.attempt-"
+    partials = sorted(
+        (
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.startswith(prefix) and name[len(prefix) :].isdigit()
+        ),
+        key=lambda path: int(path.rsplit("-", 1)[1]),
+    )
+    if not partials:
+        return
+    resumed = f"{xml_path}.resumed"
+    shutil.move(xml_path, resumed)
+    scanned = {
+        address.get("addr")
+        for address in ET.parse(resumed).getroot().iter("address")
+        if address.get("addrtype") in ("ipv4", "ipv6")
+    }
+    salvaged = []
+    for partial in reversed(partials):
+        out = f"{partial}.salvaged"
+        scanned |= salvage_nmap_xml(partial, out, exclude=scanned)
+        salvaged.append(out)
+    merge_nmap_xml([resumed] + salvaged, xml_path)
+    for path in partials + salvaged + [resumed]:
+        os.remove(path)
+    print(f"Merged hosts from {len(partials)} interrupted runs into {xml_path}")
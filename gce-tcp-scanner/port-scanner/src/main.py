@@ -1,101 +1,457 @@
 import sys
 import argparse
 import os
+import gzip
 import json
+import shutil
+import signal
+import tempfile
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-import xmltodict
+from functools import partial
 
-# import time
+import time
 
-import subprocess
 from google.cloud import pubsub_v1
-from bibt.gcp import storage
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 from bibt.gcp import pubsub
+from fingerprints import (
+    DEFAULT_FINGERPRINT_TTL_HOURS,
+    FingerprintCache,
+    collect_fingerprints,
+    splice_cached_ports,
+)
+from gcpclients import get_client
+from healthcheck import run_health_server, set_ready, set_status
+from journal import (
+    DEFAULT_JOURNAL_SYNC_MINUTES,
+    JobJournal,
+    ScanInterrupted,
+    discard_resume,
+    finish_resume,
+    resume_args,
+)
+from nmapjson import compact_host, compact_result_messages, write_nmap_json
+from nmapxml import merge_nmap_xml, split_host_groups
+from profiles import DurationHistory, profile_args
+from progress import (
+    end_job,
+    jobs_status,
+    run_with_progress,
+    soonest_finish,
+    start_job,
+    stop_jobs,
+)
+from scancost import (
+    DEFAULT_JOB_DEADLINE_HOURS,
+    DEFAULT_PROFILES,
+    count_ports,
+    load_profiles,
+    select_profile,
+)
+from twophase import (
+    DEFAULT_DISCOVERY_RATE,
+    DISCOVERY_SCANNERS,
+    discovery_args,
+    group_by_open_ports,
+    parse_open_ports,
+)
+from uploads import TeeReader, get_storage_client, upload_all
 
-# from bibt.gcp import storage
-from healthcheck import run_health_server, set_ready
+DEFAULT_MAX_CONCURRENT_SCANS = 2
+# In two-phase mode, hosts are version-scanned in at most this many nmap runs
+# per process, so hosts with different open ports don't each get their own.
+MAX_VERSION_SCANS_PER_PROCESS = 4
+# Compact result messages are split to stay well under Pub/Sub's 10 MB limit.
+MAX_RESULT_MESSAGE_BYTES = 8 * 2**20
+DEFAULT_MAX_HOLD_MINUTES = 30
+# How often a message waiting for a scan slot re-checks whether to keep it.
+HOLD_CHECK_SECONDS = 10
+# With a job journal, messages stay unacked while they are scanned; their
+# leases are extended for up to this long before Pub/Sub redelivers them.
+MAX_JOURNALED_JOB_HOURS = 24
 
+# The number of scans currently running, reported while draining on shutdown.
+_active_scans = 0
+_active_scans_lock = threading.Lock()
 
-def nmap_host(message):
+
+# Set once the process is shutting down, so held messages are released.
+_draining = threading.Event()
+
+
+def _track_scan(delta):
+    global _active_scans
+    with _active_scans_lock:
+        _active_scans += delta
+        return _active_scans
+
+
+def _command_pairs(args):
+    # The IP-port pairs an nmap command scans; its targets follow -oX <file>.
+    targets = args[args.index("-oX") + 2 :]
+    return count_ports(args[args.index("-p") + 1].split(",")) * len(targets)
+
+
+def _run_journaled(commands, run, job, journal):
+    # Runs one of a journaled job's nmap commands, unless an earlier attempt
+    # finished it, resuming it if an earlier attempt got partway.
+    args = commands[run]
+    if journal.run_done(run):
+        job.finish(run)
+        return
+    if _draining.is_set():
+        raise ScanInterrupted(f"Not starting nmap run {run} while draining")
+    to_run = resume_args(args, journal.get("attempt"))
+    if to_run is not None:
+        if to_run is not args:
+            print(f"Resuming command: {' '.join(to_run)}")
+        returncode = run_with_progress(to_run, job, run).returncode
+        if returncode and _draining.is_set():
+            raise ScanInterrupted(f"nmap run {run} was stopped while draining")
+        if returncode and to_run is not args:
+            print(
+                f"WARNING: nmap --resume exited with {returncode}; "
+                f"running command {run} from the start."
+            )
+            discard_resume(args)
+            run_with_progress(args, job, run)
+    finish_resume(args)
+    journal.finish_run(run)
+
+
+def run_nmap(commands, results_outfile, processes=1, job=None, journal=None):
+    """Runs nmap commands, at most processes at a time, reporting their
+    progress to job (a progress.JobProgress). If there is more than one,
+    their -oX outputs are merged into results_outfile as if a single nmap
+    had scanned every host.
+
+    With a journal (a journal.JobJournal), runs an earlier attempt at the job
+    finished are skipped, runs it left unfinished are resumed from their -oG
+    logs with nmap --resume, and each run is recorded once it finishes.
+    Raises ScanInterrupted if the process starts draining before every run
+    has finished.
+    """
+    for args in commands:
+        print(f"Running command: {' '.join(args)}")
+    if job is not None:
+        job.start_phase(
+            "scan", {i: _command_pairs(args) for i, args in enumerate(commands)}
+        )
+
+    def run(i):
+        if journal is not None:
+            _run_journaled(commands, i, job, journal)
+        else:
+            run_with_progress(commands[i], job, i)
+
+    if (
+        len(commands) == 1
+        and commands[0][commands[0].index("-oX") + 1] == results_outfile
+    ):
+        run(0)
+        return
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(processes, len(commands)))
+    ) as executor:
+        list(executor.map(run, range(len(commands))))
+    merge_nmap_xml([args[args.index("-oX") + 1] for args in commands], results_outfile)
+
+
+def nmap_host(
+    message,
+    work_dir="/tmp",
+    processes=1,
+    two_phase="off",
+    discovery_scanner="nmap",
+    discovery_rate=DEFAULT_DISCOVERY_RATE,
+    result_format="full",
+    fingerprint_cache=None,
+    profiles=DEFAULT_PROFILES,
+    job_deadline=DEFAULT_JOB_DEADLINE_HOURS * 3600,
+    duration_history=None,
+    journal_mode="off",
+    journal_bucket=None,
+    journal_sync_minutes=DEFAULT_JOURNAL_SYNC_MINUTES,
+):
+    """Runs the nmap scan described by a Pub/Sub message, uploads its results
+    to GCS and forwards them to evaluate-scan.
+
+    Each scan gets its own working directory under work_dir, removed when the
+    scan finishes, so concurrent scans of the same network don't collide.
+
+    With journal_mode "off", the message is acked as the scan starts, so a
+    scan cut short by a crash or preemption is lost. With "local" or "gcs",
+    the scan keeps a journal.JobJournal in its working directory (named
+    after the message, so redeliveries find it), synced to journal_bucket
+    every journal_sync_minutes with "gcs". The message is only acked once
+    the results are uploaded and published; a scan that fails or is
+    interrupted by draining nacks it, and its redelivery resumes from the
+    journal instead of starting over.
+    With more than one process, the IPs are split into that many host groups
+    that are scanned by parallel nmap runs.
+
+    The nmap timing, version intensity, retries, rate and host group size come
+    from the most thorough of profiles (see scancost.DEFAULT_PROFILES)
+    expected to finish the job's IP-port pairs within job_deadline seconds,
+    scaled by the network's slowness in duration_history (a
+    profiles.DurationHistory), which each finished scan updates.
+
+    two_phase is "off", "full-range" (only for 1-65535 jobs) or "always". In
+    two-phase mode, a rate-limited discovery sweep by discovery_scanner finds
+    open ports first, and nmap -sV only scans those, up to processes runs at a
+    time, with a profile chosen for the open ports found. With a
+    fingerprint_cache (a fingerprints.FingerprintCache), open ports with a
+    usable cached -sV result aren't version-scanned again; their cached
+    results are spliced into the scan's output instead.
+
+    result_format is "compact" to send evaluate-scan only the hosts with open
+    ports and the GCS URI of the full results, or "full" to send the whole
+    nmaprun document. Only use "compact" once every evaluate-scan instance
+    reads it.
+    """
     # message = {
     #   "network": "projects/123456789/global/networks/default", # pragma: allowlist secret # noqa
     #   "ips": ["1.2.3.4","4.4.4.4"],
     #   "ports": ["1-122","49","8000-9000"],
+    #   "started": {"1.2.3.4": "2024-01-01T00:00:00.000-08:00"},  # optional
+    #   "job": "3f2a9c1e0b7d",  # optional, tells apart messages for one network
+    #   "unit": 1,  # optional, set when a network is split into work units
+    #   "units": 3,
     # }
+    job_dir = None
+    job = None
+    journal = None
+    keep_job_dir = False
+    _track_scan(1)
     try:
-        message.ack()
+        if journal_mode == "off":
+            message.ack()
         data = json.loads(message.data.decode("utf-8"))
         network = data["network"]
         ips = data["ips"]
         ports = data["ports"]
 
         network_str = ".".join(network.split("/")[-5:])
-        results_outfile = f"/tmp/{network_str}.results.xml"
-        if ports[0] == "1-65535":
-            print(f"Running reduced-intensity nmap scan on {network} | {ips} | {ports}")
-            args = [
-                "nmap",
-                "-p",
-                ",".join(ports),
-                "-Pn",
-                "-T4",
-                "-sS",
-                "--stats-every",
-                "10m",
-                "-sV",
-                "--version-intensity",
-                "2",
-                "-oX",
-                results_outfile,
-            ]
-            args.extend(ips)
+        # A network may be covered by several messages (e.g. IPs exposing
+        # different ports), whose results mustn't overwrite each other.
+        if data.get("job"):
+            network_str += f".{data['job']}"
+        if data.get("units", 1) > 1:
+            network_str += f".unit-{data['unit']}-of-{data['units']}"
+        if journal_mode == "off":
+            job_dir = tempfile.mkdtemp(prefix=f"{network_str}.", dir=work_dir)
         else:
-            print(f"Running full-intensity nmap scan on {network} | {ips} | {ports}")
-            args = [
-                "nmap",
-                "-p",
-                ",".join(ports),
-                "-Pn",
-                "-T4",
-                "-sS",
-                "--stats-every",
-                "10m",
-                "-sV",
-                "--version-intensity",
-                "8",
-                "-oX",
-                results_outfile,
+            job_dir = os.path.join(work_dir, f"{network_str}.{message.message_id}")
+            journal = JobJournal(
+                job_dir,
+                os.path.basename(job_dir),
+                gcs_bucket=journal_bucket if journal_mode == "gcs" else None,
+                sync_interval=journal_sync_minutes * 60,
+            )
+            if journal.load():
+                print(
+                    f"Resuming scan of {network} from {journal.location()} "
+                    f"(attempt {journal.get('attempt')})"
+                )
+            else:
+                journal.set(network=network, date=date.today().isoformat())
+            journal.start_autosync()
+        job = start_job(os.path.basename(job_dir), network)
+        results_outfile = os.path.join(job_dir, "results.xml")
+        port_count = count_ports(ports)
+        job_start = time.monotonic()
+        slowness = 1.0
+        if duration_history is not None:
+            slowness = duration_history.slowness(network)
+        # Cached port results, by IP, when the fingerprint cache is in use.
+        cached = None
+        # The plan an earlier attempt at the job chose, if it is being resumed.
+        plan = journal.get("plan") if journal is not None else None
+
+        def choose_profile(host_count, pairs):
+            # Parallel nmap runs split the job's hosts between them.
+            parallel = max(1, min(processes, host_count))
+            deadline = job_deadline - (time.monotonic() - job_start)
+            profile, estimate = select_profile(
+                profiles, host_count, pairs, deadline * parallel, slowness
+            )
+            print(
+                f"Using the {profile['name']} nmap profile for {pairs} IP-port pairs "
+                f"on {host_count} hosts in {network} (estimated "
+                f"{estimate / parallel / 60:.0f} minutes at slowness {slowness})"
+            )
+            return profile, estimate / parallel
+
+        def nmap_args(outfile, group, group_ports):
+            # Journaled runs also log to -oG, which nmap --resume reads.
+            log = []
+            if journal is not None:
+                log = ["-oG", f"{outfile[: -len('.xml')]}.gnmap"]
+            return (
+                ["nmap", "-p", ",".join(group_ports), "-Pn"]
+                + profile_args(profile)
+                + log
+                + ["-oX", outfile]
+                + group
+            )
+
+        if plan is not None:
+            print(f"Resuming nmap scan on {network} | {ips} | {ports}")
+            commands = plan["commands"]
+            profile = plan["profile"]
+            estimate = plan["estimate"]
+            pairs = plan["pairs"]
+            open_ports = plan["open_ports"]
+            cached = plan["cached"]
+        elif two_phase == "always" or (
+            two_phase == "full-range" and port_count == 65535
+        ):
+            # Find open ports with a fast sweep first, then version-scan only
+            # those; hosts with the same open ports share an nmap run, up to
+            # MAX_VERSION_SCANS_PER_PROCESS runs per process.
+            print(f"Running two-phase nmap scan on {network} | {ips} | {ports}")
+            discovery_outfile = os.path.join(job_dir, "discovery.xml")
+            args = discovery_args(
+                discovery_scanner, ports, ips, discovery_outfile, discovery_rate
+            )
+            print(f"Running discovery command: {' '.join(args)}")
+            job.start_phase("discovery", {0: len(ips) * port_count}, last=False)
+            result = run_with_progress(
+                args,
+                job,
+                0,
+                stream="stderr" if discovery_scanner == "masscan" else "stdout",
+            )
+            if result.returncode and journal is not None and _draining.is_set():
+                raise ScanInterrupted("The discovery sweep was stopped while draining")
+            result.check_returncode()
+            open_ports = parse_open_ports(discovery_outfile)
+            print(
+                f"Discovery found {sum(len(p) for p in open_ports.values())} open "
+                f"ports on {len(open_ports)} of {len(ips)} hosts in {network}"
+            )
+            pairs = sum(len(p) for p in open_ports.values())
+            profile, estimate = choose_profile(len(open_ports), pairs)
+            if fingerprint_cache is not None:
+                open_ports, cached = fingerprint_cache.split(
+                    fingerprint_cache.load(network),
+                    open_ports,
+                    data.get("started", {}),
+                    profile["version_intensity"],
+                )
+                print(
+                    f"Reusing cached fingerprints of "
+                    f"{sum(len(e) for e in cached.values())} open ports in {network}; "
+                    f"version-scanning {sum(len(p) for p in open_ports.values())}"
+                )
+            commands = [
+                nmap_args(os.path.join(job_dir, f"results.{i}.xml"), group, group_ports)
+                for i, (group_ports, group) in enumerate(
+                    group_by_open_ports(
+                        open_ports, MAX_VERSION_SCANS_PER_PROCESS * processes
+                    )
+                )
             ]
-            args.extend(ips)
-        print(f"Running command: {' '.join(args)}")
-        subprocess.run(args)
+            if not commands:
+                # Nothing is open, or everything open is cached; the sweep's own
+                # output is the result.
+                shutil.copyfile(discovery_outfile, results_outfile)
+        else:
+            print(f"Running nmap scan on {network} | {ips} | {ports}")
+            pairs = len(ips) * port_count
+            profile, estimate = choose_profile(len(ips), pairs)
+            open_ports = None
+            groups = split_host_groups(ips, processes)
+            if len(groups) == 1:
+                commands = [nmap_args(results_outfile, ips, ports)]
+            else:
+                commands = [
+                    nmap_args(os.path.join(job_dir, f"results.{i}.xml"), group, ports)
+                    for i, group in enumerate(groups)
+                ]
+        if journal is not None and plan is None:
+            journal.set(
+                plan={
+                    "commands": commands,
+                    "profile": profile,
+                    "estimate": estimate,
+                    "pairs": pairs,
+                    "open_ports": open_ports,
+                    "cached": cached,
+                }
+            )
+        if commands:
+            scan_start = time.monotonic()
+            run_nmap(commands, results_outfile, processes, job, journal)
+            # A resumed scan's duration says little about the network's speed.
+            if duration_history is not None and plan is None:
+                duration_history.record(
+                    network,
+                    profile,
+                    pairs,
+                    estimate / slowness,
+                    time.monotonic() - scan_start,
+                )
+        if cached is not None:
+            if cached:
+                splice_cached_ports(results_outfile, cached)
+            fingerprint_cache.save(
+                network,
+                collect_fingerprints(
+                    results_outfile,
+                    open_ports,
+                    data.get("started", {}),
+                    profile["version_intensity"],
+                ),
+            )
         print(f"Scan complete on {network} | {ips} | {ports}")
 
         print("Uploading results to GCS...")
+        job.start_phase("upload", {})
         # Write both XML and JSON to GCS
-        storage_client = storage.Client()
+        # A resumed job is filed under the day it was first attempted.
+        results_date = journal.get("date") if journal else date.today().isoformat()
         results_blob_name = (
-            f"{date.today().isoformat()}/{network_str.replace('/', '.')}.scan-results"
+            f"{results_date}/{network_str.replace('/', '.')}.scan-results"
         )
-        storage_client.write_gcs_from_file(
-            os.environ["GCS_BUCKET"],
-            f"{results_blob_name}.xml",
-            results_outfile,
-            mime_type="application/xml",
-        )
-        with open(results_outfile, "r") as f:
-            results = f.read()
-
-        results_json = xmltodict.parse(results, attr_prefix="", cdata_key="value")[
-            "nmaprun"
-        ]
-        results_json["network"] = network
-        storage_client.write_gcs(
-            os.environ["GCS_BUCKET"],
-            f"{results_blob_name}.json",
-            json.dumps(results_json),
-            mime_type="application/json",
+        # The XML is read once: it is gzipped for upload while it is streamed
+        # host by host into gzipped JSON identical to xmltodict's parse of it.
+        results_xml_gz = os.path.join(job_dir, "results.xml.gz")
+        results_json_file = os.path.join(job_dir, "results.json.gz")
+        open_hosts = []
+
+        def keep_open_host(host):
+            host = compact_host(host)
+            if host:
+                open_hosts.append(host)
+
+        with open(results_outfile, "rb") as raw, gzip.open(
+            results_xml_gz, "wb", compresslevel=6
+        ) as xml_gz:
+            scanned = write_nmap_json(
+                TeeReader(raw, xml_gz),
+                results_json_file,
+                extra={"network": network},
+                host_callback=keep_open_host if result_format == "compact" else None,
+                compress=True,
+            )
+        upload_all(
+            [
+                (
+                    os.environ["GCS_BUCKET"],
+                    f"{results_blob_name}.xml",
+                    results_xml_gz,
+                    "application/xml",
+                ),
+                (
+                    os.environ["GCS_BUCKET"],
+                    f"{results_blob_name}.json",
+                    results_json_file,
+                    "application/json",
+                ),
+            ]
         )
 
         print(
@@ -103,13 +459,89 @@ def nmap_host(message):
             f"/{results_blob_name}"
         )
 
-        ps_client = pubsub.Client()
-        ps_client.send_pubsub(
-            topic_uri=os.environ["EVALUATE_SCAN_TOPIC_URI"], payload=results_json
-        )
+        ps_client = get_client(("pubsub",), pubsub.Client)
+        if result_format == "compact":
+            # Only hosts with open ports, plus where to find the full results.
+            results_uri = f"gs://{os.environ['GCS_BUCKET']}/{results_blob_name}.json"
+            for result_message in compact_result_messages(
+                network, results_uri, open_hosts, scanned, MAX_RESULT_MESSAGE_BYTES
+            ):
+                ps_client.send_pubsub(
+                    topic_uri=os.environ["EVALUATE_SCAN_TOPIC_URI"],
+                    payload=result_message,
+                )
+        else:
+            with gzip.open(results_json_file, "rt") as f:
+                ps_client.send_pubsub(
+                    topic_uri=os.environ["EVALUATE_SCAN_TOPIC_URI"],
+                    payload=json.load(f),
+                )
 
+        if journal is not None:
+            journal.clear()
+            message.ack()
+
+    except ScanInterrupted as e:
+        print(f"Scan interrupted: {e}")
+        keep_job_dir = _release_journaled(message, journal)
     except Exception as e:
         print(f"Scan failed: {e}")
+        if journal is not None:
+            keep_job_dir = _release_journaled(message, journal)
+        elif journal_mode != "off":
+            # The message couldn't even be read; redelivering it won't help.
+            message.ack()
+    finally:
+        if journal is not None:
+            journal.stop_autosync()
+        if job_dir:
+            end_job(os.path.basename(job_dir))
+            if not keep_job_dir:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        _track_scan(-1)
+
+
+def _release_journaled(message, journal):
+    # Saves a journaled job that didn't finish and nacks its message, so its
+    # redelivery resumes it. Returns whether its directory must be kept, i.e.
+    # the journal isn't also in GCS.
+    try:
+        journal.sync()
+        print(
+            f"Saved the job to {journal.location()}; it resumes when "
+            f"message {message.message_id} is redelivered."
+        )
+    except Exception as e:
+        print(f"WARNING: Could not save the job to {journal.location()}: {e}")
+    message.nack()
+    return journal.gcs_bucket is None
+
+
+def hold_for_slot(message, scan, slots, max_hold):
+    """Runs scan(message) once one of the scan slots (a semaphore) is free.
+
+    While every slot is busy, the message is held (its lease kept extended)
+    as long as a running scan is expected to free a slot within max_hold
+    seconds of the message arriving, going by the scans' progress. Otherwise,
+    or once the process is draining, the message is nacked so a replica with
+    a free slot can take it.
+    """
+    arrived = time.monotonic()
+    while not slots.acquire(timeout=HOLD_CHECK_SECONDS):
+        waited = time.monotonic() - arrived
+        soonest = soonest_finish()
+        if _draining.is_set() or waited + (soonest or 0) > max_hold:
+            print(
+                f"Releasing message {message.message_id} after {waited:.0f}s: "
+                f"the next scan slot is expected in "
+                f"{'unknown' if soonest is None else f'{soonest}s'}"
+            )
+            message.nack()
+            return
+    try:
+        scan(message)
+    finally:
+        slots.release()
 
 
 def main(config):
@@ -120,11 +552,122 @@ def main(config):
     if not os.environ.get("EVALUATE_SCAN_TOPIC_URI"):
         os.environ["EVALUATE_SCAN_TOPIC_URI"] = config["evaluate-scan-topic-uri"]
 
+    max_scans = config["max-concurrent-scans"]
+    profiles = DEFAULT_PROFILES
+    if config["nmap-profiles"]:
+        profiles = load_profiles(config["nmap-profiles"])
+        print(
+            f"Loaded nmap profiles from {config['nmap-profiles']}: "
+            f"{', '.join(profile['name'] for profile in profiles)}"
+        )
+    duration_history = None
+    if config["duration-history-blob"]:
+        duration_history = DurationHistory(
+            get_storage_client().bucket(os.environ["GCS_BUCKET"]),
+            config["duration-history-blob"],
+        )
+    fingerprint_cache = None
+    if config["fingerprint-cache-path"] or config["fingerprint-cache-prefix"]:
+        fingerprint_cache = FingerprintCache(
+            path=config["fingerprint-cache-path"],
+            gcs_bucket=(
+                None
+                if config["fingerprint-cache-path"]
+                else get_storage_client().bucket(os.environ["GCS_BUCKET"])
+            ),
+            prefix=config["fingerprint-cache-prefix"] or "fingerprints",
+            ttl_hours=config["fingerprint-cache-ttl-hours"],
+        )
+        if config["two-phase"] == "off":
+            print(
+                "WARNING: The fingerprint cache is only used by two-phase scans; "
+                "set --two-phase to use it."
+            )
+    journal_mode = config["journal"]
+    journal_bucket = None
+    if journal_mode == "gcs":
+        journal_bucket = get_storage_client().bucket(os.environ["GCS_BUCKET"])
     subscriber = pubsub_v1.SubscriberClient()
     sub_path = subscriber.subscription_path(subscription_project, subscription_topic)
+    # Without a journal, scans ack their message when they start, so flow
+    # control only counts messages held waiting for a scan slot: at most
+    # max_scans of them, each held only while a running scan is expected to
+    # finish within max_hold. With one, running scans' messages stay leased
+    # until their results are published, so they count too.
+    # The pool has a thread for each running scan and each held message.
+    max_hold = config["max-hold-minutes"] * 60
+    scheduler = ThreadScheduler(
+        executor=ThreadPoolExecutor(
+            max_workers=2 * max_scans, thread_name_prefix="nmap-scan"
+        )
+    )
+    if journal_mode == "off":
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=max_scans, max_lease_duration=max(3600, max_hold + 600)
+        )
+    else:
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=2 * max_scans,
+            max_lease_duration=MAX_JOURNALED_JOB_HOURS * 3600,
+        )
+        print(
+            f"Journaling scans to "
+            f"{'the work directory' if journal_bucket is None else 'GCS'}; "
+            "messages are acked once their results are published."
+        )
+    set_status(lambda: {"ready": not _draining.is_set(), "jobs": jobs_status()})
     set_ready(True)
-    streaming_pull_future = subscriber.subscribe(sub_path, callback=nmap_host)
-    print(f"Listening on Pub/Sub: {sub_path}")
+    scan = partial(
+        nmap_host,
+        work_dir=config["work-dir"],
+        processes=config["processes-per-scan"],
+        two_phase=config["two-phase"],
+        discovery_scanner=config["discovery-scanner"],
+        discovery_rate=config["discovery-rate"],
+        result_format=config["result-format"],
+        fingerprint_cache=fingerprint_cache,
+        profiles=profiles,
+        job_deadline=config["job-deadline-hours"] * 3600,
+        duration_history=duration_history,
+        journal_mode=journal_mode,
+        journal_bucket=journal_bucket,
+        journal_sync_minutes=config["journal-sync-minutes"],
+    )
+    streaming_pull_future = subscriber.subscribe(
+        sub_path,
+        callback=partial(
+            hold_for_slot,
+            scan=scan,
+            slots=threading.BoundedSemaphore(max_scans),
+            max_hold=max_hold,
+        ),
+        flow_control=flow_control,
+        scheduler=scheduler,
+        await_callbacks_on_shutdown=True,
+    )
+    print(
+        f"Listening on Pub/Sub: {sub_path} " f"(at most {max_scans} concurrent scans)"
+    )
+
+    def drain(signum, frame):
+        # Stop pulling new messages and let running scans finish; the pod's
+        # termination grace period should cover the longest expected scan.
+        # Journaled scans are stopped instead and saved to be resumed; if
+        # their nacks don't get through, their leases lapse and Pub/Sub
+        # redelivers them anyway.
+        set_ready(False)
+        _draining.set()
+        print(
+            f"Received signal {signum}; "
+            f"{'draining' if journal_mode == 'off' else 'stopping and saving'} "
+            f"{_active_scans} running scans before shutting down..."
+        )
+        if journal_mode != "off":
+            stop_jobs()
+        streaming_pull_future.cancel()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
 
     with subscriber:
         try:
@@ -133,6 +676,7 @@ def main(config):
             print(f"Listening for messages on {sub_path} threw an exception: {e}.")
             streaming_pull_future.cancel()
             streaming_pull_future.result()
+    print("Shut down cleanly.")
 
 
 def get_config():
@@ -167,6 +711,204 @@ def get_config():
         required=False,
     )
 
+    parser.add_argument(
+        "--max-concurrent-scans",
+        type=int,
+        help=(
+            "Optional: The maximum number of nmap scans to run at once. "
+            f"Defaults to {DEFAULT_MAX_CONCURRENT_SCANS}. "
+            "May also be provided in the MAX_CONCURRENT_SCANS environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--max-hold-minutes",
+        type=float,
+        help=(
+            "Optional: While all scan slots are busy, hold a newly pulled message "
+            "only if a running scan is expected to finish within this many "
+            "minutes, going by nmap's progress; otherwise release it to other "
+            f"replicas. Defaults to {DEFAULT_MAX_HOLD_MINUTES}. "
+            "May also be provided in the MAX_HOLD_MINUTES environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        help=(
+            "Optional: The directory in which each scan gets its own working "
+            'directory. Defaults to "/tmp". '
+            "May also be provided in the WORK_DIR environment variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--processes-per-scan",
+        type=int,
+        help=(
+            "Optional: Split each scan's IPs into this many host groups, scanned "
+            "by parallel nmap processes whose results are merged. Defaults to 1. "
+            "May also be provided in the PROCESSES_PER_SCAN environment variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--two-phase",
+        type=str,
+        choices=["off", "full-range", "always"],
+        help=(
+            "Optional: Find open ports with a fast discovery sweep, then run "
+            'nmap -sV only on those. "full-range" does this for 1-65535 jobs '
+            'only. Defaults to "off". '
+            "May also be provided in the TWO_PHASE environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--discovery-scanner",
+        type=str,
+        choices=DISCOVERY_SCANNERS,
+        help=(
+            "Optional: The scanner for two-phase discovery sweeps: nmap -sS, or "
+            "masscan if it is installed in the image. "
+            'Defaults to "nmap". '
+            "May also be provided in the DISCOVERY_SCANNER environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--discovery-rate",
+        type=int,
+        help=(
+            "Optional: The maximum packets per second of a discovery sweep. "
+            f"Defaults to {DEFAULT_DISCOVERY_RATE}. "
+            "May also be provided in the DISCOVERY_RATE environment variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--result-format",
+        type=str,
+        choices=["compact", "full"],
+        help=(
+            'Optional: The results message sent to evaluate-scan. "compact" '
+            "sends only hosts with open ports and the GCS path of the full "
+            'results; "full" sends the whole nmaprun document. '
+            'Defaults to "full"; use "compact" only once evaluate-scan is '
+            "deployed with support for it. "
+            "May also be provided in the RESULT_FORMAT environment variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--nmap-profiles",
+        type=str,
+        help=(
+            "Optional: A JSON file listing nmap profiles, most thorough first, "
+            "to choose between instead of the built-in ones. Each has a name, "
+            "version_intensity and seconds_per_pair, and optionally timing, "
+            "max_retries, min_rate and host_group. "
+            "May also be provided in the NMAP_PROFILES environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--job-deadline-hours",
+        type=float,
+        help=(
+            "Optional: Scan each job with the most thorough nmap profile "
+            "expected to finish within this many hours. "
+            f"Defaults to {DEFAULT_JOB_DEADLINE_HOURS}. "
+            "May also be provided in the JOB_DEADLINE_HOURS environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--duration-history-blob",
+        type=str,
+        help=(
+            "Optional: A JSON blob in the GCS bucket in which to record how much "
+            "slower than estimated each network scans, so profiles are chosen "
+            'from past run times, e.g. "scan-durations.json". '
+            "May also be provided in the DURATION_HISTORY_BLOB environment "
+            "variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--fingerprint-cache-path",
+        type=str,
+        help=(
+            "Optional: A local directory in which to cache the -sV result of "
+            "each open IP:port, so two-phase scans only version-probe ports that "
+            "are new, changed or restarted since. "
+            "May also be provided in the FINGERPRINT_CACHE_PATH environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--fingerprint-cache-prefix",
+        type=str,
+        help=(
+            "Optional: Like --fingerprint-cache-path, but a prefix in the GCS "
+            'bucket, e.g. "fingerprints", so the cache is shared by every '
+            "replica. "
+            "May also be provided in the FINGERPRINT_CACHE_PREFIX environment "
+            "variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--fingerprint-cache-ttl-hours",
+        type=float,
+        help=(
+            "Optional: How long a cached -sV result is reused before its port "
+            f"is probed again. Defaults to {DEFAULT_FINGERPRINT_TTL_HOURS}. "
+            "May also be provided in the FINGERPRINT_CACHE_TTL_HOURS environment "
+            "variable. "
+        ),
+        required=False,
+    )
+
+    parser.add_argument(
+        "--journal",
+        type=str,
+        choices=["off", "local", "gcs"],
+        help=(
+            "Optional: Keep a journal of each scan and only ack its message once "
+            "its results are published, so a scan cut short by a crash or "
+            "preemption is resumed (with nmap --resume) when the message is "
+            'redelivered. "local" keeps journals in --work-dir, which must then '
+            'be on a volume that survives restarts; "gcs" also syncs them to '
+            'the "jobs" prefix of the GCS bucket, so any replica can resume '
+            "them. Give the subscription a dead-letter topic, as scans that keep "
+            'failing are redelivered. Defaults to "off". '
+            "May also be provided in the JOURNAL environment variable. "
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--journal-sync-minutes",
+        type=float,
+        help=(
+            "Optional: How often a running scan's journal and partial nmap "
+            "output are synced to GCS with --journal gcs. "
+            f"Defaults to {DEFAULT_JOURNAL_SYNC_MINUTES}. "
+            "May also be provided in the JOURNAL_SYNC_MINUTES environment "
+            "variable. "
+        ),
+        required=False,
+    )
+
     args = parser.parse_args()
 
     config = {
@@ -177,6 +919,38 @@ def get_config():
         or os.environ.get("SUBSCRIPTION_TOPIC"),
         "evaluate-scan-topic-uri": args.evaluate_scan_topic_uri
         or os.environ.get("EVALUATE_SCAN_TOPIC_URI"),
+        "max-concurrent-scans": args.max_concurrent_scans
+        or int(os.environ.get("MAX_CONCURRENT_SCANS", DEFAULT_MAX_CONCURRENT_SCANS)),
+        "max-hold-minutes": (
+            args.max_hold_minutes
+            if args.max_hold_minutes is not None
+            else float(os.environ.get("MAX_HOLD_MINUTES", DEFAULT_MAX_HOLD_MINUTES))
+        ),
+        "work-dir": args.work_dir or os.environ.get("WORK_DIR", "/tmp"),
+        "processes-per-scan": args.processes_per_scan
+        or int(os.environ.get("PROCESSES_PER_SCAN", 1)),
+        "two-phase": args.two_phase or os.environ.get("TWO_PHASE", "off"),
+        "discovery-scanner": args.discovery_scanner
+        or os.environ.get("DISCOVERY_SCANNER", "nmap"),
+        "discovery-rate": args.discovery_rate
+        or int(os.environ.get("DISCOVERY_RATE", DEFAULT_DISCOVERY_RATE)),
+        "result-format": args.result_format or os.environ.get("RESULT_FORMAT", "full"),
+        "nmap-profiles": args.nmap_profiles or os.environ.get("NMAP_PROFILES"),
+        "job-deadline-hours": args.job_deadline_hours
+        or float(os.environ.get("JOB_DEADLINE_HOURS", DEFAULT_JOB_DEADLINE_HOURS)),
+        "duration-history-blob": args.duration_history_blob
+        or os.environ.get("DURATION_HISTORY_BLOB"),
+        "fingerprint-cache-path": args.fingerprint_cache_path
+        or os.environ.get("FINGERPRINT_CACHE_PATH"),
+        "fingerprint-cache-prefix": args.fingerprint_cache_prefix
+        or os.environ.get("FINGERPRINT_CACHE_PREFIX"),
+        "fingerprint-cache-ttl-hours": args.fingerprint_cache_ttl_hours
+        or float(
+            os.environ.get("FINGERPRINT_CACHE_TTL_HOURS", DEFAULT_FINGERPRINT_TTL_HOURS)
+        ),
+        "journal": args.journal or os.environ.get("JOURNAL", "off"),
+        "journal-sync-minutes": args.journal_sync_minutes
+        or float(os.environ.get("JOURNAL_SYNC_MINUTES", DEFAULT_JOURNAL_SYNC_MINUTES)),
     }
 
     if (
@@ -0,0 +1,203 @@
+import gzip
+import json
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from functools import partial
+
+# The key character data is stored under when an element also has attributes
+# or children, matching xmltodict.parse(..., cdata_key="value").
+CDATA_KEY = "value"
+
+
+def _push(item, key, value):
+    # Repeated keys become lists, as in xmltodict.
+    if key in item:
+        if isinstance(item[key], list):
+            item[key].append(value)
+        else:
+            item[key] = [item[key], value]
+    else:
+        item[key] = value
+
+
+def _text(element):
+    # All character data directly inside an element, including the tails of
+    # its children, stripped as xmltodict does.
+    chunks = [element.text or ""] + [child.tail or "" for child in element]
+    return "".join(chunks).strip() or None
+
+
+def element_to_dict(element):
+    """Converts a parsed element to exactly what xmltodict.parse(xml,
+    attr_prefix="", cdata_key="value") produces for it: a dict of attributes,
+    then children (repeated ones as lists), then any text under "value"; or
+    just the text (or None) if it has no attributes or children.
+    """
+    item = dict(element.attrib)
+    for child in element:
+        _push(item, child.tag, element_to_dict(child))
+    text = _text(element)
+    if not item:
+        return text
+    if text:
+        _push(item, CDATA_KEY, text)
+    return item
+
+
+def write_nmap_json(
+    xml_file, json_path, extra=None, host_callback=None, compress=False
+):
+    """Converts nmap XML output to JSON identical to
+    json.dumps(xmltodict.parse(xml, attr_prefix="", cdata_key="value")["nmaprun"])
+    with the items of extra (e.g. {"network": ...}) appended, without holding
+    the document in memory.
+
+    The XML is parsed one top-level element (e.g. one host) at a time. Each is
+    converted and spooled to a temporary file per tag, and the spools are then
+    concatenated into json_path in the order xmltodict would emit their keys.
+    If given, host_callback is called with each host's dict as it is parsed.
+    xml_file may be a path or a binary file object. With compress, json_path
+    is written gzip-compressed. Returns the number of hosts.
+    """
+    spools = {}
+    counts = {}
+    root = None
+    root_text = []
+    previous = None
+    depth = 0
+    try:
+        for event, element in ET.iterparse(xml_file, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                    root_attrib = dict(element.attrib)
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            item = element_to_dict(element)
+            if element.tag == "host" and host_callback:
+                host_callback(item)
+            if element.tag not in spools:
+                spools[element.tag] = tempfile.TemporaryFile("w+")
+                counts[element.tag] = 0
+            elif counts[element.tag]:
+                spools[element.tag].write(", ")
+            spools[element.tag].write(json.dumps(item))
+            counts[element.tag] += 1
+            # A child's tail is only parsed after its end event, so each child
+            # is dropped once the next one has ended.
+            if previous is not None:
+                root_text.append(previous.tail or "")
+                root.remove(previous)
+            previous = element
+        if previous is not None:
+            root_text.append(previous.tail or "")
+        root_text = ((root.text or "") + "".join(root_text)).strip() or None
+
+        opener = partial(gzip.open, compresslevel=6) if compress else open
+        with opener(json_path, "wt") as out:
+            out.write("{")
+            first = True
+
+            def write_key(key):
+                nonlocal first
+                out.write(("" if first else ", ") + json.dumps(key) + ": ")
+                first = False
+
+            for key, value in root_attrib.items():
+                write_key(key)
+                if key in spools:
+                    # An attribute and child with the same name form one list.
+                    spool = spools.pop(key)
+                    spool.seek(0)
+                    out.write("[" + json.dumps(value) + ", ")
+                    shutil.copyfileobj(spool, out)
+                    out.write("]")
+                    spool.close()
+                else:
+                    out.write(json.dumps(value))
+            for tag, spool in spools.items():
+                write_key(tag)
+                spool.seek(0)
+                if counts[tag] > 1:
+                    out.write("[")
+                shutil.copyfileobj(spool, out)
+                if counts[tag] > 1:
+                    out.write("]")
+            if root_text:
+                write_key(CDATA_KEY)
+                out.write(json.dumps(root_text))
+            for key, value in (extra or {}).items():
+                write_key(key)
+                out.write(json.dumps(value))
+            out.write("}")
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return counts.get("host", 0)
+
+
+def compact_host(host):
+    """Returns a host record (as from write_nmap_json's host_callback) cut
+    down to its address, hostnames, host scripts and open ports, with each
+    open port's service and script data intact; or None if it has no open
+    ports. The record keeps the nmaprun shape, so evaluate-scan reads it the
+    same way.
+    """
+    ports = (host.get("ports") or {}).get("port", [])
+    if not isinstance(ports, list):
+        ports = [ports]
+    open_ports = [
+        port
+        for port in ports
+        if isinstance(port, dict) and (port.get("state") or {}).get("state") == "open"
+    ]
+    if not open_ports:
+        return None
+    compact = {
+        key: host[key] for key in ("address", "hostnames", "hostscript") if key in host
+    }
+    compact["ports"] = {"port": open_ports}
+    return compact
+
+
+def compact_result_messages(network, results_uri, hosts, scanned, max_bytes):
+    """Yields compact result messages for evaluate-scan: the network, the GCS
+    URI of the full JSON results, how many hosts were scanned, and the hosts
+    with open ports (from compact_host), split across as many messages as
+    needed to keep each under max_bytes of JSON. At least one message is
+    yielded, even if no host has open ports.
+
+    The output looks like:
+    {
+        "format": "compact",
+        "network": "projects/123456789/global/networks/default", # pragma: allowlist secret
+        "results": "gs://my-bucket/2024-01-01/123456789.global.networks.default.3f2a9c1e0b7d.scan-results.json",
+        "scanned": 250,
+        "part": 1,
+        "host": [{"address": {"addr": "1.2.3.4", "addrtype": "ipv4"}, "ports": {"port": [...]}}]
+    }
+    """  # noqa
+    base = {
+        "format": "compact",
+        "network": network,
+        "results": results_uri,
+        "scanned": scanned,
+    }
+    overhead = len(json.dumps(base)) + 64
+    part = 1
+    batch = []
+    size = overhead
+    for host in hosts:
+        host_size = len(json.dumps(host)) + 2
+        if batch and size + host_size > max_bytes:
+            yield dict(base, part=part, host=batch)
+            part += 1
+            batch = []
+            size = overhead
+        batch.append(host)
+        size += host_size
+    yield dict(base, part=part, host=batch)
@@ -0,0 +1,147 @@
+import xml.etree.ElementTree as ET
+
+# Elements of an nmaprun that describe individual hosts, in document order.
+HOST_ELEMENTS = ("hosthint", "host")
+
+
+def split_host_groups(ips, groups):
+    """Splits a list of IPs into at most the given number of contiguous,
+    evenly sized groups, in order.
+    """
+    groups = max(1, min(groups, len(ips)))
+    size, extra = divmod(len(ips), groups)
+    result = []
+    start = 0
+    for i in range(groups):
+        end = start + size + (1 if i < extra else 0)
+        result.append(ips[start:end])
+        start = end
+    return result
+
+
+def merge_nmap_xml(paths, out_path):
+    """Merges the XML output of several nmap runs over disjoint host groups
+    (run with the same options) into one nmaprun document at out_path, as if
+    a single nmap run had scanned every host.
+
+    Hosts are kept in the order of paths. The merged runstats count every
+    run's hosts, start at the earliest run's start and finish at the latest
+    run's finish. Runs whose output is missing or unparseable (e.g. nmap was
+    killed) are skipped with a warning; at least one must be readable.
+    Returns the number of runs merged.
+    """
+    runs = []
+    for path in paths:
+        try:
+            runs.append(ET.parse(path).getroot())
+        except (OSError, ET.ParseError) as e:
+            print(f"WARNING: Skipping unreadable nmap output {path}: {e}")
+    if not runs:
+        raise ValueError(f"No readable nmap output among {paths}")
+
+    merged = runs[0]
+    if len(runs) > 1:
+        _merge_runs(merged, runs[1:])
+    ET.ElementTree(merged).write(out_path, encoding="utf-8", xml_declaration=True)
+    return len(runs)
+
+
+def _merge_runs(merged, others):
+    # Hosts go after the first run's last host, before its runstats.
+    runstats = merged.find("runstats")
+    insert_at = list(merged).index(runstats) if runstats is not None else len(merged)
+    for other in others:
+        for element in other:
+            if element.tag in HOST_ELEMENTS:
+                merged.insert(insert_at, element)
+                insert_at += 1
+
+    start = min(int(run.get("start", 0)) for run in [merged] + others)
+    if merged.get("start") and start < int(merged.get("start")):
+        earliest = min(others, key=lambda run: int(run.get("start", 0)))
+        merged.set("start", earliest.get("start"))
+        merged.set("startstr", earliest.get("startstr", ""))
+
+    if runstats is None:
+        return
+    finished = runstats.find("finished")
+    hosts = runstats.find("hosts")
+    for other in others:
+        other_stats = other.find("runstats")
+        if other_stats is None:
+            continue
+        other_finished = other_stats.find("finished")
+        if (
+            finished is not None
+            and other_finished is not None
+            and int(other_finished.get("time", 0)) > int(finished.get("time", 0))
+        ):
+            for key in ("time", "timestr", "summary", "exit"):
+                if other_finished.get(key) is not None:
+                    finished.set(key, other_finished.get(key))
+        other_hosts = other_stats.find("hosts")
+        if hosts is not None and other_hosts is not None:
+            for key in ("up", "down", "total"):
+                hosts.set(
+                    key, str(int(hosts.get(key, 0)) + int(other_hosts.get(key, 0)))
+                )
+    if finished is not None:
+        finished.set("elapsed", f"{int(finished.get('time', 0)) - start:.2f}")
+        if hosts is not None and finished.get("summary"):
+            finished.set(
+                "summary",
+                f"Nmap done at {finished.get('timestr')}; "
+                f"{hosts.get('total')} IP addresses ({hosts.get('up')} hosts up) "
+                f"scanned in {finished.get('elapsed')} seconds",
+            )
+
+
+def salvage_nmap_xml(path, out_path, exclude=()):
+    """Writes the hosts nmap finished writing to the XML at path before it
+    was killed, other than those whose address is in exclude, to a complete
+    nmaprun document at out_path, counted in its runstats. Returns the
+    addresses written.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    depth = 0
+    hosts = []
+    with open(path, "rb") as f:
+        try:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == "start":
+                        if root is None:
+                            root = element
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth == 1 and element.tag == "host":
+                        hosts.append(element)
+        except ET.ParseError:
+            pass
+    salvaged = ET.Element("nmaprun", dict(root.attrib) if root is not None else {})
+    if root is not None:
+        for element in root:
+            if element.tag in ("scaninfo", "verbose", "debugging"):
+                salvaged.append(element)
+    addresses = set()
+    up = 0
+    for host in hosts:
+        addrs = {
+            address.get("addr")
+            for address in host.findall("address")
+            if address.get("addrtype") in ("ipv4", "ipv6")
+        }
+        if addrs & set(exclude):
+            continue
+        salvaged.append(host)
+        addresses |= addrs
+        status = host.find("status")
+        up += status is not None and status.get("state") == "up"
+    runstats = ET.SubElement(salvaged, "runstats")
+    total = len(salvaged.findall("host"))
+    ET.SubElement(runstats, "hosts", up=str(up), down=str(total - up), total=str(total))
+    ET.ElementTree(salvaged).write(out_path, encoding="utf-8", xml_declaration=True)
+    return addresses
@@ -0,0 +1,117 @@
+import json
+import threading
+
+from google.api_core.exceptions import PreconditionFailed
+
+# A network's slowness factor is smoothed over runs and kept within bounds, so
+# one unusually fast or slow scan can't swing the next profile choice much.
+HISTORY_WEIGHT = 0.5
+MIN_SLOWNESS, MAX_SLOWNESS = 0.1, 10.0
+HISTORY_SAVE_ATTEMPTS = 5
+
+
+def profile_args(profile):
+    """Returns the nmap options a profile sets, besides the ports, targets
+    and output.
+    """
+    args = [
+        f"-T{profile['timing']}",
+        "-sS",
+        "--stats-every",
+        "30s",
+        "-sV",
+        "--version-intensity",
+        str(profile["version_intensity"]),
+    ]
+    if profile["max_retries"] is not None:
+        args += ["--max-retries", str(profile["max_retries"])]
+    if profile["min_rate"] is not None:
+        args += ["--min-rate", str(profile["min_rate"])]
+    if profile["host_group"] is not None:
+        args += ["--min-hostgroup", str(profile["host_group"])]
+    return args
+
+
+class DurationHistory:
+    """Per-network slowness factors learned from previous scans: how many
+    times longer than estimated each network's scans actually took. Kept as a
+    JSON blob in gcs_bucket (a google.cloud.storage Bucket) shared by every
+    replica. The history is read once per process and refreshed from GCS
+    whenever this process records a scan, rather than downloaded per job.
+
+    The blob looks like:
+    {
+        "projects/123456789/global/networks/default": {"slowness": 1.7, "seconds": 5400, "pairs": 2400000, "profile": "reduced"}, # pragma: allowlist secret
+    }
+    """  # noqa
+
+    def __init__(self, gcs_bucket, blob_name):
+        self.gcs_bucket = gcs_bucket
+        self.blob_name = blob_name
+        self._lock = threading.Lock()
+        self._history = None
+
+    def _read(self):
+        blob = self.gcs_bucket.get_blob(self.blob_name)
+        if blob is None:
+            return {}, 0
+        return (
+            json.loads(blob.download_as_bytes(if_generation_match=blob.generation)),
+            blob.generation,
+        )
+
+    def slowness(self, network):
+        """Returns the network's slowness factor, or 1 if it has none."""
+        with self._lock:
+            if self._history is None:
+                try:
+                    self._history, _ = self._read()
+                except Exception as e:
+                    print(
+                        f"Could not load scan duration history "
+                        f"gs://{self.gcs_bucket.name}/{self.blob_name}: {e}"
+                    )
+                    return 1.0
+            history = self._history
+        return history.get(network, {}).get("slowness", 1.0)
+
+    def record(self, network, profile, pairs, estimate, seconds):
+        """Folds a finished scan's actual duration into the network's slowness
+        factor. estimate is what the scan was expected to take at a slowness
+        of 1. If the history can't be read, the scan isn't recorded, rather
+        than overwriting every other network's history.
+        """
+        observed = min(max(seconds / max(estimate, 1.0), MIN_SLOWNESS), MAX_SLOWNESS)
+        for _ in range(HISTORY_SAVE_ATTEMPTS):
+            with self._lock:
+                try:
+                    history, generation = self._read()
+                except Exception as e:
+                    print(
+                        f"WARNING: Not recording the scan duration of {network}; "
+                        f"could not read the scan duration history: {e}"
+                    )
+                    return
+                previous = history.get(network, {}).get("slowness", observed)
+                history[network] = {
+                    "slowness": round(
+                        HISTORY_WEIGHT * observed + (1 - HISTORY_WEIGHT) * previous, 3
+                    ),
+                    "seconds": round(seconds),
+                    "pairs": pairs,
+                    "profile": profile["name"],
+                }
+                try:
+                    self.gcs_bucket.blob(self.blob_name).upload_from_string(
+                        json.dumps(history),
+                        content_type="application/json",
+                        if_generation_match=generation,
+                    )
+                    self._history = history
+                    return
+                except PreconditionFailed:
+                    continue
+        print(
+            f"WARNING: Gave up recording the scan duration of {network} after "
+            f"{HISTORY_SAVE_ATTEMPTS} attempts."
+        )
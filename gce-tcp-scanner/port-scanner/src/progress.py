@@ -0,0 +1,255 @@
+import re
+import subprocess
+import threading
+import time
+
+# nmap prints these every --stats-every, e.g.
+# "SYN Stealth Scan Timing: About 12.34% done; ETC: 14:35 (0:09:15 remaining)"
+NMAP_TIMING = re.compile(
+    r"^(?P<task>.+?) Timing: About (?P<percent>[\d.]+)% done"
+    r"(?:; ETC: \S+ \((?P<remaining>\d+:\d\d:\d\d) remaining\))?"
+)
+# masscan rewrites a status line on stderr, e.g.
+# "rate:  1.00-kpps, 12.34% done,   0:01:23 remaining, found=3"
+MASSCAN_STATUS = re.compile(
+    r"rate:\s*(?P<kpps>[\d.]+)-kpps,\s*(?P<percent>[\d.]+)% done,"
+    r"\s*(?:(?P<remaining>\d+:\d\d:\d\d) remaining)?"
+)
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _seconds(hms):
+    hours, minutes, seconds = (int(part) for part in hms.split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_nmap_line(line):
+    """Returns (task, percent, remaining seconds or None, probes per second
+    or None) for an nmap or masscan progress line, or None for other lines.
+    """
+    match = NMAP_TIMING.match(line.strip())
+    if match:
+        remaining = match.group("remaining")
+        return (
+            match.group("task"),
+            float(match.group("percent")),
+            _seconds(remaining) if remaining else None,
+            None,
+        )
+    match = MASSCAN_STATUS.search(line)
+    if match:
+        remaining = match.group("remaining")
+        return (
+            "masscan",
+            float(match.group("percent")),
+            _seconds(remaining) if remaining else None,
+            float(match.group("kpps")) * 1000,
+        )
+    return None
+
+
+class JobProgress:
+    """Tracks how far along a scan job is, from the progress its nmap (or
+    masscan) runs print. A job goes through phases (e.g. "discovery" then
+    "scan"), each made of one or more runs over some number of IP-port pairs.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.started = time.time()
+        self.phase = "starting"
+        self._phase_start = time.monotonic()
+        self._runs = {}
+        self._last = False
+        self._procs = set()
+        self._lock = threading.Lock()
+
+    def start_phase(self, phase, runs, last=True):
+        """Starts a phase whose runs are given as {run id: IP-port pairs}.
+        Only the last phase's progress says when the job will finish.
+        """
+        with self._lock:
+            self.phase = phase
+            self._last = last
+            self._phase_start = time.monotonic()
+            self._runs = {
+                run: {
+                    "pairs": pairs,
+                    "task": None,
+                    "task_start": None,
+                    "percent": 0.0,
+                    "remaining": None,
+                    "rate": None,
+                    "done": False,
+                }
+                for run, pairs in runs.items()
+            }
+
+    def begin(self, run):
+        """Marks a run as started; its first task is timed from here."""
+        with self._lock:
+            self._runs[run]["task_start"] = time.monotonic()
+
+    def update(self, run, task, percent, remaining=None, rate=None):
+        with self._lock:
+            state = self._runs[run]
+            if task != state["task"]:
+                if state["task"] is not None or state["task_start"] is None:
+                    state["task_start"] = time.monotonic()
+                state["task"] = task
+            state["percent"] = percent
+            state["remaining"] = remaining
+            if rate is None and state["task"] and "Service" not in state["task"]:
+                # nmap doesn't print its packet rate; a port scan sends about
+                # one probe per IP-port pair, so estimate it from progress.
+                elapsed = time.monotonic() - state["task_start"]
+                rate = state["pairs"] * percent / 100 / elapsed if elapsed else None
+            state["rate"] = rate
+
+    def finish(self, run):
+        with self._lock:
+            self._runs[run].update(done=True, percent=100.0, remaining=0, rate=None)
+
+    def stop(self):
+        """Terminates the job's running scanner processes."""
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            proc.terminate()
+
+    def eta(self):
+        """Returns the estimated seconds until the job finishes, or None if
+        there's no progress to go by yet or later phases are still to come.
+        """
+        with self._lock:
+            return self._eta()
+
+    def _eta(self):
+        if not self._last:
+            return None
+        runs = self._runs.values()
+        pending = [run for run in runs if not run["done"]]
+        if not pending:
+            return 0
+        if all(run["remaining"] is not None for run in pending):
+            # Every unfinished run is running and reports its own ETA.
+            return max(run["remaining"] for run in pending)
+        percent = self._percent()
+        if not percent:
+            return None
+        elapsed = time.monotonic() - self._phase_start
+        return round(elapsed * (100 - percent) / percent)
+
+    def _percent(self):
+        pairs = sum(run["pairs"] for run in self._runs.values()) or 1
+        return sum(run["pairs"] * run["percent"] for run in self._runs.values()) / pairs
+
+    def snapshot(self):
+        """Returns the job's progress for the health server.
+
+        The output looks like:
+        {
+            "network": "projects/123456789/global/networks/default", # pragma: allowlist secret
+            "phase": "scan",
+            "tasks": ["SYN Stealth Scan"],
+            "percent": 12.3,
+            "eta_seconds": 555,
+            "probes_per_second": 1830.5,
+            "runs": 2,
+            "runs_done": 0,
+            "elapsed_seconds": 75
+        }
+
+        percent and eta_seconds are for the current nmap task of each run, so
+        they start over when e.g. a SYN scan moves on to version detection;
+        eta_seconds is None until the job's last phase.
+        """  # noqa
+        with self._lock:
+            runs = list(self._runs.values())
+            rates = [run["rate"] for run in runs if run["rate"] is not None]
+            return {
+                "network": self.network,
+                "phase": self.phase,
+                "tasks": sorted({run["task"] for run in runs if run["task"]}),
+                "percent": round(self._percent(), 1),
+                "eta_seconds": self._eta(),
+                "probes_per_second": round(sum(rates), 1) if rates else None,
+                "runs": len(runs),
+                "runs_done": sum(1 for run in runs if run["done"]),
+                "elapsed_seconds": round(time.time() - self.started),
+            }
+
+
+def start_job(job_id, network):
+    """Registers a job whose progress the health server reports."""
+    job = JobProgress(network)
+    with _jobs_lock:
+        _jobs[job_id] = job
+    return job
+
+
+def end_job(job_id):
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
+
+
+def jobs_status():
+    """Returns a snapshot of every running job, keyed by job id."""
+    with _jobs_lock:
+        jobs = dict(_jobs)
+    return {job_id: job.snapshot() for job_id, job in jobs.items()}
+
+
+def stop_jobs():
+    """Terminates the scanner processes of every running job."""
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    for job in jobs:
+        job.stop()
+
+
+def soonest_finish():
+    """Returns the estimated seconds until the first running job finishes, or
+    None if no job has an estimate yet.
+    """
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    etas = [eta for eta in (job.eta() for job in jobs) if eta is not None]
+    return min(etas) if etas else None
+
+
+def run_with_progress(args, job=None, run=None, stream="stdout", check=False):
+    """Runs a scanner command, echoing its output and feeding its progress
+    lines (from stream, "stdout" for nmap or "stderr" for masscan) to the
+    job's run. Returns the CompletedProcess, like subprocess.run.
+    """
+    if job is not None:
+        job.begin(run)
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE if stream == "stdout" else None,
+        stderr=subprocess.PIPE if stream == "stderr" else None,
+        text=True,
+        errors="replace",
+    )
+    if job is not None:
+        with job._lock:
+            job._procs.add(proc)
+    # Text mode turns masscan's carriage-return status updates into lines.
+    for line in proc.stdout if stream == "stdout" else proc.stderr:
+        parsed = parse_nmap_line(line)
+        if parsed and job is not None:
+            job.update(run, *parsed)
+        if not (parsed and parsed[0] == "masscan"):
+            # masscan updates its status line about once a second.
+            print(line, end="")
+    returncode = proc.wait()
+    if job is not None:
+        with job._lock:
+            job._procs.discard(proc)
+        job.finish(run)
+    if check and returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+    return subprocess.CompletedProcess(args, returncode)
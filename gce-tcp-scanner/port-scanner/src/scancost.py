@@ -0,0 +1,112 @@
+import json
+
+# port-scanner picks each job's nmap profile with this scan duration model and
+# asset-discovery orders jobs by it, so both services keep identical copies of
+# this module.
+
+# nmap profiles, most thorough first. A job is scanned with the first profile
+# expected to finish within its deadline, or the last one if none is.
+# seconds_per_pair is the rough -sS -sV throughput of the profile, in seconds
+# per IP-port pair; timing, max_retries, min_rate and host_group map to nmap's
+# -T, --max-retries, --min-rate and --min-hostgroup (None leaves nmap's own
+# default).
+DEFAULT_PROFILES = [
+    {
+        "name": "thorough",
+        "timing": 4,
+        "version_intensity": 8,
+        "max_retries": None,
+        "min_rate": None,
+        "host_group": None,
+        "seconds_per_pair": 0.001,
+    },
+    {
+        "name": "balanced",
+        "timing": 4,
+        "version_intensity": 5,
+        "max_retries": 3,
+        "min_rate": 300,
+        "host_group": None,
+        "seconds_per_pair": 0.0006,
+    },
+    {
+        "name": "reduced",
+        "timing": 4,
+        "version_intensity": 2,
+        "max_retries": 2,
+        "min_rate": 1000,
+        "host_group": 64,
+        "seconds_per_pair": 0.0004,
+    },
+    {
+        "name": "fast",
+        "timing": 5,
+        "version_intensity": 0,
+        "max_retries": 1,
+        "min_rate": 5000,
+        "host_group": 256,
+        "seconds_per_pair": 0.0001,
+    },
+]
+PROFILE_KEYS = ("timing", "max_retries", "min_rate", "host_group")
+DEFAULT_JOB_DEADLINE_HOURS = 4.0
+# Fixed per-IP cost of host setup and version detection on open ports.
+SECONDS_PER_IP = 30.0
+
+
+def count_ports(ports):
+    """Returns the number of distinct ports in a list like ["1-122", "49"]."""
+    intervals = []
+    for port in ports:
+        low, _, high = str(port).partition("-")
+        intervals.append((int(low), int(high or low)))
+    count = 0
+    end = 0
+    for low, high in sorted(intervals):
+        low = max(low, end + 1)
+        if high >= low:
+            count += high - low + 1
+            end = high
+    return count
+
+
+def load_profiles(path):
+    """Loads a JSON list of profiles, most thorough first, shaped like
+    DEFAULT_PROFILES. Each needs a name, version_intensity and
+    seconds_per_pair; the other keys default to nmap's own defaults.
+    """
+    with open(path) as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, list) or not profiles:
+        raise ValueError(f"{path} must contain a non-empty list of profiles")
+    for profile in profiles:
+        missing = [
+            key
+            for key in ("name", "version_intensity", "seconds_per_pair")
+            if key not in profile
+        ]
+        if missing:
+            raise ValueError(f"Profile {profile} in {path} is missing {missing}")
+        profile.setdefault("timing", 4)
+        for key in PROFILE_KEYS[1:]:
+            profile.setdefault(key, None)
+    return profiles
+
+
+def estimate_duration(profile, ips, pairs, slowness=1.0):
+    """Estimates how many seconds a profile takes to scan pairs IP-port pairs
+    across ips hosts on a network that scans slowness times slower than the
+    profile's nominal rate.
+    """
+    return (ips * SECONDS_PER_IP + pairs * profile["seconds_per_pair"]) * slowness
+
+
+def select_profile(profiles, ips, pairs, deadline, slowness=1.0):
+    """Returns the most thorough profile expected to scan the job within
+    deadline seconds, or the fastest if none is, with its estimated duration.
+    """
+    for profile in profiles:
+        estimate = estimate_duration(profile, ips, pairs, slowness)
+        if estimate <= deadline:
+            return profile, estimate
+    return profiles[-1], estimate_duration(profiles[-1], ips, pairs, slowness)
@@ -0,0 +1,94 @@
+import xml.etree.ElementTree as ET
+
+from nmapxml import split_host_groups
+
+DISCOVERY_SCANNERS = ["nmap", "masscan"]
+DEFAULT_DISCOVERY_RATE = 1000
+
+
+def discovery_args(scanner, ports, ips, outfile, rate=DEFAULT_DISCOVERY_RATE):
+    """Returns the command for a fast, rate-limited SYN sweep that only finds
+    open ports, writing nmap-style XML to outfile. scanner is "nmap" (-sS
+    without -sV) or "masscan", which must be installed.
+    """
+    if scanner == "masscan":
+        return [
+            "masscan",
+            "-p",
+            ",".join(ports),
+            "--rate",
+            str(rate),
+            "--wait",
+            "5",
+            "-oX",
+            outfile,
+        ] + ips
+    if scanner == "nmap":
+        return [
+            "nmap",
+            "-p",
+            ",".join(ports),
+            "-Pn",
+            "-T4",
+            "-sS",
+            "--open",
+            "--max-retries",
+            "2",
+            "--max-rate",
+            str(rate),
+            "--stats-every",
+            "30s",
+            "-oX",
+            outfile,
+        ] + ips
+    raise ValueError(f"Unsupported discovery scanner: {scanner}")
+
+
+def parse_open_ports(path):
+    """Reads a discovery scan's XML (from nmap, or masscan, which writes one
+    host element per open port) and returns the open TCP ports of each host
+    in the order hosts were found.
+
+    The output looks like:
+    {"1.2.3.4": ["22", "443"], "4.4.4.4": ["8888"]}
+    """
+    open_ports = {}
+    for _, element in ET.iterparse(path):
+        if element.tag != "host":
+            continue
+        address = element.find("address")
+        if address is not None:
+            for port in element.iter("port"):
+                state = port.find("state")
+                if state is None or state.get("state") != "open":
+                    continue
+                ip_ports = open_ports.setdefault(address.get("addr"), [])
+                if port.get("portid") not in ip_ports:
+                    ip_ports.append(port.get("portid"))
+        element.clear()
+    return open_ports
+
+
+def group_by_open_ports(open_ports, max_groups=None):
+    """Groups hosts that have the same open ports, so each group can be
+    version-scanned by one nmap run restricted to exactly those ports.
+
+    If that makes more than max_groups groups, the hosts are instead split
+    into max_groups groups, each scanned on the union of its hosts' open
+    ports, since many single-host nmap runs lose nmap's own parallelism.
+
+    The output looks like:
+    [(["22", "443"], ["1.2.3.4", "5.6.7.8"]), (["8888"], ["4.4.4.4"])]
+    """
+    groups = {}
+    for ip, ports in open_ports.items():
+        key = tuple(sorted(ports, key=int))
+        groups.setdefault(key, []).append(ip)
+    if max_groups is None or len(groups) <= max_groups:
+        return [(list(ports), ips) for ports, ips in groups.items()]
+
+    result = []
+    for group in split_host_groups(list(open_ports), max_groups):
+        ports = {port for ip in group for port in open_ports[ip]}
+        result.append((sorted(ports, key=int), group))
+    return result
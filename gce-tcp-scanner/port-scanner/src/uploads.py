@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import storage
+from gcpclients import get_client
+
+
+def get_storage_client():
+    """Returns a storage client shared by every scan in this process, so
+    connections and credentials are reused rather than set up per message.
+    """
+    return get_client(("storage",), storage.Client)
+
+
+class TeeReader:
+    """Wraps a binary file object so everything read from it is also written
+    to sink, e.g. to compress a file while it is being parsed.
+    """
+
+    def __init__(self, fileobj, sink):
+        self.fileobj = fileobj
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sink.write(data)
+        return data
+
+
+def upload_gzipped(bucket_name, blob_name, path, content_type):
+    """Uploads an already gzip-compressed file with gzip content-encoding, so
+    GCS stores it compressed but serves it decompressed to clients that don't
+    accept gzip.
+    """
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    blob.content_encoding = "gzip"
+    blob.upload_from_filename(path, content_type=content_type)
+
+
+def upload_all(uploads):
+    """Runs upload_gzipped for each (bucket, blob, path, content type) tuple
+    concurrently, raising the first error once all have finished.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(uploads))) as executor:
+        futures = [executor.submit(upload_gzipped, *upload) for upload in uploads]
+    for future in futures:
+        future.result()